@@ -452,7 +452,7 @@ router.get(
   datasetService.dataset_access_check,
   asyncHandler(async (req, res, next) => {
     // #swagger.tags = ['datasets']
-    // only select path and md5 columns from the dataset_file table if files is
+    // only select path, md5 and size columns from the dataset_file table if files is
     // true
 
     const dataset = await datasetService.get_dataset({
@@ -205,6 +205,7 @@ async function get_dataset({
     select: {
       path: true,
       md5: true,
+      size: true,
     },
     where: {
       NOT: {
@@ -56,6 +56,9 @@ elif [ $WORKER_TYPE == "metrics" ]; then
 elif [ $WORKER_TYPE == "purge_staged_datasets" ]; then
   echo "Starting Purge Staged Datasets Worker"
   python -m workers.scripts.purge_staged_datasets
+elif [ $WORKER_TYPE == "collect_chunk_garbage" ]; then
+  echo "Starting Chunk Store Garbage Collection Worker"
+  python -m workers.scripts.collect_chunk_garbage
 elif [ $WORKER_TYPE == "purge_stale_workflows" ]; then
   echo "Starting Purge Stale Workflows Worker"
   python -m workers.scripts.purge_stale_workflows
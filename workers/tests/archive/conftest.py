@@ -0,0 +1,104 @@
+"""
+Fixtures for the archive and stage tests.
+
+These tests run without Docker services: the archive is a local directory (app_env docker), and the paths of
+the RAW_DATA dataset type are moved under the test's tmp_path.
+
+Fixture chain
+-------------
+  archive_paths  →  make_dataset(files, ...)  →  dataset dict (archived with archived=True)
+
+  ledger         -  a digest ledger in tmp_path instead of no ledger, for tests that need one
+"""
+
+import os
+from collections.abc import Callable
+from pathlib import Path
+
+import pytest
+
+from workers import digest_ledger
+from workers.config import config
+from workers.tasks import archive as archive_task
+
+
+@pytest.fixture
+def archive_paths(tmp_path: Path, monkeypatch) -> dict:
+    """
+    config['paths']['RAW_DATA'] under tmp_path (archive, staged, bundle generation and staging directories) and
+    the download directory in tmp_path / 'download'. The digest ledger is off.
+    """
+    monkeypatch.setitem(config['paths'], 'RAW_DATA', {
+        **config['paths']['RAW_DATA'],
+        'archive': str(tmp_path / 'archive'),
+        'stage': str(tmp_path / 'staged'),
+        'bundle': {
+            'generate': str(tmp_path / 'bundle' / 'generation'),
+            'stage': str(tmp_path / 'bundle' / 'staging'),
+        },
+    })
+    monkeypatch.setitem(config['paths'], 'download_dir', str(tmp_path / 'download'))
+    (tmp_path / 'bundle' / 'generation').mkdir(parents=True)
+    monkeypatch.setattr(digest_ledger, 'get_ledger', lambda: None)
+    return config['paths']['RAW_DATA']
+
+
+@pytest.fixture
+def ledger(archive_paths: dict, tmp_path: Path, monkeypatch) -> digest_ledger.DigestLedger:
+    ledger = digest_ledger.DigestLedger(tmp_path / 'digests.sqlite3')
+    monkeypatch.setattr(digest_ledger, 'get_ledger', lambda: ledger)
+    return ledger
+
+
+@pytest.fixture
+def make_dataset(archive_paths: dict, tmp_path: Path) -> Callable[..., dict]:
+    """
+    Factory of RAW_DATA datasets with their origin directory in tmp_path / 'origin' / name.
+
+    make_dataset(files, name='run1', hard_links=None, symlinks=None, du_size=None, archived=False)
+
+    files: {path relative to the dataset: contents}
+    hard_links: {path: path of a file in files} - additional names of files
+    symlinks: {path: link target}
+    du_size: default: the size of the files
+    archived: archive the dataset with archive_task.archive and add its 'archive_path' and 'bundle'
+
+    Datasets are numbered from 1 in the order they are made.
+    """
+    num_datasets = 0
+
+    def make(files: dict[str, bytes | str],
+             name: str = 'run1',
+             hard_links: dict[str, str] = None,
+             symlinks: dict[str, str] = None,
+             du_size: int = None,
+             archived: bool = False) -> dict:
+        nonlocal num_datasets
+        origin = tmp_path / 'origin' / name
+        origin.mkdir(parents=True, exist_ok=True)
+        for relpath, contents in files.items():
+            (origin / relpath).parent.mkdir(parents=True, exist_ok=True)
+            if isinstance(contents, str):
+                (origin / relpath).write_text(contents, encoding='utf-8')
+            else:
+                (origin / relpath).write_bytes(contents)
+        for relpath, existing in (hard_links or {}).items():
+            os.link(origin / existing, origin / relpath)
+        for relpath, target in (symlinks or {}).items():
+            (origin / relpath).symlink_to(target)
+
+        num_datasets += 1
+        dataset = {
+            'id': num_datasets,
+            'name': name,
+            'type': 'RAW_DATA',
+            'origin_path': str(origin),
+            'du_size': du_size if du_size is not None else sum(len(contents) for contents in files.values()),
+            'bundle': None,
+        }
+        if archived:
+            archive_path, bundle_attrs = archive_task.archive(celery_task=None, dataset=dataset)
+            dataset = {**dataset, 'archive_path': archive_path, 'bundle': bundle_attrs}
+        return dataset
+
+    return make
@@ -0,0 +1,47 @@
+import hashlib
+import tarfile
+from pathlib import Path
+
+import pytest
+
+from workers.config import config
+from workers.tasks import archive as archive_task
+
+
+@pytest.fixture
+def dataset(make_dataset) -> dict:
+    return make_dataset({
+        'lane1/reads.fastq.gz': b'ACGT' * 50_000,
+        'SampleSheet.csv': 'sample,lane\nS1,1\n',
+    })
+
+
+@pytest.mark.parametrize('mode', ['tar', 'stream', 'diskless'])
+def test_archive_modes_produce_the_same_bundle(dataset: dict, mode: str, monkeypatch):
+    monkeypatch.setitem(config['archive'], 'mode', mode)
+
+    archive_path, bundle_attrs = archive_task.archive(celery_task=None, dataset=dataset)
+
+    archived = Path(archive_path)
+    assert archived.name == 'run1.tar'
+    assert bundle_attrs['name'] == 'run1.tar'
+    assert bundle_attrs['size'] == archived.stat().st_size
+    assert bundle_attrs['md5'] == hashlib.md5(archived.read_bytes()).hexdigest()
+    assert not archived.with_name('run1.tar.partial').exists()
+
+    with tarfile.open(archived) as tar:
+        assert './lane1/reads.fastq.gz' in tar.getnames()
+
+    generated = Path(config['paths']['RAW_DATA']['bundle']['generate']) / 'run1.tar'
+    assert generated.exists() == (mode != 'diskless')
+
+
+def test_diskless_archive_is_not_left_behind_when_tar_fails(dataset: dict, monkeypatch):
+    monkeypatch.setitem(config['archive'], 'mode', 'diskless')
+    dataset['origin_path'] = str(Path(dataset['origin_path']).parent / 'missing')
+
+    with pytest.raises(archive_task.cmd.SubprocessError):
+        archive_task.archive(celery_task=None, dataset=dataset)
+
+    archive_dir = Path(config['paths']['RAW_DATA']['archive'])
+    assert list(archive_dir.iterdir()) == []
@@ -0,0 +1,192 @@
+import hashlib
+import io
+import os
+import subprocess
+import tarfile
+from pathlib import Path
+
+import pytest
+
+import workers.api as api
+from workers import bundle_index
+from workers.config import config
+from workers.dataset import get_bundle_index_archive_path, get_bundle_staged_path
+from workers.tasks import archive as archive_task
+from workers.tasks import delete as delete_task
+from workers.tasks import stage as stage_task
+from workers.tasks.inspect_and_archive import write_bundle
+
+
+@pytest.fixture
+def dataset(make_dataset, monkeypatch) -> dict:
+    monkeypatch.setitem(config['archive'], 'index', True)
+    monkeypatch.setitem(config['archive'], 'zstd', {'level': 3, 'frame_size': 32 * 1024, 'threads': 4})
+    files = {f'{lane}/S{sample}.fastq': os.urandom(50_000 + sample)
+             for lane in ['lane1', 'lane2'] for sample in range(3)}
+    return make_dataset({**files, 'SampleSheet.csv': 'sample,lane\nS1,1\n'},
+                        hard_links={'lane2/S0.copy.fastq': 'lane2/S0.fastq'},
+                        symlinks={'lane2/latest.fastq': 'S2.fastq'})
+
+
+def _archive(dataset: dict) -> dict:
+    archive_path, bundle_attrs = archive_task.archive(celery_task=None, dataset=dataset)
+    return {**dataset, 'archive_path': archive_path, 'bundle': bundle_attrs}
+
+
+class _ForwardOnly(io.RawIOBase):
+    def __init__(self, f):
+        self.f = f
+
+    def readinto(self, b):
+        return self.f.readinto(b)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+
+@pytest.mark.parametrize('mode', ['tar', 'stream', 'diskless'])
+def test_index_matches_the_bundle(dataset: dict, mode: str, monkeypatch):
+    monkeypatch.setitem(config['archive'], 'mode', mode)
+    archived = _archive(dataset)
+
+    index_path = get_bundle_index_archive_path(archived)
+    entries, frames = bundle_index.read_index(index_path)
+    assert frames is None
+    by_path = {e.path: e for e in entries}
+
+    bundle = Path(archived['archive_path'])
+    with tarfile.open(bundle) as tar, open(bundle, 'rb') as raw:
+        for member in tar.getmembers():
+            if member.name == '.':
+                continue
+            path = member.name.removeprefix('./')
+            entry = by_path[path]
+            if member.isreg():
+                raw.seek(entry.offset)
+                data = raw.read(entry.size)
+                assert entry.offset == member.offset_data
+                assert entry.md5 == hashlib.md5(data).hexdigest() == hashlib.md5(
+                    tar.extractfile(member).read()).hexdigest()
+            elif member.islnk():
+                assert entry.type == 'hardlink'
+            elif member.issym():
+                assert (entry.type, entry.linkname) == ('symlink', 'S2.fastq')
+
+
+@pytest.mark.parametrize('bundle_format', ['tar', 'tar.zst'])
+def test_stage_files(dataset: dict, bundle_format: str, monkeypatch):
+    monkeypatch.setitem(config['archive'], 'mode', 'stream')
+    monkeypatch.setitem(config['archive'], 'format', bundle_format)
+    archived = _archive(dataset)
+    origin = Path(dataset['origin_path'])
+
+    files = ['lane1/S1.fastq', 'lane2/S0.copy.fastq', 'lane2/latest.fastq', 'SampleSheet.csv']
+    staged = stage_task.stage_files(celery_task=None, dataset=archived, files=files)
+
+    assert staged == stage_task.partial_staging_path(archived)
+    staged_files = sorted(str(p.relative_to(staged)) for p in staged.rglob('*') if not p.is_dir())
+    assert staged_files == sorted(files)
+    for f in ['lane1/S1.fastq', 'lane2/S0.copy.fastq', 'SampleSheet.csv']:
+        assert (staged / f).read_bytes() == (origin / f).read_bytes()
+    assert os.readlink(staged / 'lane2' / 'latest.fastq') == 'S2.fastq'
+    # the whole bundle was never staged
+    assert not Path(get_bundle_staged_path(archived)).exists()
+
+
+def test_stage_files_without_an_index(dataset: dict, monkeypatch):
+    monkeypatch.setitem(config['archive'], 'mode', 'stream')
+    archived = _archive(dataset)
+    index_archive_path = Path(get_bundle_index_archive_path(archived))
+    index_archive_path.unlink()
+
+    staged = stage_task.stage_files(celery_task=None, dataset=archived, files=['lane1/S2.fastq'])
+
+    origin = Path(dataset['origin_path'])
+    assert (staged / 'lane1' / 'S2.fastq').read_bytes() == (origin / 'lane1' / 'S2.fastq').read_bytes()
+    # the index is built from the staged bundle and archived for the next request
+    assert index_archive_path.exists()
+
+
+def test_read_members_from_a_forward_only_stream(dataset: dict, tmp_path: Path, monkeypatch):
+    monkeypatch.setitem(config['archive'], 'mode', 'stream')
+    monkeypatch.setitem(config['archive'], 'format', 'tar.zst')
+    archived = _archive(dataset)
+    entries, frames = bundle_index.read_index(get_bundle_index_archive_path(archived), ['lane2/S2.fastq'])
+    assert len(frames) > 1
+
+    with open(archived['archive_path'], 'rb') as f:
+        bundle_index.read_members(io.BufferedReader(_ForwardOnly(f)), entries, tmp_path / 'out', frames=frames)
+    assert (tmp_path / 'out' / 'lane2' / 'S2.fastq').read_bytes() == \
+           (Path(dataset['origin_path']) / 'lane2' / 'S2.fastq').read_bytes()
+
+
+@pytest.mark.parametrize('forward_only', [False, True])
+def test_read_sparse_members(tmp_path: Path, forward_only: bool):
+    source = tmp_path / 'source'
+    source.mkdir()
+    image = source / 'image.raw'
+    with open(image, 'wb') as f:
+        f.write(os.urandom(4096))
+        f.seek(8 * 1024 * 1024)
+        f.write(os.urandom(4096))
+        f.truncate(16 * 1024 * 1024)
+    (source / 'after.txt').write_bytes(os.urandom(3000))
+    bundle = tmp_path / 'bundle.tar'
+    subprocess.run(['tar', 'cf', str(bundle), '--sparse', '-C', str(source), '.'], check=True)
+
+    index_path = tmp_path / 'bundle.index.jsonl.gz'
+    bundle_index.index_bundle(bundle, index_path)
+    entries, frames = bundle_index.read_index(index_path, ['image.raw', 'after.txt'])
+    by_path = {e.path: e for e in entries}
+    assert by_path['image.raw'].sparse is not None
+    assert by_path['image.raw'].stored_size < by_path['image.raw'].size
+
+    with open(bundle, 'rb') as f:
+        stream = io.BufferedReader(_ForwardOnly(f)) if forward_only else f
+        bundle_index.read_members(stream, entries, tmp_path / 'out', frames=frames)
+    staged = tmp_path / 'out' / 'image.raw'
+    assert staged.read_bytes() == image.read_bytes()
+    assert staged.stat().st_blocks * 512 < staged.stat().st_size
+    assert (tmp_path / 'out' / 'after.txt').read_bytes() == (source / 'after.txt').read_bytes()
+
+
+def test_unknown_files_are_rejected(dataset: dict, monkeypatch):
+    monkeypatch.setitem(config['archive'], 'mode', 'stream')
+    archived = _archive(dataset)
+    with pytest.raises(stage_task.exc.ValidationFailed):
+        stage_task.stage_files(celery_task=None, dataset=archived, files=['lane3/S0.fastq'])
+
+
+def test_single_read_writer_index_matches_tar_indexer(dataset: dict, tmp_path: Path):
+    sink = io.BytesIO()
+    index = bundle_index.IndexWriter(tmp_path / 'written.index.jsonl.gz')
+    write_bundle(celery_task=None, sink=sink, source=Path(dataset['origin_path']), on_file=lambda r: None,
+                 index=index)
+    index.close()
+
+    parsed = bundle_index.IndexWriter(tmp_path / 'parsed.index.jsonl.gz')
+    with bundle_index.TarIndexer(parsed) as indexer:
+        indexer.write(sink.getvalue())
+    parsed.close()
+
+    written, _ = bundle_index.read_index(tmp_path / 'written.index.jsonl.gz')
+    expected, _ = bundle_index.read_index(tmp_path / 'parsed.index.jsonl.gz')
+    assert sorted(written) == sorted(expected)
+
+
+def test_delete_dataset_deletes_the_index(dataset: dict, monkeypatch):
+    monkeypatch.setitem(config['archive'], 'mode', 'tar')
+    archived = _archive(dataset)
+    index_path = Path(get_bundle_index_archive_path(archived))
+    assert index_path.exists()
+
+    monkeypatch.setattr(api, 'get_dataset', lambda dataset_id, **kwargs: archived)
+    monkeypatch.setattr(api, 'update_dataset', lambda dataset_id, update_data: None)
+    monkeypatch.setattr(api, 'add_state_to_dataset', lambda dataset_id, state, **kwargs: None)
+    delete_task.delete_dataset(celery_task=None, dataset_id=archived['id'])
+
+    assert not Path(archived['archive_path']).exists()
+    assert not index_path.exists()
@@ -0,0 +1,168 @@
+import hashlib
+import os
+from pathlib import Path
+
+import pytest
+
+from workers import chunkstore
+from workers.config import config
+from workers.tasks import archive as archive_task
+from workers.tasks import stage as stage_task
+from workers.tasks.stage import extract_tarfile
+
+
+@pytest.fixture
+def store(archive_paths: dict, tmp_path: Path, monkeypatch) -> Path:
+    monkeypatch.setitem(config['archive'], 'mode', 'chunks')
+    monkeypatch.setitem(config['archive'], 'chunks', {
+        'store': str(tmp_path / 'archive' / 'chunks'),
+        'index': str(tmp_path / 'chunk_index.sqlite3'),
+        'min_size': 4 * 1024,
+        'avg_size': 16 * 1024,
+        'max_size': 64 * 1024,
+        'pack_size': 256 * 1024,
+        'grace_period_seconds': 0,
+        'index_host': None,
+    })
+    monkeypatch.setattr(chunkstore, '_index', None)
+    # next to the chunk store, as in the docker config
+    monkeypatch.setitem(archive_paths, 'archive', str(tmp_path / 'archive' / 'raw_data'))
+    return tmp_path / 'archive' / 'chunks' / 'packs'
+
+
+def archive(dataset: dict) -> dict:
+    archive_path, bundle_attrs = archive_task.archive(celery_task=None, dataset=dataset)
+    return {**dataset, 'archive_path': archive_path, 'bundle': bundle_attrs}
+
+
+def pack_bytes(store: Path) -> int:
+    return sum(p.stat().st_size for p in store.glob('*.pack')) if store.exists() else 0
+
+
+@pytest.fixture
+def files() -> dict[str, bytes]:
+    return {f'lane{lane}/S{sample}.fastq': os.urandom(300_000 + sample) for lane in [1, 2] for sample in range(3)}
+
+
+def test_chunker_cuts_are_content_defined():
+    chunker = chunkstore.Chunker(min_size=4096, avg_size=16384, max_size=65536)
+    data = os.urandom(2_000_000)
+    chunks = chunker.push(data[:700_001]) + chunker.push(data[700_001:]) + chunker.finish()
+    assert b''.join(chunks) == data
+    assert all(4096 <= len(chunk) <= 65536 for chunk in chunks[:-1])
+
+    # a block inserted at the front only changes the chunks around it
+    shifted = chunkstore.Chunker(min_size=4096, avg_size=16384, max_size=65536)
+    shifted_chunks = shifted.push(os.urandom(512) + data) + shifted.finish()
+    assert len(set(chunks) & set(shifted_chunks)) >= len(chunks) - 2
+
+
+def test_archive_and_stage(store: Path, make_dataset, files: dict):
+    dataset = make_dataset(files, name='run1', archived=True)
+    assert dataset['archive_path'].endswith('run1.tar' + chunkstore.RECIPE_SUFFIX)
+    assert dataset['bundle']['name'] == 'run1.tar'
+
+    staged_path, _ = stage_task.stage(celery_task=None, dataset=dataset)
+    for relpath, data in files.items():
+        assert (Path(staged_path) / relpath).read_bytes() == data
+
+
+def test_rearchive_stores_only_new_chunks(store: Path, make_dataset, files: dict):
+    dataset = make_dataset(files, name='run1')
+    archive(dataset)
+    first = pack_bytes(store)
+
+    (Path(dataset['origin_path']) / 'lane2' / 'S1.fastq').write_bytes(os.urandom(300_001))
+    archive(dataset)
+    assert pack_bytes(store) - first < first / 3
+
+    # an overlapping dataset shares the chunks of the files it has in common
+    before = pack_bytes(store)
+    make_dataset({'S0.fastq': files['lane1/S0.fastq'], 'new.fastq': os.urandom(50_000)}, name='run2', archived=True)
+    assert pack_bytes(store) - before < 150_000
+
+
+def test_stage_files_restores_only_the_chunks_it_needs(store: Path, make_dataset, files: dict, monkeypatch):
+    monkeypatch.setitem(config['archive'], 'index', True)
+    dataset = make_dataset(files, name='run1', archived=True)
+
+    restored = []
+    restore_pack = chunkstore._restore_pack
+
+    def count_restored(pack, chunks, local_file):
+        restored.append(sum(size for _, size, _, _ in chunks))
+        return restore_pack(pack, chunks, local_file)
+
+    monkeypatch.setattr(chunkstore, '_restore_pack', count_restored)
+    staged = stage_task.stage_files(celery_task=None, dataset=dataset, files=['lane2/S2.fastq'])
+
+    assert (staged / 'lane2' / 'S2.fastq').read_bytes() == files['lane2/S2.fastq']
+    assert sum(restored) < dataset['bundle']['size'] / 3
+
+
+def test_garbage_collection(store: Path, make_dataset, tmp_path: Path, files: dict):
+    run1 = make_dataset(files, name='run1', archived=True)
+    shared = {'S0.fastq': files['lane1/S0.fastq']}
+    run2 = make_dataset(shared, name='run2', archived=True)
+    assert chunkstore.collect_garbage() == []
+
+    chunkstore.forget_recipe(run1['archive_path'])
+    collected = chunkstore.collect_garbage()
+    assert collected
+    assert not any(Path(path).exists() for path, _ in collected)
+
+    # the chunks run2 shares with run1 are still there
+    bundle = tmp_path / 'run2.tar'
+    chunkstore.restore(recipe_path=run2['archive_path'], local_file=bundle)
+    assert hashlib.md5(bundle.read_bytes()).hexdigest() == run2['bundle']['md5']
+    extract_tarfile(tar_path=bundle, target_dir=tmp_path / 'run2', override_arcname=True)
+    assert (tmp_path / 'run2' / 'S0.fastq').read_bytes() == files['lane1/S0.fastq']
+
+
+def test_failed_archive_is_not_committed(store: Path, tmp_path: Path):
+    recipe_path = chunkstore.recipe_archive_path(str(tmp_path / 'archive' / 'raw_data' / 'run1.tar'))
+    work_dir = tmp_path / 'bundle' / 'generation'
+    with pytest.raises(RuntimeError):
+        with chunkstore.ChunkWriter(recipe_path=recipe_path, work_dir=work_dir) as writer:
+            writer.write(os.urandom(600_000))
+            raise RuntimeError('tar failed')
+
+    assert not Path(recipe_path).exists()
+    assert list(work_dir.iterdir()) == []
+    # the packs it uploaded before it failed are garbage
+    uploaded = sorted(p.name for p in store.glob('*.pack'))
+    assert uploaded
+    assert sorted(Path(path).name for path, _ in chunkstore.collect_garbage()) == uploaded
+
+
+def test_chunk_index_is_pinned_to_its_node(store: Path, make_dataset, files: dict, monkeypatch):
+    dataset = make_dataset(files, name='run1', archived=True)
+    monkeypatch.setitem(config['archive']['chunks'], 'index_host', 'another-node.example.edu')
+
+    with pytest.raises(chunkstore.ChunkStoreError):
+        make_dataset(files, name='run2', archived=True)
+    with pytest.raises(chunkstore.ChunkStoreError):
+        chunkstore.collect_garbage()
+    with pytest.raises(chunkstore.ChunkStoreError):
+        chunkstore.forget_recipe(dataset['archive_path'])
+
+    # staging only needs the recipe and the packs
+    staged_path, _ = stage_task.stage(celery_task=None, dataset=dataset)
+    assert (Path(staged_path) / 'lane1' / 'S0.fastq').read_bytes() == files['lane1/S0.fastq']
+
+
+def test_chunk_stored_by_parallel_runs_keeps_both_packs(tmp_path: Path):
+    index = chunkstore.ChunkIndex(tmp_path / 'chunk_index.sqlite3')
+    # two runs stored the same new chunk, each in its own pack, and each recipe reads it from its own pack
+    index.add_pack('p1', 10, [('X', 0, 10)])
+    index.add_pack('p2', 10, [('X', 0, 10)])
+    for recipe, pack in [('r1', 'p1'), ('r2', 'p2')]:
+        pending = index.begin_recipe(recipe)
+        index.add_refs(pending, reused=[], stored=[('X', pack)])
+        index.commit_recipe(pending, recipe)
+
+    assert index.collect_garbage(grace_period_seconds=0) == []
+    index.forget_recipe('r1')
+    assert index.collect_garbage(grace_period_seconds=0) == [('p1', 10)]
+    assert index.lookup('X') == ('p2', 0, 10)
+    index.close()
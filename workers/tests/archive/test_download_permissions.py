@@ -0,0 +1,89 @@
+import os
+import stat
+import tarfile
+from pathlib import Path
+
+import pytest
+
+from workers import tarextract
+from workers.config import config
+from workers.tasks import archive as archive_task
+from workers.tasks import download as download_task
+from workers.tasks import stage as stage_task
+
+
+def _others(path: Path) -> int:
+    return stat.S_IMODE(path.lstat().st_mode) & 0o007
+
+
+@pytest.fixture
+def tree(tmp_path: Path) -> Path:
+    root = tmp_path / 'run1'
+    for d in range(5):
+        for f in range(30):
+            path = root / f'L00{d}' / f'C{f % 3}' / f's_{f}.bcl'
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(b'bcl')
+    (root / 'SampleSheet.csv').write_text('sample\n', encoding='utf-8')
+    (root / 'L000' / 'public.txt').touch()
+    outside = tmp_path / 'outside.txt'
+    outside.touch()
+    os.symlink(outside, root / 'link')
+    for p in [root, *root.rglob('*'), outside]:
+        if not p.is_symlink():
+            p.chmod(0o700 if p.is_dir() else 0o600)
+    (root / 'L000' / 'public.txt').chmod(0o644)
+    return root
+
+
+def test_grant_read_permissions_to_others(tree: Path):
+    entries = [p for p in [tree, *tree.rglob('*')] if not p.is_symlink()]
+
+    changed = download_task.grant_read_permissions_to_others(tree, num_workers=4, batch_size=7)
+
+    assert changed == len(entries) - 1
+    for p in entries:
+        assert _others(p) == (0o005 if p.is_dir() else 0o004)
+    # symlinks are not followed out of the tree
+    assert _others(tree.parent / 'outside.txt') == 0
+    assert download_task.grant_read_permissions_to_others(tree, num_workers=4) == 0
+
+
+def test_extract_readable_by_others(tree: Path, tmp_path: Path):
+    bundle = tmp_path / 'run1.tar'
+    with tarfile.open(bundle, 'w') as tar:
+        tar.add(tree, arcname='run1')
+
+    with tarfile.open(bundle) as tar:
+        tarextract.extract(tar, tmp_path / 'extracted', num_workers=4, readable_by_others=True)
+
+    extracted = tmp_path / 'extracted' / 'run1'
+    for p in [extracted, *extracted.rglob('*')]:
+        if not p.is_symlink():
+            source = tree / p.relative_to(extracted)
+            added = 0o005 if p.is_dir() else 0o004
+            assert stat.S_IMODE(p.stat().st_mode) == stat.S_IMODE(source.stat().st_mode) | added
+
+
+def test_setup_download_does_not_walk_extracted_datasets(tree: Path, archive_paths: dict, tmp_path: Path,
+                                                        monkeypatch):
+    monkeypatch.setitem(config['paths'], 'root', str(tmp_path))
+    (tmp_path / 'download').mkdir()
+
+    dataset = {'id': 1, 'name': 'run1', 'type': 'RAW_DATA', 'origin_path': str(tree), 'du_size': 1000,
+               'bundle': None}
+    archive_path, bundle_attrs = archive_task.archive(celery_task=None, dataset=dataset)
+    dataset = {**dataset, 'archive_path': archive_path, 'bundle': bundle_attrs}
+    staged_path, alias = stage_task.stage(celery_task=None, dataset=dataset)
+    dataset = {**dataset, 'staged_path': staged_path, 'metadata': {'stage_alias': alias}}
+
+    walked = []
+    grant = download_task.grant_read_permissions_to_others
+    monkeypatch.setattr(download_task, 'grant_read_permissions_to_others',
+                        lambda root, **kwargs: walked.append(root) or grant(root, **kwargs))
+    monkeypatch.setattr(download_task.api, 'get_dataset', lambda dataset_id, **kwargs: dataset)
+
+    download_task.setup_download(None, 1)
+
+    assert Path(staged_path) not in walked
+    assert _others(Path(staged_path) / 'L000' / 'C0' / 's_0.bcl') == 0o004
@@ -0,0 +1,65 @@
+import hashlib
+import os
+import tarfile
+from pathlib import Path
+
+import pytest
+
+from workers import hashing
+from workers.config import config
+from workers.tasks import stage as stage_task
+from workers.tasks import validate as validate_task
+
+
+@pytest.fixture
+def dataset(make_dataset, ledger, monkeypatch) -> dict:
+    monkeypatch.setitem(config['archive'], 'mode', 'stream')
+    monkeypatch.setitem(config['archive'], 'format', 'tar')
+    # stage from the archive, not from the generated bundle
+    monkeypatch.setitem(config['stage'], 'local_bundles', False)
+
+    dataset = make_dataset({
+        'lane1/reads.fastq': os.urandom(300_000),
+        'lane1/empty.txt': b'',
+        'SampleSheet.csv': 'sample,lane\nS1,1\n',
+    }, hard_links={'lane1/SampleSheet.csv': 'SampleSheet.csv'}, archived=True)
+    origin = Path(dataset['origin_path'])
+    files = [{'path': str(p.relative_to(origin)), 'md5': hashlib.md5(p.read_bytes()).hexdigest(),
+              'size': p.stat().st_size}
+             for p in sorted(origin.rglob('*')) if p.is_file()]
+    return {**dataset, 'files': files}
+
+
+@pytest.mark.parametrize('stage_mode', ['bundle', 'stream'])
+def test_extraction_digests(dataset: dict, stage_mode: str, monkeypatch):
+    monkeypatch.setitem(config['stage'], 'mode', stage_mode)
+    staged_path, _ = stage_task.stage(celery_task=None, dataset=dataset)
+
+    # validate_dataset after stage (tier sample) finds every digest in the ledger and does not read the staged
+    # files again
+    def read(*args, **kwargs):
+        raise AssertionError('staged file was read again')
+
+    monkeypatch.setattr(hashing, 'hash_file', read)
+    validation_errors, report = validate_task.check_files(celery_task=None, dataset_dir=Path(staged_path),
+                                                          files_metadata=dataset['files'], tier='sample')
+    assert report['hashed_files'] == len(dataset['files'])
+    assert validation_errors == []
+
+
+def test_digests_of_the_extracted_bytes(dataset: dict, tmp_path: Path):
+    bundle = tmp_path / 'run1.tar'
+    with tarfile.open(bundle, 'w') as tar:
+        tar.add(dataset['origin_path'], arcname='run1')
+
+    digests = stage_task.extract_tarfile(tar_path=bundle, target_dir=tmp_path / 'extracted' / 'run1')
+    assert digests == {f['path']: f['md5'] for f in dataset['files']}
+
+
+def test_checksum_mismatch(dataset: dict):
+    dataset['files'][0]['md5'] = '0' * 32
+    with pytest.raises(stage_task.exc.ValidationFailed) as e:
+        stage_task.stage(celery_task=None, dataset=dataset)
+
+    staged_path, _ = stage_task.compute_staging_path(dataset)
+    assert e.value.args[0] == [(str(staged_path / dataset['files'][0]['path']), 'checksum mismatch')]
@@ -0,0 +1,80 @@
+import os
+from pathlib import Path
+
+import pytest
+
+import workers.workflow_utils as wf_utils
+from workers import utils
+from workers.config import config
+from workers.dataset import get_archive_bundle_name, get_bundle_staged_path
+from workers.tasks import stage as stage_task
+
+
+@pytest.fixture
+def dataset(make_dataset, ledger, monkeypatch) -> dict:
+    monkeypatch.setitem(config['archive'], 'mode', 'stream')
+    monkeypatch.setitem(config['archive'], 'format', 'tar')
+    return make_dataset({
+        'lane1/reads.fastq': os.urandom(200_000),
+        'SampleSheet.csv': 'sample,lane\nS1,1\n',
+    }, archived=True)
+
+
+@pytest.fixture
+def downloads(monkeypatch) -> list:
+    downloads = []
+    stage = wf_utils.stage
+
+    def record(archive_path, local_file_path, celery_task=None):
+        downloads.append(archive_path)
+        return stage(archive_path=archive_path, local_file_path=local_file_path, celery_task=celery_task)
+
+    monkeypatch.setattr(wf_utils, 'stage', record)
+    monkeypatch.setattr(wf_utils, 'open_archive_reader', None)
+    return downloads
+
+
+@pytest.mark.parametrize('stage_mode', ['bundle', 'stream'])
+def test_stages_the_generated_bundle(dataset: dict, downloads: list, stage_mode: str, monkeypatch):
+    monkeypatch.setitem(config['stage'], 'mode', stage_mode)
+    generated = Path(config['paths']['RAW_DATA']['bundle']['generate']) / get_archive_bundle_name(dataset)
+    lookups = []
+    find_local_bundle = stage_task.find_local_bundle
+    monkeypatch.setattr(stage_task, 'find_local_bundle', lambda d: lookups.append(d) or find_local_bundle(d))
+
+    staged_path, _ = stage_task.stage(celery_task=None, dataset=dataset)
+
+    assert downloads == []
+    assert len(lookups) == 1
+    if stage_mode == 'bundle':
+        assert os.path.samefile(get_bundle_staged_path(dataset), generated)
+    else:
+        # extracted where it is, not copied to the bundle staging directory
+        assert not Path(get_bundle_staged_path(dataset)).exists()
+    origin = Path(dataset['origin_path'])
+    for relpath in ['lane1/reads.fastq', 'SampleSheet.csv']:
+        assert (Path(staged_path) / relpath).read_bytes() == (origin / relpath).read_bytes()
+
+
+def test_modified_local_bundle_is_not_used(dataset: dict, downloads: list, monkeypatch):
+    generated = Path(config['paths']['RAW_DATA']['bundle']['generate']) / get_archive_bundle_name(dataset)
+    with open(generated, 'r+b') as f:
+        f.seek(-1, os.SEEK_END)
+        f.write(b'x')
+
+    stage_task.stage(celery_task=None, dataset=dataset)
+    assert downloads == [dataset['archive_path']]
+
+
+def test_clone_file_without_hard_links(tmp_path: Path, monkeypatch):
+    def no_link(src, dst):
+        raise OSError('cross-device link')
+
+    monkeypatch.setattr(os, 'link', no_link)
+    src = tmp_path / 'src'
+    src.write_bytes(os.urandom(3_000_000))
+    dst = tmp_path / 'dst'
+    dst.write_bytes(b'previous')
+
+    assert utils.clone_file(src, dst) in ('copy_file_range', 'copy')
+    assert dst.read_bytes() == src.read_bytes()
@@ -0,0 +1,202 @@
+import hashlib
+import io
+import os
+import shutil
+from contextlib import contextmanager
+from pathlib import Path
+
+import pytest
+
+import workers.workflow_utils as wf_utils
+from workers import digest_ledger, multipart, sda
+from workers.config import config
+
+
+class LocalSDA:
+    """
+    The hsi calls multipart makes, against a local directory.
+    """
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.puts = []
+        self.gets = []
+        self.fail_put_of = None
+
+    def path(self, sda_path: str) -> Path:
+        return self.root / sda_path
+
+    @contextmanager
+    def put_stream(self, sda_file: str, verify_checksum: bool = True):
+        self.puts.append(sda_file)
+        out = io.BytesIO()
+        yield out
+        if sda_file == self.fail_put_of:
+            raise ConnectionError('hsi lost its connection')
+        self.path(sda_file).write_bytes(out.getvalue())
+
+    @contextmanager
+    def get_stream(self, sda_file: str):
+        self.gets.append(sda_file)
+        with open(self.path(sda_file), 'rb') as f:
+            yield f
+
+    def get_hash(self, sda_path: str, missing_ok: bool = False):
+        if not self.path(sda_path).exists() and missing_ok:
+            return None
+        return hashlib.md5(self.path(sda_path).read_bytes()).hexdigest()
+
+    def exists(self, path: str) -> bool:
+        return self.path(path).exists()
+
+    def delete(self, path: str) -> None:
+        self.path(path).unlink(missing_ok=True)
+
+    def delete_directory(self, path: str) -> None:
+        self.path(path).rmdir()
+
+    def delete_recursive(self, path: str) -> None:
+        shutil.rmtree(self.path(path), ignore_errors=True)
+
+    def put(self, local_file: str, sda_file: str, verify_checksum: bool = True):
+        self.puts.append(sda_file)
+        self.path(sda_file).parent.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(local_file, self.path(sda_file))
+
+    def ensure_directory(self, dir_path: str) -> None:
+        self.path(dir_path).mkdir(parents=True, exist_ok=True)
+
+
+@pytest.fixture
+def local_sda(tmp_path: Path, monkeypatch) -> LocalSDA:
+    fake = LocalSDA(tmp_path / 'sda')
+    fake.root.mkdir()
+    for name in ['put', 'put_stream', 'get_stream', 'get_hash', 'exists', 'delete', 'delete_directory',
+                 'delete_recursive', 'ensure_directory']:
+        monkeypatch.setattr(sda, name, getattr(fake, name))
+    return fake
+
+
+@pytest.fixture
+def bundle(tmp_path: Path) -> Path:
+    path = tmp_path / 'generate' / 'run1.tar'
+    path.parent.mkdir()
+    path.write_bytes(os.urandom(10 * 1024 + 100))
+    return path
+
+
+def test_put_and_get(local_sda: LocalSDA, bundle: Path, tmp_path: Path):
+    transferred = []
+    multipart.put(bundle, 'archive/run1.tar', part_size=1024, parallel_transfers=3,
+                  on_part=lambda part: transferred.append(part.index))
+    assert transferred == list(range(11))
+    assert not multipart.journal_path(bundle).exists()
+
+    manifest = multipart.read_manifest('archive/run1.tar')
+    assert manifest['size'] == bundle.stat().st_size
+    assert [p['size'] for p in manifest['parts']] == [1024] * 10 + [100]
+
+    staged = tmp_path / 'staging' / 'run1.tar'
+    multipart.get('archive/run1.tar', staged, manifest, parallel_transfers=3)
+    assert staged.read_bytes() == bundle.read_bytes()
+    assert not multipart.journal_path(staged).exists()
+
+    with multipart.open_reader('archive/run1.tar', manifest) as f:
+        assert f.read() == bundle.read_bytes()
+
+
+def test_retried_put_skips_completed_parts(local_sda: LocalSDA, bundle: Path):
+    local_sda.fail_put_of = multipart.part_path('archive/run1.tar', 4)
+    with pytest.raises(ConnectionError):
+        multipart.put(bundle, 'archive/run1.tar', part_size=1024, parallel_transfers=1)
+    assert multipart.read_manifest('archive/run1.tar') is None
+
+    local_sda.fail_put_of = None
+    local_sda.puts.clear()
+    multipart.put(bundle, 'archive/run1.tar', part_size=1024, parallel_transfers=3)
+
+    uploaded = sorted(local_sda.puts)
+    assert uploaded == [multipart.part_path('archive/run1.tar', i) for i in range(4, 11)] + \
+           [multipart.manifest_path('archive/run1.tar')]
+
+
+def test_retried_get_skips_completed_parts(local_sda: LocalSDA, bundle: Path, tmp_path: Path, monkeypatch):
+    multipart.put(bundle, 'archive/run1.tar', part_size=1024, parallel_transfers=3)
+    manifest = multipart.read_manifest('archive/run1.tar')
+    staged = tmp_path / 'staging' / 'run1.tar'
+
+    get_part = multipart._get_part
+
+    def lose_worker_at_part_6(sda_path, local_file, part, block_size):
+        if part.index == 6:
+            raise ConnectionError('worker lost')
+        return get_part(sda_path, local_file, part, block_size)
+
+    monkeypatch.setattr(multipart, '_get_part', lose_worker_at_part_6)
+    with pytest.raises(ConnectionError):
+        multipart.get('archive/run1.tar', staged, manifest, parallel_transfers=1)
+
+    monkeypatch.setattr(multipart, '_get_part', get_part)
+    local_sda.gets.clear()
+    multipart.get('archive/run1.tar', staged, manifest, parallel_transfers=3)
+
+    assert sorted(local_sda.gets) == [multipart.part_path('archive/run1.tar', i) for i in range(6, 11)]
+    assert staged.read_bytes() == bundle.read_bytes()
+
+
+def test_corrupt_part_is_rejected(local_sda: LocalSDA, bundle: Path, tmp_path: Path):
+    multipart.put(bundle, 'archive/run1.tar', part_size=1024, parallel_transfers=3)
+    manifest = multipart.read_manifest('archive/run1.tar')
+    part = local_sda.path(multipart.part_path('archive/run1.tar', 2))
+    part.write_bytes(bytes(1024))
+
+    with pytest.raises(multipart.MultipartError):
+        multipart.get('archive/run1.tar', tmp_path / 'staging' / 'run1.tar', manifest, parallel_transfers=3)
+
+
+def test_delete(local_sda: LocalSDA, bundle: Path):
+    multipart.put(bundle, 'archive/run1.tar', part_size=1024, parallel_transfers=3)
+    multipart.delete('archive/run1.tar')
+    assert not local_sda.path(multipart.parts_dir('archive/run1.tar')).exists()
+
+
+def test_delete_without_manifest(local_sda: LocalSDA, bundle: Path):
+    local_sda.fail_put_of = multipart.part_path('archive/run1.tar', 4)
+    with pytest.raises(ConnectionError):
+        multipart.put(bundle, 'archive/run1.tar', part_size=1024, parallel_transfers=1)
+
+    # the parts of the interrupted upload
+    multipart.delete('archive/run1.tar')
+    assert not local_sda.path(multipart.parts_dir('archive/run1.tar')).exists()
+
+
+def test_put_without_checksums(local_sda: LocalSDA, bundle: Path, monkeypatch):
+    def no_hash(sda_path, missing_ok=False):
+        raise AssertionError('no checksum was asked for')
+
+    monkeypatch.setattr(sda, 'get_hash', no_hash)
+    multipart.put(bundle, 'archive/run1.tar', part_size=1024, parallel_transfers=3, verify_checksum=False)
+    assert multipart.read_manifest('archive/run1.tar')['size'] == bundle.stat().st_size
+
+
+def test_upload_replaces_the_other_layout(local_sda: LocalSDA, bundle: Path, monkeypatch):
+    monkeypatch.setattr(digest_ledger, 'get_ledger', lambda: None)
+    (local_sda.root / 'archive').mkdir()
+
+    wf_utils.upload_file_to_sda(bundle, 'archive/run1.tar')
+    assert local_sda.path('archive/run1.tar').exists()
+
+    monkeypatch.setitem(config['sda'], 'part_size', 1024)
+    wf_utils.upload_file_to_sda(bundle, 'archive/run1.tar')
+    assert multipart.read_manifest('archive/run1.tar')['md5'] == hashlib.md5(bundle.read_bytes()).hexdigest()
+    assert not local_sda.path('archive/run1.tar').exists()
+
+    # preflight check: the same bundle is not uploaded again
+    local_sda.puts.clear()
+    wf_utils.upload_file_to_sda(bundle, 'archive/run1.tar')
+    assert local_sda.puts == []
+
+    monkeypatch.setitem(config['sda'], 'part_size', None)
+    wf_utils.upload_file_to_sda(bundle, 'archive/run1.tar')
+    assert local_sda.path('archive/run1.tar').read_bytes() == bundle.read_bytes()
+    assert not local_sda.path(multipart.parts_dir('archive/run1.tar')).exists()
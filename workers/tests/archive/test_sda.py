@@ -0,0 +1,47 @@
+import os
+from pathlib import Path
+
+import pytest
+
+from workers import cmd, sda
+
+
+@pytest.fixture
+def hsi(tmp_path: Path, monkeypatch):
+    """
+    An hsi on PATH that writes size bytes of the file to stdout, then exits with return_code.
+    """
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    monkeypatch.setenv('PATH', f'{bin_dir}{os.pathsep}{os.environ["PATH"]}')
+
+    def make(size: int, return_code: int) -> None:
+        script = bin_dir / 'hsi'
+        script.write_text('#!/bin/sh\n'
+                          f'head -c {size} /dev/zero\n'
+                          'echo "transfer failed" >&2\n'
+                          f'exit {return_code}\n', encoding='utf-8')
+        script.chmod(0o755)
+
+    return make
+
+
+def test_get_stream_reports_a_failure_after_the_end_of_the_file(hsi):
+    hsi(size=1_000_000, return_code=72)
+    with pytest.raises(cmd.SubprocessError) as e:
+        with sda.get_stream('/archive/run1.tar') as f:
+            assert len(f.read()) == 1_000_000
+    assert e.value.args[0]['return_code'] == 72
+    assert 'transfer failed' in e.value.args[0]['stderr']
+
+
+def test_get_stream_read_to_the_end(hsi):
+    hsi(size=1_000_000, return_code=0)
+    with sda.get_stream('/archive/run1.tar') as f:
+        assert len(f.read()) == 1_000_000
+
+
+def test_leaving_get_stream_early_stops_the_transfer(hsi):
+    hsi(size=100_000_000, return_code=0)
+    with sda.get_stream('/archive/run1.tar') as f:
+        assert len(f.read(1024)) == 1024
@@ -0,0 +1,125 @@
+import hashlib
+import io
+import os
+import subprocess
+from pathlib import Path
+
+import pytest
+
+from workers import digest_ledger, seekable_zstd
+from workers.config import config
+from workers.dataset import get_archive_bundle_name, get_bundle_format, get_bundle_name
+from workers.tasks import archive as archive_task
+from workers.tasks.stage import extract_tarfile
+
+
+def test_round_trip(tmp_path: Path):
+    data = os.urandom(100_000) + b'ACGT' * 200_000
+    path = tmp_path / 'data.zst'
+    with open(path, 'wb') as f:
+        with seekable_zstd.SeekableZstdWriter(f, frame_size=64 * 1024, threads=4) as writer:
+            for offset in range(0, len(data), 10_000):
+                writer.write(data[offset:offset + 10_000])
+
+    assert writer.size == path.stat().st_size
+    assert writer.hexdigests() == {'md5': hashlib.md5(path.read_bytes()).hexdigest()}
+
+    frames = seekable_zstd.read_seek_table(path)
+    assert len(frames) == -(-len(data) // (64 * 1024))
+    assert sum(frame.decompressed_size for frame in frames) == len(data)
+    assert b''.join(seekable_zstd.iter_decompressed(path, threads=4)) == data
+
+    # the seek table is a skippable frame - the file is a regular zstd stream
+    decompressed = subprocess.run(['zstd', '-d', '-q', '-c', str(path)], check=True, capture_output=True).stdout
+    assert decompressed == data
+
+
+def test_chunk_stream_reads_across_chunks():
+    stream = seekable_zstd.ChunkStream(iter([b'abc', b'', b'defg', b'h']))
+    assert stream.read(2) == b'ab'
+    assert stream.read(4) == b'cdef'
+    assert stream.read() == b'gh'
+    assert stream.read(1) == b''
+
+
+def test_plain_files_are_not_seekable(tmp_path: Path):
+    path = tmp_path / 'bundle.tar'
+    path.write_bytes(bytes(10240))
+    assert not seekable_zstd.is_seekable(path)
+
+
+def test_bundle_format_is_read_from_the_bundle_name(monkeypatch):
+    monkeypatch.setitem(config['archive'], 'format', 'tar.zst')
+    dataset = {'name': 'run1', 'type': 'RAW_DATA', 'bundle': None}
+    assert get_bundle_format(dataset) == 'tar.zst'
+    assert get_archive_bundle_name(dataset) == 'run1.tar.zst'
+    assert get_bundle_name(dataset) == 'run1.RAW_DATA.tar.zst'
+
+    # bundles archived before the format changed keep their format
+    dataset['bundle'] = {'name': 'run1.tar'}
+    assert get_bundle_format(dataset) == 'tar'
+    assert get_bundle_name(dataset) == 'run1.RAW_DATA.tar'
+
+
+@pytest.fixture
+def dataset(tmp_path: Path, monkeypatch):
+    origin = tmp_path / 'origin' / 'run1'
+    (origin / 'lane1').mkdir(parents=True)
+    (origin / 'lane1' / 'reads.fastq').write_bytes(b'@r1\nACGT\n+\nIIII\n' * 100_000)
+    (origin / 'SampleSheet.csv').write_text('sample,lane\nS1,1\n', encoding='utf-8')
+
+    monkeypatch.setitem(config['paths'], 'RAW_DATA', {
+        **config['paths']['RAW_DATA'],
+        'archive': str(tmp_path / 'archive'),
+        'bundle': {
+            'generate': str(tmp_path / 'bundle' / 'generation'),
+            'stage': str(tmp_path / 'bundle' / 'staging'),
+        },
+    })
+    (tmp_path / 'bundle' / 'generation').mkdir(parents=True)
+    monkeypatch.setattr(digest_ledger, 'get_ledger', lambda: None)
+    monkeypatch.setitem(config['archive'], 'format', 'tar.zst')
+    monkeypatch.setitem(config['archive'], 'zstd', {'level': 3, 'frame_size': 256 * 1024, 'threads': 4})
+
+    return {
+        'id': 1,
+        'name': 'run1',
+        'type': 'RAW_DATA',
+        'origin_path': str(origin),
+        'du_size': 1_600_100,
+    }
+
+
+@pytest.mark.parametrize('mode', ['stream', 'diskless'])
+def test_compressed_bundle_is_staged_like_a_tar_bundle(dataset: dict, mode: str, tmp_path: Path, monkeypatch):
+    monkeypatch.setitem(config['archive'], 'mode', mode)
+
+    archive_path, bundle_attrs = archive_task.archive(celery_task=None, dataset=dataset)
+
+    archived = Path(archive_path)
+    assert archived.name == bundle_attrs['name'] == 'run1.tar.zst'
+    assert bundle_attrs['size'] == archived.stat().st_size < dataset['du_size']
+    assert bundle_attrs['md5'] == hashlib.md5(archived.read_bytes()).hexdigest()
+    assert len(seekable_zstd.read_seek_table(archived)) > 1
+
+    staged = tmp_path / 'staged' / 'run1'
+    extract_tarfile(tar_path=archived, target_dir=staged, override_arcname=True)
+    origin = Path(dataset['origin_path'])
+    assert (staged / 'lane1' / 'reads.fastq').read_bytes() == (origin / 'lane1' / 'reads.fastq').read_bytes()
+    assert (staged / 'SampleSheet.csv').read_bytes() == (origin / 'SampleSheet.csv').read_bytes()
+
+
+def test_compressed_bundle_needs_a_streaming_mode(dataset: dict, monkeypatch):
+    monkeypatch.setitem(config['archive'], 'mode', 'tar')
+    with pytest.raises(ValueError):
+        archive_task.archive(celery_task=None, dataset=dataset)
+
+
+def test_writer_output_is_discarded_on_error():
+    sink = io.BytesIO()
+    with pytest.raises(RuntimeError):
+        with seekable_zstd.SeekableZstdWriter(sink, frame_size=1024, threads=2) as writer:
+            writer.write(os.urandom(10_000))
+            raise RuntimeError('tar failed')
+    # no seek table is written
+    assert sink.getvalue()[-4:] != seekable_zstd.SEEKABLE_MAGIC.to_bytes(4, 'little')
@@ -0,0 +1,118 @@
+import os
+import time
+from pathlib import Path
+
+import pytest
+
+import workers.workflow_utils as wf_utils
+from workers import api, staging_cache
+from workers.config import config
+from workers.scripts import purge_staged_datasets
+from workers.tasks import stage as stage_task
+
+
+def _cached(name: str, size: int, last_access: float) -> dict:
+    return {'name': name, 'size': size, 'last_access': last_access}
+
+
+def test_select_evictions():
+    now = time.time()
+    datasets = [_cached('a', 40, now - 500), _cached('b', 30, now - 900), _cached('c', 25, now - 100)]
+    select = staging_cache.select_evictions
+
+    # below the high watermark
+    assert select(datasets, budget=110, high_watermark=0.9, low_watermark=0.5, min_idle_seconds=0, now=now) == []
+    # least recently used first, down to the low watermark
+    evicted = select(datasets, budget=100, high_watermark=0.9, low_watermark=0.5, min_idle_seconds=0, now=now)
+    assert [d['name'] for d in evicted] == ['b', 'a']
+    # recently accessed datasets are kept
+    evicted = select(datasets, budget=100, high_watermark=0.9, low_watermark=0.1, min_idle_seconds=200, now=now)
+    assert [d['name'] for d in evicted] == ['b', 'a']
+
+
+@pytest.fixture
+def dataset(make_dataset) -> dict:
+    return make_dataset({'reads.fastq': os.urandom(100_000)}, archived=True)
+
+
+def test_staged_dataset_is_served_from_the_cache(dataset: dict, monkeypatch):
+    staged_path, _ = stage_task.stage(celery_task=None, dataset=dataset)
+    entry = staging_cache.read_entry(Path(staged_path))
+    assert entry['bundle_md5'] == dataset['bundle']['md5']
+
+    def no_staging(*args, **kwargs):
+        raise AssertionError('staged again')
+
+    monkeypatch.setattr(wf_utils, 'stage', no_staging)
+    assert stage_task.stage(celery_task=None, dataset=dataset)[0] == staged_path
+    assert staging_cache.read_entry(Path(staged_path))['last_access'] >= entry['last_access']
+
+    # a dataset that was archived again is not
+    with pytest.raises(AssertionError):
+        stage_task.stage(celery_task=None, dataset={**dataset, 'bundle': {**dataset['bundle'], 'md5': '0' * 32}})
+    assert staging_cache.read_entry(Path(staged_path)) is None
+
+
+def test_purge_evicts_the_least_recently_used(dataset: dict, tmp_path: Path, monkeypatch):
+    staged = []
+    for dataset_id in [1, 2, 3]:
+        d = {**dataset, 'id': dataset_id, 'name': f'run{dataset_id}'}
+        staged_path, alias = stage_task.stage(celery_task=None, dataset=d)
+        staged.append({**d, 'staged_path': staged_path, 'metadata': {'stage_alias': alias}})
+    bundle_size = Path(stage_task.get_bundle_staged_path(dataset)).stat().st_size
+    size = dataset['du_size'] + bundle_size
+    now = time.time()
+    for d, last_access in zip(staged, [now - 300, now - 7200, now - 3600]):
+        staging_cache.record(d, Path(d['staged_path']), last_access=last_access)
+    # the download symlink of dataset 1 was followed just now
+    (tmp_path / 'download').mkdir()
+    os.symlink(staged[0]['staged_path'], tmp_path / 'download' / staged[0]['metadata']['stage_alias'])
+
+    monkeypatch.setitem(config['stage'], 'cache', {
+        'budget': {'RAW_DATA': 3 * size},
+        'high_watermark': 0.9,
+        'low_watermark': 0.5,
+        'min_idle_seconds': 60,
+    })
+    purged = []
+    monkeypatch.setattr(api, 'get_all_datasets', lambda **kwargs: staged)
+    monkeypatch.setattr(api, 'update_dataset', lambda dataset_id, update_data: None)
+    monkeypatch.setattr(api, 'add_state_to_dataset', lambda dataset_id, state: purged.append(dataset_id))
+
+    purge_staged_datasets.main()
+
+    assert purged == [2, 3]
+    assert [Path(d['staged_path']).exists() for d in staged] == [True, False, False]
+
+
+def test_purge_is_capped_per_run(monkeypatch):
+    evictions = [{'id': dataset_id, 'name': f'run{dataset_id}', 'staged_path': f'/staged/run{dataset_id}', 'size': 1}
+                 for dataset_id in range(5)]
+    purged = []
+    monkeypatch.setattr(api, 'get_all_datasets', lambda **kwargs: evictions)
+    monkeypatch.setattr(staging_cache, 'evictions', lambda datasets: datasets)
+    monkeypatch.setattr(purge_staged_datasets, 'purge', lambda dataset: purged.append(dataset['id']))
+    monkeypatch.setattr(purge_staged_datasets, 'MAX_PURGES', 2)
+
+    purge_staged_datasets.main()
+
+    assert purged == [0, 1]
+
+
+def test_cached_stage_request_does_not_load_the_files(dataset: dict, monkeypatch):
+    requests = []
+
+    def get_dataset(dataset_id, files=False, **kwargs):
+        requests.append(files)
+        return {**dataset, 'files': []} if files else dataset
+
+    monkeypatch.setattr(api, 'get_dataset', get_dataset)
+    monkeypatch.setattr(api, 'update_dataset', lambda dataset_id, update_data: None)
+    monkeypatch.setattr(api, 'add_state_to_dataset', lambda dataset_id, state: None)
+
+    stage_task.stage_dataset(None, dataset['id'])
+    assert requests == [False, True]
+
+    requests.clear()
+    stage_task.stage_dataset(None, dataset['id'])
+    assert requests == [False]
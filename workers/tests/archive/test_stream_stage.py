@@ -0,0 +1,87 @@
+import io
+import os
+from contextlib import contextmanager
+from pathlib import Path
+
+import pytest
+
+import workers.workflow_utils as wf_utils
+from workers.config import config
+from workers.dataset import get_bundle_staged_path
+from workers.tasks import archive as archive_task
+from workers.tasks import stage as stage_task
+
+
+class _ForwardOnly(io.RawIOBase):
+    """
+    Like the stdout of `hsi get`: no seek, no tell.
+    """
+
+    def __init__(self, f):
+        self.f = f
+
+    def readinto(self, b):
+        return self.f.readinto(b)
+
+    def readable(self):
+        return True
+
+
+@pytest.fixture
+def dataset(make_dataset, monkeypatch) -> dict:
+    monkeypatch.setitem(config['archive'], 'mode', 'stream')
+    monkeypatch.setitem(config['archive'], 'zstd', {'level': 3, 'frame_size': 128 * 1024, 'threads': 4})
+    monkeypatch.setitem(config['stage'], 'mode', 'stream')
+    # stage from the archive, not from the generated bundle
+    monkeypatch.setitem(config['stage'], 'local_bundles', False)
+
+    open_archive_reader = wf_utils.open_archive_reader
+
+    @contextmanager
+    def forward_only_reader(archive_path):
+        with open_archive_reader(archive_path) as f:
+            yield io.BufferedReader(_ForwardOnly(f))
+
+    monkeypatch.setattr(wf_utils, 'open_archive_reader', forward_only_reader)
+
+    return make_dataset({
+        'lane1/reads.fastq': b'@r1\nACGT\n+\nIIII\n' * 50_000,
+        'lane1/reads.bam': os.urandom(300_000),
+        'SampleSheet.csv': 'sample,lane\nS1,1\n',
+    })
+
+
+def _archive(dataset: dict) -> dict:
+    archive_path, bundle_attrs = archive_task.archive(celery_task=None, dataset=dataset)
+    return {**dataset, 'archive_path': archive_path, 'bundle': bundle_attrs}
+
+
+@pytest.mark.parametrize('bundle_format', ['tar', 'tar.zst'])
+def test_stream_stage(dataset: dict, bundle_format: str, monkeypatch):
+    monkeypatch.setitem(config['archive'], 'format', bundle_format)
+    archived = _archive(dataset)
+
+    staged_path, _ = stage_task.stage(celery_task=None, dataset=archived)
+
+    origin = Path(dataset['origin_path'])
+    for relpath in ['lane1/reads.fastq', 'lane1/reads.bam', 'SampleSheet.csv']:
+        assert (Path(staged_path) / relpath).read_bytes() == (origin / relpath).read_bytes()
+    # no local copy of the bundle was made
+    assert not Path(get_bundle_staged_path(archived)).exists()
+    assert not any(p.name.startswith('tmp') for p in Path(staged_path).parent.iterdir())
+
+
+@pytest.mark.parametrize('bundle_format', ['tar', 'tar.zst'])
+def test_checksum_mismatch_keeps_the_staged_dataset(dataset: dict, bundle_format: str, monkeypatch):
+    monkeypatch.setitem(config['archive'], 'format', bundle_format)
+    archived = _archive(dataset)
+    staged_path, _ = stage_task.stage(celery_task=None, dataset=archived)
+    (Path(staged_path) / 'marker').touch()
+
+    archived['bundle']['md5'] = '0' * 32
+    with pytest.raises(stage_task.exc.ValidationFailed):
+        stage_task.stage(celery_task=None, dataset=archived)
+
+    # the previously staged dataset was not replaced and the partial extraction is gone
+    assert (Path(staged_path) / 'marker').exists()
+    assert sorted(p.name for p in Path(staged_path).parent.iterdir()) == [Path(staged_path).name]
@@ -0,0 +1,106 @@
+import hashlib
+import io
+import os
+import stat
+import subprocess
+import tarfile
+from pathlib import Path
+
+import pytest
+
+from workers import tarextract
+
+
+@pytest.fixture
+def bundle(tmp_path: Path) -> Path:
+    source = tmp_path / 'source' / 'run1'
+    for lane in range(3):
+        for tile in range(40):
+            path = source / 'Data' / f'L00{lane}' / f'C1.{tile}' / f's_{lane}_{tile}.bcl'
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(os.urandom(100 + tile))
+    (source / 'reads.bam').write_bytes(os.urandom(300_000))
+    (source / 'empty').touch()
+    os.symlink('reads.bam', source / 'reads.link')
+    os.link(source / 'reads.bam', source / 'Data' / 'reads.bam')
+    (source / 'readonly').mkdir()
+    (source / 'readonly' / 'RunInfo.xml').write_text('<RunInfo/>', encoding='utf-8')
+    os.chmod(source / 'readonly' / 'RunInfo.xml', 0o444)
+    os.utime(source / 'reads.bam', ns=(1_000_000_000, 1_500_000_000_000_000_000))
+    os.utime(source / 'Data' / 'L001', ns=(1_000_000_000, 1_600_000_000_000_000_000))
+    os.chmod(source / 'readonly', 0o555)
+
+    path = tmp_path / 'run1.tar'
+    with tarfile.open(path, 'w', format=tarfile.GNU_FORMAT) as tar:
+        tar.add(source, arcname='./run1')
+    return path
+
+
+def _tree(root: Path) -> dict:
+    tree = {}
+    for p in sorted(root.rglob('*')):
+        st = p.lstat()
+        entry = {'mode': stat.S_IMODE(st.st_mode), 'type': stat.S_IFMT(st.st_mode)}
+        if p.is_symlink():
+            entry['link'] = os.readlink(p)
+        else:
+            entry['mtime'] = int(st.st_mtime)
+            if p.is_file():
+                entry['data'] = p.read_bytes()
+        tree[str(p.relative_to(root))] = entry
+    return tree
+
+
+@pytest.mark.parametrize('num_workers', [1, 4])
+@pytest.mark.parametrize('mode', ['r', 'r|'])
+def test_extracts_like_extractall(bundle: Path, tmp_path: Path, num_workers: int, mode: str):
+    with tarfile.open(bundle) as tar:
+        tar.extractall(tmp_path / 'expected')
+
+    with tarfile.open(bundle, mode) as tar:
+        digests = tarextract.extract(tar, tmp_path / 'extracted', num_workers=num_workers,
+                                     max_buffered_size=64 * 1024)
+
+    assert _tree(tmp_path / 'extracted') == _tree(tmp_path / 'expected')
+    assert os.stat(tmp_path / 'extracted' / 'run1' / 'Data' / 'reads.bam').st_nlink == 2
+
+    files = [p for p in (tmp_path / 'expected').rglob('*') if p.is_file() and not p.is_symlink()]
+    assert digests == {f'./{p.relative_to(tmp_path / "expected")}': hashlib.md5(p.read_bytes()).hexdigest()
+                       for p in files}
+
+
+def test_rejects_members_outside_of_the_destination(tmp_path: Path):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w') as tar:
+        info = tarfile.TarInfo('../escaped')
+        info.size = 4
+        tar.addfile(info, io.BytesIO(b'data'))
+    buf.seek(0)
+
+    with tarfile.open(fileobj=buf) as tar, pytest.raises(tarextract.TarExtractError):
+        tarextract.extract(tar, tmp_path / 'extracted')
+    assert not (tmp_path / 'escaped').exists()
+
+
+@pytest.mark.parametrize('mode', ['r', 'r|'])
+def test_sparse_members_stay_sparse(tmp_path: Path, mode: str):
+    source = tmp_path / 'source'
+    source.mkdir()
+    sparse = source / 'disk.img'
+    with open(sparse, 'wb') as f:
+        f.write(os.urandom(4096))
+        f.seek(8 * 1024 * 1024)
+        f.write(os.urandom(4096))
+        f.truncate(16 * 1024 * 1024)
+    if sparse.stat().st_blocks * 512 >= sparse.stat().st_size:
+        pytest.skip('the file system does not support sparse files')
+    bundle = tmp_path / 'run1.tar'
+    subprocess.run(['tar', 'cf', str(bundle), '--sparse', '-C', str(source), '.'], check=True)
+
+    with tarfile.open(bundle, mode) as archive:
+        digests = tarextract.extract(archive, tmp_path / 'extracted')
+
+    extracted = tmp_path / 'extracted' / 'disk.img'
+    assert extracted.read_bytes() == sparse.read_bytes()
+    assert digests['./disk.img'] == hashlib.md5(sparse.read_bytes()).hexdigest()
+    assert extracted.stat().st_blocks * 512 < 1024 * 1024
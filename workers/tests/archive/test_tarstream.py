@@ -0,0 +1,123 @@
+import hashlib
+import io
+import os
+import subprocess
+import tarfile
+from pathlib import Path
+
+import pytest
+
+from workers import digest_ledger, fswalk
+from workers.tarstream import TarStreamError, TarWriter
+from workers.tasks.inspect import generate_metadata
+from workers.tasks.inspect_and_archive import write_bundle
+
+
+@pytest.fixture(autouse=True)
+def no_digest_ledger(monkeypatch):
+    monkeypatch.setattr(digest_ledger, 'get_ledger', lambda: None)
+
+
+@pytest.fixture
+def source(tmp_path: Path) -> Path:
+    root = tmp_path / 'run1'
+    (root / 'lane1' / 'nested').mkdir(parents=True)
+    (root / 'lane1' / 'reads.fastq.gz').write_bytes(os.urandom(300_001))
+    (root / 'lane1' / 'nested' / 'empty.txt').write_bytes(b'')
+    (root / 'SampleSheet.csv').write_text('sample,lane\nS1,1\n', encoding='utf-8')
+    os.link(root / 'SampleSheet.csv', root / 'SampleSheet.copy.csv')
+    (root / 'link_to_reads').symlink_to('lane1/reads.fastq.gz')
+    (root / 'link_to_lane1').symlink_to('lane1')
+
+    # 3 MB file with data only at the start and 2 MB in
+    with open(root / 'sparse.bin', 'wb') as f:
+        f.write(b'head')
+        f.seek(2 * 1024 * 1024)
+        f.write(b'middle')
+        f.truncate(3 * 1024 * 1024)
+    return root
+
+
+def _write(source: Path, **kwargs) -> tuple[bytes, dict, TarWriter]:
+    sink = io.BytesIO()
+    digests = {}
+    with TarWriter(sink, **kwargs) as writer:
+        writer.add_root(source)
+        for entry in fswalk.walk(source):
+            digests[entry.relpath] = writer.add(entry)
+    return sink.getvalue(), digests, writer
+
+
+def test_tar_stream_matches_gnu_tar(source: Path):
+    data, _, writer = _write(source, block_size=64 * 1024)
+
+    assert writer.size == len(data)
+    assert len(data) % tarfile.RECORDSIZE == 0
+    assert writer.hexdigests() == {'md5': hashlib.md5(data).hexdigest()}
+
+    gnu_tar = subprocess.run(['tar', 'cf', '-', '-C', str(source), '.'], check=True, capture_output=True).stdout
+    with tarfile.open(fileobj=io.BytesIO(gnu_tar)) as expected, tarfile.open(fileobj=io.BytesIO(data)) as actual:
+        expected_members = {m.name: m for m in expected.getmembers()}
+        actual_members = {m.name: m for m in actual.getmembers()}
+        assert actual_members.keys() == expected_members.keys()
+        for name, member in actual_members.items():
+            assert member.type == expected_members[name].type, name
+            assert member.mode == expected_members[name].mode, name
+            assert member.size == expected_members[name].size, name
+            assert member.linkname == expected_members[name].linkname, name
+            if member.isreg():
+                assert actual.extractfile(member).read() == expected.extractfile(name).read(), name
+
+
+def test_sparse_file_is_stored_densely(source: Path):
+    data, digests, _ = _write(source)
+
+    with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+        member = tar.getmember('./sparse.bin')
+        assert member.type == tarfile.REGTYPE
+        assert not member.issparse()
+        contents = tar.extractfile(member).read()
+    assert contents == (source / 'sparse.bin').read_bytes()
+    assert digests['sparse.bin'] == {'md5': hashlib.md5(contents).hexdigest()}
+
+
+def test_file_digests_are_computed_from_the_tar_read(source: Path):
+    _, digests, _ = _write(source, file_algorithms=['md5', 'sha256'])
+
+    for relpath in ['lane1/reads.fastq.gz', 'lane1/nested/empty.txt', 'SampleSheet.csv', 'SampleSheet.copy.csv']:
+        contents = (source / relpath).read_bytes()
+        assert digests[relpath] == {
+            'md5': hashlib.md5(contents).hexdigest(),
+            'sha256': hashlib.sha256(contents).hexdigest(),
+        }
+    assert digests['link_to_reads'] is None
+    assert digests['lane1'] is None
+
+
+def test_file_changed_while_read(source: Path):
+    entry = next(e for e in fswalk.walk(source) if e.relpath == 'SampleSheet.csv')
+    (source / 'SampleSheet.csv').write_text('changed since the walk\n', encoding='utf-8')
+
+    with pytest.raises(TarStreamError):
+        TarWriter(io.BytesIO()).add(entry)
+
+
+def test_write_bundle_matches_inspection(source: Path):
+    records = []
+    sink = io.BytesIO()
+    inspection, bundle_size, bundle_md5 = write_bundle(celery_task=None, sink=sink, source=source,
+                                                       on_file=records.append)
+
+    num_files, num_directories, size, du_size, num_genome_files, metadata = generate_metadata(
+        celery_task=None, source=source, num_workers=1)
+
+    assert inspection == {
+        'du_size': du_size,
+        'size': size,
+        'num_files': num_files,
+        'num_directories': num_directories,
+        'metadata': {'num_genome_files': num_genome_files},
+    }
+    assert sorted(records, key=lambda r: r['path']) == sorted(metadata, key=lambda r: r['path'])
+    assert bundle_size == len(sink.getvalue())
+    assert bundle_md5 == hashlib.md5(sink.getvalue()).hexdigest()
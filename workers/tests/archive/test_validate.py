@@ -0,0 +1,129 @@
+import hashlib
+import os
+import random
+from pathlib import Path
+
+import pytest
+
+from workers import digest_ledger, hashing
+from workers.config import config
+from workers.tasks import validate as validate_task
+
+
+@pytest.fixture
+def staged(tmp_path: Path, monkeypatch) -> tuple[Path, list[dict]]:
+    monkeypatch.setattr(digest_ledger, 'get_ledger', lambda: None)
+    files = []
+    for i in range(200):
+        path = tmp_path / 'run1' / f'tile{i // 50}' / f's_{i}.bcl'
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(os.urandom(100 + i))
+        files.append({'path': str(path.relative_to(tmp_path / 'run1')), 'size': 100 + i,
+                      'md5': hashlib.md5(path.read_bytes()).hexdigest()})
+    return tmp_path / 'run1', files
+
+
+def _corrupt(path: Path) -> None:
+    data = bytearray(path.read_bytes())
+    data[0] ^= 0xff
+    path.write_bytes(bytes(data))
+
+
+def _hashed_files(monkeypatch) -> list:
+    hashed = []
+    hash_file = hashing.hash_file
+
+    def count(path, *args, **kwargs):
+        hashed.append(path)
+        return hash_file(path, *args, **kwargs)
+
+    monkeypatch.setattr(hashing, 'hash_file', count)
+    return hashed
+
+
+def test_sample_size():
+    assert validate_task.sample_size(1_000_000, confidence=0.99, defect_rate=0.001) == 4603
+    assert validate_task.sample_size(100, confidence=0.99, defect_rate=0.001) == 100
+    assert validate_task.sample_size(0, confidence=0.99, defect_rate=0.001) == 0
+
+
+def test_size_tier(staged, monkeypatch):
+    dataset_dir, files = staged
+    hashed = _hashed_files(monkeypatch)
+    _corrupt(dataset_dir / files[3]['path'])
+    (dataset_dir / files[4]['path']).write_bytes(b'truncated')
+    (dataset_dir / files[5]['path']).unlink()
+
+    errors, report = validate_task.check_files(None, dataset_dir, files, tier='size')
+
+    # a corrupt file of the right size is not found without hashing it
+    assert errors == [(str(dataset_dir / files[4]['path']), 'size mismatch'),
+                      (str(dataset_dir / files[5]['path']), 'file does not exist')]
+    assert report == {'tier': 'size', 'files': 200, 'hashed_files': 0}
+    assert hashed == []
+
+
+def test_sample_tier(staged, monkeypatch):
+    dataset_dir, files = staged
+    monkeypatch.setitem(config['validate'], 'sample', {'confidence': 0.9, 'defect_rate': 0.05})
+    hashed = _hashed_files(monkeypatch)
+    for f in files[:40]:
+        _corrupt(dataset_dir / f['path'])
+
+    errors, report = validate_task.check_files(None, dataset_dir, files, tier='sample', rng=random.Random(1))
+
+    assert report == {'tier': 'sample', 'files': 200, 'hashed_files': 45}
+    assert len(hashed) == 45
+    assert errors
+    assert all(reason == 'checksum mismatch' for _, reason in errors)
+
+
+def test_full_tier(staged):
+    dataset_dir, files = staged
+    _corrupt(dataset_dir / files[150]['path'])
+
+    errors, report = validate_task.check_files(None, dataset_dir, files, tier='full')
+
+    assert errors == [(str(dataset_dir / files[150]['path']), 'checksum mismatch')]
+    assert report == {'tier': 'full', 'files': 200, 'hashed_files': 200}
+
+
+def test_full_tier_reads_the_files(staged, tmp_path: Path, monkeypatch):
+    dataset_dir, files = staged
+    ledger = digest_ledger.DigestLedger(tmp_path / 'digests.sqlite3')
+    monkeypatch.setattr(digest_ledger, 'get_ledger', lambda: ledger)
+    # the file rotted after stage recorded its digest, without a change to its attributes
+    corrupt = dataset_dir / files[150]['path']
+    _corrupt(corrupt)
+    digest_ledger.record_digests(corrupt, {'md5': files[150]['md5']})
+
+    assert validate_task.check_files(None, dataset_dir, files, tier='sample', rng=random.Random(1))[0] == []
+    errors, _ = validate_task.check_files(None, dataset_dir, files, tier='full')
+    assert errors == [(str(corrupt), 'checksum mismatch')]
+
+
+def test_missing_size_is_an_error(staged):
+    dataset_dir, files = staged
+    del files[7]['size']
+
+    errors, _ = validate_task.check_files(None, dataset_dir, files, tier='size')
+
+    assert errors == [(str(dataset_dir / files[7]['path']), 'size is not recorded')]
+
+
+def test_validation_tier_is_recorded(staged, monkeypatch):
+    dataset_dir, files = staged
+    states = []
+    monkeypatch.setattr(validate_task.api, 'get_dataset',
+                        lambda dataset_id, **kwargs: {'staged_path': str(dataset_dir), 'files': files})
+    monkeypatch.setattr(validate_task.api, 'update_dataset', lambda dataset_id, update_data: None)
+    monkeypatch.setattr(validate_task.api, 'add_state_to_dataset',
+                        lambda dataset_id, state, metadata=None: states.append((state, metadata)))
+
+    validate_task.validate_dataset(None, 1, tier='size')
+    assert states == [('STAGED', {'validation': {'tier': 'size', 'files': 200, 'hashed_files': 0}})]
+
+    # the default tier
+    states.clear()
+    validate_task.validate_dataset(None, 1)
+    assert states[0][1]['validation']['tier'] == config['validate']['tier']
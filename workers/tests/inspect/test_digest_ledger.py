@@ -0,0 +1,88 @@
+import hashlib
+import os
+from pathlib import Path
+
+import pytest
+
+from workers import digest_ledger, hashing
+from workers.digest_ledger import DigestLedger
+
+
+@pytest.fixture
+def ledger(tmp_path: Path):
+    ledger = DigestLedger(tmp_path / 'ledger' / 'digests.sqlite3')
+    yield ledger
+    ledger.close()
+
+
+def test_file_digest_is_read_once(tmp_path: Path, ledger: DigestLedger, monkeypatch):
+    data_file = tmp_path / 'sample.txt'
+    data_file.write_bytes(b'hello world')
+
+    calls = []
+    hash_file = hashing.hash_file
+
+    def _counting_hash_file(path, algorithms):
+        calls.extend(algorithms)
+        return hash_file(path, algorithms)
+
+    monkeypatch.setattr(hashing, 'hash_file', _counting_hash_file)
+
+    expected = hashlib.md5(b'hello world').hexdigest()
+    assert digest_ledger.file_digest(data_file, ledger=ledger) == expected
+    assert digest_ledger.file_digest(data_file, ledger=ledger) == expected
+    assert calls == ['md5']
+
+    # a different algorithm for the same file is computed once and stored alongside
+    expected_sha = hashlib.sha256(b'hello world').hexdigest()
+    assert digest_ledger.file_digest(data_file, algorithm='sha256', ledger=ledger) == expected_sha
+    assert digest_ledger.file_digest(data_file, algorithm='sha256', ledger=ledger) == expected_sha
+    assert calls == ['md5', 'sha256']
+
+
+def test_file_digests_reads_only_missing_algorithms_once(tmp_path: Path, ledger: DigestLedger, monkeypatch):
+    data_file = tmp_path / 'sample.txt'
+    data_file.write_bytes(b'hello world')
+    assert digest_ledger.file_digest(data_file, ledger=ledger) == hashlib.md5(b'hello world').hexdigest()
+
+    reads = []
+    hash_file = hashing.hash_file
+
+    def _counting_hash_file(path, algorithms):
+        reads.append(list(algorithms))
+        return hash_file(path, algorithms)
+
+    monkeypatch.setattr(hashing, 'hash_file', _counting_hash_file)
+
+    digests = digest_ledger.file_digests(data_file, ['md5', 'sha1', 'sha256'], ledger=ledger)
+    assert digests == {
+        'md5': hashlib.md5(b'hello world').hexdigest(),
+        'sha1': hashlib.sha1(b'hello world').hexdigest(),
+        'sha256': hashlib.sha256(b'hello world').hexdigest(),
+    }
+    assert reads == [['sha1', 'sha256']]
+
+
+def test_modified_file_is_rehashed(tmp_path: Path, ledger: DigestLedger):
+    data_file = tmp_path / 'sample.txt'
+    data_file.write_bytes(b'version 1')
+    assert digest_ledger.file_digest(data_file, ledger=ledger) == hashlib.md5(b'version 1').hexdigest()
+
+    data_file.write_bytes(b'version 2')
+    st = data_file.stat()
+    # make sure the new version differs in mtime even on coarse timestamp file systems
+    os.utime(data_file, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+
+    assert digest_ledger.file_digest(data_file, ledger=ledger) == hashlib.md5(b'version 2').hexdigest()
+
+    # only the latest version of the inode is kept
+    key = digest_ledger.make_key(data_file.stat())
+    rows = ledger._conn.execute('SELECT COUNT(*) FROM file_digest WHERE dev=? AND ino=?', key[:2]).fetchone()
+    assert rows == (1,)
+
+
+def test_file_digest_without_ledger(tmp_path: Path, monkeypatch):
+    data_file = tmp_path / 'sample.txt'
+    data_file.write_bytes(b'abc')
+    monkeypatch.setattr(digest_ledger, 'get_ledger', lambda: None)
+    assert digest_ledger.file_digest(data_file) == hashlib.md5(b'abc').hexdigest()
@@ -0,0 +1,86 @@
+import threading
+
+import pytest
+
+from workers.tasks import inspect
+
+
+def _record(i):
+    return {'path': f'f{i}', 'md5': f'md5-{i}', 'size': i, 'type': 'file'}
+
+
+def test_poster_posts_all_records_in_batches(monkeypatch):
+    posted = []
+    monkeypatch.setattr(inspect.api, 'add_files_to_dataset',
+                        lambda dataset_id, files: posted.append((dataset_id, list(files))))
+
+    with inspect.FileMetadataPoster(dataset_id=7, batch_size=3) as poster:
+        for i in range(8):
+            poster.add(_record(i))
+
+    assert [len(files) for _, files in posted] == [3, 3, 2]
+    assert all(dataset_id == 7 for dataset_id, _ in posted)
+    assert [f['path'] for _, files in posted for f in files] == [f'f{i}' for i in range(8)]
+
+
+def test_poster_skips_records_stored_by_a_previous_attempt(monkeypatch):
+    posted = []
+    monkeypatch.setattr(inspect.api, 'add_files_to_dataset', lambda dataset_id, files: posted.extend(files))
+
+    stored_files = {'f0': 'md5-0', 'f1': 'changed'}
+    with inspect.FileMetadataPoster(dataset_id=7, batch_size=10, stored_files=stored_files) as poster:
+        for i in range(3):
+            poster.add(_record(i))
+
+    assert [f['path'] for f in posted] == ['f1', 'f2']
+    assert poster.num_skipped == 1
+
+
+def test_poster_is_bounded(monkeypatch):
+    release = threading.Event()
+    monkeypatch.setattr(inspect.api, 'add_files_to_dataset', lambda dataset_id, files: release.wait())
+
+    poster = inspect.FileMetadataPoster(dataset_id=7, batch_size=1, max_pending_batches=1)
+    with poster:
+        poster.add(_record(0))  # taken by the background thread, which blocks
+        poster.add(_record(1))  # fills the queue
+        blocked = threading.Thread(target=poster.add, args=(_record(2),))
+        blocked.start()
+        blocked.join(timeout=0.2)
+        assert blocked.is_alive()
+        release.set()
+        blocked.join()
+
+
+def test_poster_raises_api_errors(monkeypatch):
+    def _fail(dataset_id, files):
+        raise RuntimeError('API unavailable')
+
+    monkeypatch.setattr(inspect.api, 'add_files_to_dataset', _fail)
+
+    with pytest.raises(RuntimeError, match='API unavailable'):
+        with inspect.FileMetadataPoster(dataset_id=7, batch_size=1) as poster:
+            poster.add(_record(0))
+
+
+def test_stored_files_are_fetched_in_pages(monkeypatch):
+    stored = [_record(i) for i in range(5)]
+    requests = []
+
+    def get_dataset_files(dataset_id, skip, take, filetype):
+        requests.append((skip, take))
+        return stored[skip:skip + take]
+
+    monkeypatch.setattr(inspect.api, 'get_dataset_files', get_dataset_files)
+
+    assert inspect.get_stored_files(dataset_id=7, page_size=2) == {f'f{i}': f'md5-{i}' for i in range(5)}
+    assert requests == [(0, 2), (2, 2), (4, 2)]
+
+
+def test_first_inspection_fetches_one_empty_page(monkeypatch):
+    requests = []
+    monkeypatch.setattr(inspect.api, 'get_dataset_files',
+                        lambda dataset_id, skip, take, filetype: requests.append(skip) or [])
+
+    assert inspect.get_stored_files(dataset_id=7, page_size=2) == {}
+    assert requests == [0]
@@ -0,0 +1,47 @@
+import os
+from pathlib import Path
+
+from workers import fswalk
+from workers.utils import FileType
+
+
+def _make_tree(root: Path) -> None:
+    (root / 'a' / 'b').mkdir(parents=True)
+    (root / 'a' / 'b' / 'f1.txt').write_bytes(b'12345')
+    (root / 'f2.txt').write_bytes(b'')
+    (root / 'dir_link').symlink_to(root / 'a', target_is_directory=True)
+    (root / 'file_link').symlink_to(root / 'f2.txt')
+    (root / 'dangling').symlink_to(root / 'does-not-exist')
+
+
+def test_walk_matches_rglob(tmp_path: Path):
+    _make_tree(tmp_path)
+
+    entries = {e.relpath: e for e in fswalk.walk(tmp_path)}
+
+    expected = {str(p.relative_to(tmp_path)) for p in tmp_path.rglob('*')}
+    assert set(entries) == expected
+    assert fswalk.count_entries(tmp_path) == len(expected)
+
+    assert entries['a/b/f1.txt'].type == FileType.FILE
+    assert entries['a/b/f1.txt'].stat.st_size == 5
+    assert entries['a/b/f1.txt'].path == os.path.join(str(tmp_path), 'a', 'b', 'f1.txt')
+    assert entries['a'].type == FileType.DIRECTORY
+    assert entries['dir_link'].type == FileType.SYMBOLIC_LINK
+    assert entries['dir_link'].target_type == FileType.DIRECTORY
+    assert entries['file_link'].target_type == FileType.FILE
+    assert entries['file_link'].readable
+    assert entries['dangling'].target_type == FileType.OTHER
+    assert not entries['dangling'].readable
+
+
+def test_walk_does_not_descend_into_symlinked_directories(tmp_path: Path):
+    _make_tree(tmp_path)
+    assert not any(e.relpath.startswith('dir_link/') for e in fswalk.walk(tmp_path))
+
+
+def test_walk_reports_listing_errors(tmp_path: Path):
+    errors = []
+    entries = list(fswalk.walk(tmp_path / 'missing', onerror=lambda path, e: errors.append(path)))
+    assert entries == []
+    assert errors == [str(tmp_path / 'missing')]
@@ -0,0 +1,69 @@
+import hashlib
+from pathlib import Path
+
+import pytest
+
+import workers.cmd as cmd
+from workers import digest_ledger
+from workers import exceptions as exc
+from workers import utils
+from workers.tasks.inspect import generate_metadata
+
+
+@pytest.fixture(autouse=True)
+def _no_digest_ledger(monkeypatch):
+    monkeypatch.setattr(digest_ledger, 'get_ledger', lambda: None)
+
+
+def _make_dataset(root: Path) -> Path:
+    source = root / 'dataset'
+    (source / 'run' / 'lane1').mkdir(parents=True)
+    (source / 'run' / 'lane1' / 's1.bcl').write_bytes(b'A' * 10_000)
+    (source / 'run' / 'lane1' / 's2.fastq.gz').write_bytes(b'B' * 5)
+    (source / 'notes.txt').write_text('hello world', encoding='utf-8')
+    (source / 'empty.txt').write_bytes(b'')
+    (source / 'link.txt').symlink_to(source / 'notes.txt')
+    (source / 'run' / 'hardlink.txt').hardlink_to(source / 'notes.txt')
+    return source
+
+
+def test_parallel_map_preserves_order():
+    results = list(utils.parallel_map(lambda x: x * x, range(100), num_workers=4, max_pending=3))
+    assert results == [x * x for x in range(100)]
+
+
+def test_parallel_map_propagates_exceptions():
+    def fn(x):
+        if x == 5:
+            raise ValueError('boom')
+        return x
+
+    with pytest.raises(ValueError, match='boom'):
+        list(utils.parallel_map(fn, range(10), num_workers=4))
+
+
+@pytest.mark.parametrize('num_workers', [1, 4])
+def test_generate_metadata_matches_serial_walk(tmp_path: Path, num_workers: int):
+    source = _make_dataset(tmp_path)
+
+    num_files, num_directories, size, du_size, num_genome_files, metadata = generate_metadata(
+        celery_task=None, source=source, num_workers=num_workers)
+
+    assert num_files == 6
+    assert num_directories == 2
+    assert num_genome_files == 2
+    assert size == 10_000 + 5 + 11 + 11 + 0 + (source / 'link.txt').lstat().st_size
+
+    assert du_size == cmd.total_size(source)
+
+    by_path = {m['path']: m for m in metadata}
+    assert by_path['run/lane1/s1.bcl']['md5'] == hashlib.md5(b'A' * 10_000).hexdigest()
+    assert by_path['empty.txt']['md5'] == hashlib.md5(b'').hexdigest()
+    assert by_path['link.txt']['md5'] is None
+    assert by_path['link.txt']['type'] == utils.FileType.SYMBOLIC_LINK
+    assert set(by_path['notes.txt'].keys()) == {'path', 'md5', 'size', 'type'}
+
+
+def test_generate_metadata_rejects_unreadable_source(tmp_path: Path):
+    with pytest.raises(exc.InspectionFailed):
+        generate_metadata(celery_task=None, source=tmp_path / 'missing')
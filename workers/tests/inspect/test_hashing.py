@@ -0,0 +1,69 @@
+import hashlib
+from pathlib import Path
+
+import pytest
+
+from workers import hashing
+
+
+def test_hash_file_computes_all_digests_in_one_pass(tmp_path: Path):
+    data = b'0123456789' * 1000
+    data_file = tmp_path / 'data.bin'
+    data_file.write_bytes(data)
+
+    digests = hashing.hash_file(data_file, ['md5', 'sha256', 'md5'], block_size=4096)
+
+    assert digests == {
+        'md5': hashlib.md5(data).hexdigest(),
+        'sha256': hashlib.sha256(data).hexdigest(),
+    }
+
+
+def test_multi_hasher_blake3():
+    blake3 = pytest.importorskip('blake3')
+    hasher = hashing.MultiHasher(['blake3', 'md5'])
+    hasher.update(b'abc')
+    hasher.update(b'def')
+    assert hasher.hexdigests() == {
+        'blake3': blake3.blake3(b'abcdef').hexdigest(),
+        'md5': hashlib.md5(b'abcdef').hexdigest(),
+    }
+
+
+def test_multi_hasher_requires_an_algorithm():
+    with pytest.raises(ValueError):
+        hashing.MultiHasher([])
+
+
+@pytest.mark.parametrize('mode', hashing.MODES)
+@pytest.mark.parametrize('size', [0, 1, 4096, 3 * 4096 + 17])
+def test_hash_file_modes_agree(tmp_path: Path, mode: str, size: int):
+    data = bytes(range(256)) * (size // 256) + bytes(size % 256)
+    data_file = tmp_path / 'data.bin'
+    data_file.write_bytes(data)
+
+    digests = hashing.hash_file(data_file, ['md5', 'sha256'], mode=mode, block_size=4096)
+
+    assert digests == {
+        'md5': hashlib.md5(data).hexdigest(),
+        'sha256': hashlib.sha256(data).hexdigest(),
+    }
+
+
+def test_hash_file_rejects_unknown_mode(tmp_path: Path):
+    data_file = tmp_path / 'data.bin'
+    data_file.write_bytes(b'abc')
+    with pytest.raises(ValueError):
+        hashing.hash_file(data_file, ['md5'], mode='carrier-pigeon')
+
+
+def test_benchmark_reports_every_combination(tmp_path: Path):
+    data_file = tmp_path / 'data.bin'
+    data_file.write_bytes(b'x' * 100_000)
+
+    results = hashing.benchmark(data_file, block_sizes=[4096, 65536], repeat=1)
+
+    assert {(r['mode'], r['block_size']) for r in results} == {
+        (mode, block_size) for mode in hashing.MODES for block_size in [4096, 65536]
+    }
+    assert results == sorted(results, key=lambda r: r['seconds'])
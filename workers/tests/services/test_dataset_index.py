@@ -0,0 +1,91 @@
+from pathlib import Path
+
+import pytest
+
+import workers.api as api
+from workers import dataset_index
+from workers.dataset_index import DatasetIndex
+from workers.scripts.watch import Register
+
+
+@pytest.fixture
+def index(tmp_path: Path, monkeypatch) -> DatasetIndex:
+    index = DatasetIndex(tmp_path / 'dataset_index.sqlite3')
+    monkeypatch.setattr(dataset_index, 'get_index', lambda: index)
+    yield index
+    index.close()
+
+
+@pytest.fixture
+def api_datasets(monkeypatch) -> dict:
+    """
+    The datasets in a stand-in API, by name, and the names sent to it.
+    """
+    datasets = {'run1': {'id': 1, 'name': 'run1', 'type': 'RAW_DATA', 'origin_path': '/source/run1'}}
+    sent = []
+
+    def bulk_create_datasets(data):
+        sent.extend(d['name'] for d in data)
+        created = []
+        for d in data:
+            if d['name'] not in datasets:
+                datasets[d['name']] = {**d, 'id': len(datasets) + 1}
+                created.append(datasets[d['name']])
+        conflicted = [{'name': d['name'], 'type': d['type']} for d in data if d['name'] not in
+                      set(c['name'] for c in created)]
+        return {'created': created, 'conflicted': conflicted, 'errored': []}
+
+    monkeypatch.setattr(api, 'bulk_create_datasets', bulk_create_datasets)
+    monkeypatch.setattr(api, 'get_all_datasets', lambda dataset_type, **kwargs: list(datasets.values()))
+    monkeypatch.setattr(Register, 'run_workflows', lambda self, dataset: None)
+    return {'datasets': datasets, 'sent': sent}
+
+
+def test_index_persists(tmp_path: Path):
+    index = DatasetIndex(tmp_path / 'dataset_index.sqlite3')
+    index.add([{'type': 'RAW_DATA', 'name': 'run1', 'origin_path': '/source/run1'}])
+    index.replace('DATA_PRODUCT', [{'name': 'dp1', 'origin_path': '/source/dp1'}])
+    index.close()
+
+    reopened = DatasetIndex(tmp_path / 'dataset_index.sqlite3')
+    assert reopened.contains('RAW_DATA', 'run1')
+    assert reopened.contains('DATA_PRODUCT', 'dp1')
+    assert not reopened.contains('DATA_PRODUCT', 'run1')
+    assert reopened.synced_at('DATA_PRODUCT') is not None
+    assert reopened.synced_at('RAW_DATA') is None
+    reopened.close()
+
+
+def test_only_new_directories_are_sent(tmp_path: Path, index: DatasetIndex, api_datasets: dict):
+    register = Register('RAW_DATA')
+    source = tmp_path / 'source'
+    dirs = [source / name for name in ['run1', 'run2', 'run3']]
+
+    # the index is synced from the API before the first registration
+    register.register('full_scan', dirs)
+    assert api_datasets['sent'] == ['run2', 'run3']
+
+    # steady state: full scans send nothing
+    register.register('full_scan', dirs)
+    register.register('add', dirs)
+    assert api_datasets['sent'] == ['run2', 'run3']
+
+    register.register('add', [source / 'run4'])
+    assert api_datasets['sent'] == ['run2', 'run3', 'run4']
+    assert index.contains('RAW_DATA', 'run4')
+
+
+def test_sync_drops_datasets_deleted_in_the_api(tmp_path: Path, index: DatasetIndex, api_datasets: dict):
+    register = Register('RAW_DATA')
+    register.register('full_scan', [tmp_path / 'run1'])
+    assert api_datasets['sent'] == []
+
+    # deleted in the API: still indexed until the next sync
+    api_datasets['datasets'].pop('run1')
+    register.register('full_scan', [tmp_path / 'run1'])
+    assert api_datasets['sent'] == []
+
+    # once synced, it is registered again, as it was before the index existed
+    index._conn.execute('DELETE FROM sync')
+    register.register('full_scan', [tmp_path / 'run1'])
+    assert api_datasets['sent'] == ['run1']
@@ -0,0 +1,91 @@
+import threading
+import time
+from pathlib import Path
+
+from workers.services.watchlib import Observer, Poller
+
+
+def _observer(name: str, dir_path: Path, events: list, interval: int = 1, **kwargs) -> Observer:
+    return Observer(name=name, dir_path=str(dir_path), callback=lambda event, dirs: events.append((event, dirs)),
+                    interval=interval, **kwargs)
+
+
+def test_hung_observer_does_not_delay_the_others(tmp_path: Path):
+    release = threading.Event()
+    hung = _observer('hung', tmp_path, [], max_retries=5)
+    hung.watch = lambda scan_type: release.wait()
+    (tmp_path / 'run1').mkdir()
+    events = []
+
+    poller = Poller(num_workers=2, scan_timeout=0.2)
+    poller.register(hung)
+    poller.register(_observer('ok', tmp_path, events))
+    try:
+        poller.poll(loop=False)
+        assert events == [('add', [tmp_path / 'run1'])]
+        assert 'hung' in poller.running
+        assert poller.retries['hung'] == 1
+        assert poller.scan_stats['hung']['timeouts'] == 1
+
+        # the hung observer is not called again while its call is running
+        poller.last_call_times['hung'] = 0
+        poller._poll()
+        assert poller.scan_stats['hung']['timeouts'] == 1
+        [metric] = [m for m in poller.metrics() if m['measurement'] == 'watch_scan_seconds:hung']
+        assert metric['usage'] > 0.2
+    finally:
+        release.set()
+
+    # once it returns, it is called again
+    poller.poll(loop=False)
+    assert 'hung' not in poller.running
+    assert poller.retries['hung'] == 0
+
+
+def test_interval_backs_off_while_idle(tmp_path: Path):
+    poller = Poller(backoff=2, max_interval_factor=4)
+    poller.register(_observer('obs', tmp_path, [], interval=10))
+
+    for expected in [20, 40, 40]:
+        poller.last_call_times['obs'] = 0
+        poller.poll(loop=False)
+        assert poller.intervals['obs'] == expected
+
+    # activity brings it back to the observer's interval
+    (tmp_path / 'run1').mkdir()
+    poller.last_call_times['obs'] = 0
+    poller.poll(loop=False)
+    assert poller.intervals['obs'] == 10
+
+
+def test_failing_observer_is_unregistered(tmp_path: Path):
+    def fail(scan_type):
+        raise OSError('stale file handle')
+
+    observer = _observer('obs', tmp_path, [], max_retries=2)
+    observer.watch = fail
+    poller = Poller()
+    poller.register(observer)
+    for _ in range(2):
+        poller.last_call_times['obs'] = 0
+        poller.poll(loop=False)
+    assert 'obs' not in poller.observers
+
+
+def test_backing_off_does_not_delay_full_scans(tmp_path: Path):
+    events = []
+    poller = Poller(backoff=10, max_interval_factor=100)
+    poller.register(_observer('obs', tmp_path, events, interval=10, full_scan_every_n_scans=3))
+    (tmp_path / 'run1').mkdir()
+    poller.poll(loop=False)
+    assert poller.intervals['obs'] == 10
+    events.clear()
+
+    # idle: the next call is 100s away, but the full scan is due 30s after registration
+    poller.last_call_times['obs'] = 0
+    poller.poll(loop=False)
+    assert poller.intervals['obs'] == 100
+    poller.last_full_scan_times['obs'] -= 30
+    assert poller._next_wakeup(time.time()) == 0
+    poller.poll(loop=False)
+    assert events == [('full_scan', [tmp_path / 'run1'])]
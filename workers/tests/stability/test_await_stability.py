@@ -0,0 +1,80 @@
+import os
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+from celery.exceptions import Ignore
+
+import workers.api as api
+from workers.config import config
+from workers.tasks import await_stability as await_stability_task
+
+
+class _Task:
+    """
+    Stands in for the bound WorkflowTask: records progress and the rescheduled task runs.
+    """
+
+    def __init__(self, called_directly: bool = False):
+        self.request = SimpleNamespace(called_directly=called_directly,
+                                       kwargs={'workflow_id': 'wf1', 'step': 'await stability'})
+        self.progress = []
+        self.sent = []
+
+    def update_progress(self, progress_obj):
+        self.progress.append(progress_obj)
+
+    def signature_from_request(self, kwargs=None, **options):
+        task = self
+        return SimpleNamespace(apply_async=lambda: task.sent.append((kwargs, options)))
+
+
+@pytest.fixture
+def dataset(tmp_path: Path, monkeypatch) -> dict:
+    origin = tmp_path / 'run1'
+    (origin / 'Data').mkdir(parents=True)
+    (origin / 'Data' / 's_1.bcl').write_bytes(b'bcl')
+    dataset = {'id': 1, 'name': 'run1', 'type': 'RAW_DATA', 'origin_path': str(origin), 'states': []}
+    monkeypatch.setattr(api, 'get_dataset', lambda dataset_id, **kwargs: dataset)
+    monkeypatch.setattr(api, 'add_state_to_dataset',
+                        lambda dataset_id, state, **kwargs: dataset['states'].append(state))
+    monkeypatch.setitem(config['registration'], 'stability_checks', 'reschedule')
+    return dataset
+
+
+def test_unstable_dataset_is_rescheduled(dataset: dict):
+    task = _Task()
+    with pytest.raises(Ignore):
+        await_stability_task.await_stability(task, dataset_id=1, wait_seconds=30, recency_threshold=600)
+
+    # one check, then the same task is sent again with the hot directories of its scan
+    assert len(task.progress) == 1
+    [(kwargs, options)] = task.sent
+    assert options == {'countdown': 30}
+    assert kwargs['workflow_id'] == 'wf1'
+    # the change time of the dataset directory itself was recent enough, nothing under it was scanned
+    assert kwargs['hot_dirs'] == []
+    assert dataset['states'] == []
+
+
+def test_stable_dataset_is_ready(dataset: dict, monkeypatch):
+    # ctimes cannot be set back, so the threshold is in the future of every change
+    monkeypatch.setattr(time, 'time', lambda: os.stat(dataset['origin_path']).st_ctime + 3600)
+    task = _Task()
+    assert await_stability_task.await_stability(task, dataset_id=1, recency_threshold=600) == (1,)
+    assert task.sent == []
+    assert dataset['states'] == ['READY']
+
+
+def test_called_directly_waits_in_the_task(dataset: dict, monkeypatch):
+    sleeps = []
+    # the dataset does not change while the task sleeps
+    start = time.time()
+    monkeypatch.setattr(time, 'sleep', sleeps.append)
+    monkeypatch.setattr(time, 'time', lambda: start + 600 if sleeps else start)
+    task = _Task(called_directly=True)
+    assert await_stability_task.await_stability(task, dataset_id=1, wait_seconds=5, recency_threshold=300) == (1,)
+    assert sleeps == [5]
+    assert task.sent == []
+    assert dataset['states'] == ['READY']
@@ -0,0 +1,176 @@
+import os
+import time
+from pathlib import Path
+
+import pytest
+
+import workers.cmd as cmd
+from workers import change_sources
+from workers.config import config
+
+ROOT_FID = '[0x200000402:0x1:0x0]'
+SUBDIR_FID = '[0x200000402:0x2:0x0]'
+
+
+def _wait_for(predicate, timeout: float = 5.0) -> bool:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.05)
+    return predicate()
+
+
+@pytest.fixture
+def dataset_dir(tmp_path: Path) -> Path:
+    root = tmp_path / 'run1'
+    (root / 'Data').mkdir(parents=True)
+    (root / 'Data' / 's_1.bcl').write_bytes(b'bcl')
+    return root
+
+
+def test_inotify(dataset_dir: Path):
+    with change_sources.InotifySource(dataset_dir) as source:
+        baseline = source.last_modified()
+        assert baseline == change_sources.dir_last_modified_time(dataset_dir)
+
+        time.sleep(0.05)
+        # a directory created after the source was set up is watched too
+        (dataset_dir / 'Data' / 'L001').mkdir()
+        assert _wait_for(lambda: source.last_modified() > baseline)
+
+        seen = source.last_modified()
+        time.sleep(0.05)
+        (dataset_dir / 'Data' / 'L001' / 's_2.bcl').write_bytes(b'bcl')
+        assert _wait_for(lambda: source.last_modified() > seen)
+
+
+def test_parse_changelog_record():
+    line = ('12 01CREAT 15:22:33.123456789 2024.01.02 0x0 t=[0x200000402:0x3:0x0] ef=0xf u=0:0 '
+            'nid=10.0.0.1@tcp p=[0x200000402:0x2:0x0] s_2.bcl')
+    assert change_sources.parse_changelog_record(line) == (12, 'CREAT', '[0x200000402:0x3:0x0]', SUBDIR_FID)
+    assert change_sources.parse_changelog_record('lfs: no changelog records') is None
+
+
+@pytest.fixture
+def lfs(dataset_dir: Path, monkeypatch) -> list:
+    commands = []
+
+    def execute(args, **kwargs):
+        commands.append(args)
+        if args[0] == 'lctl':
+            return 'cl1\ncurrent_index: 41\nID    index (idle seconds)\ncl1   41 (3)\n', ''
+        if args[1] == 'path2fid':
+            fids = {str(dataset_dir): ROOT_FID, str(dataset_dir / 'Data'): SUBDIR_FID}
+            return ''.join(f'{path}: {fids[path]}\n' for path in args[2:]), ''
+        if args[1] == 'fid2path':
+            return {'[0x200000402:0x9:0x0]': f'{dataset_dir}/Data/s_1.bcl\n'}.get(args[3], '/elsewhere/file\n'), ''
+        return '', ''
+
+    monkeypatch.setattr(cmd, 'execute', execute)
+    return commands
+
+
+def test_lustre_changelog(dataset_dir: Path, lfs: list):
+    source = change_sources.LustreChangelogSource(dataset_dir, mdt='lustre-MDT0000', poll_interval_seconds=3600)
+    try:
+        baseline = source.last_modified()
+
+        # records about other directories and files are ignored
+        source.consume(['42 01CREAT 15:22:33.1 2024.01.02 0x0 t=[0x300000402:0x1:0x0] p=[0x300000400:0x1:0x0] x',
+                        '43 11CLOSE 15:22:33.2 2024.01.02 0x42 t=[0x300000402:0x1:0x0]'])
+        assert source.last_modified() == baseline
+
+        time.sleep(0.01)
+        # a file created in the dataset, then closed after writing
+        source.consume(['44 01CREAT 15:22:33.3 2024.01.02 0x0 t=[0x200000402:0x3:0x0] p=[0x200000402:0x2:0x0] y'])
+        created = source.last_modified()
+        assert created > baseline
+        time.sleep(0.01)
+        source.consume(['45 11CLOSE 15:22:33.4 2024.01.02 0x42 t=[0x200000402:0x3:0x0]'])
+        assert source.last_modified() > created
+
+        # a file that existed before is found with fid2path
+        modified = source.last_modified()
+        time.sleep(0.01)
+        source.consume(['46 13TRUNC 15:22:33.5 2024.01.02 0xe t=[0x200000402:0x9:0x0]'])
+        assert source.last_modified() > modified
+        assert source._index == 46
+    finally:
+        source.close()
+
+
+def test_falls_back_to_polling(dataset_dir: Path, monkeypatch):
+    def no_lfs(args, **kwargs):
+        raise cmd.SubprocessError({'return_code': 127, 'args': args})
+
+    monkeypatch.setattr(cmd, 'execute', no_lfs)
+    monkeypatch.setitem(config['registration']['change_source'], 'backend', 'lustre_changelog')
+    with change_sources.open_change_source(dataset_dir) as source:
+        assert isinstance(source, change_sources.PollingSource)
+
+
+def _set_change_time(path: Path, when: float) -> None:
+    os.utime(path, (when, when), follow_symlinks=False)
+
+
+def test_scanner_finds_the_latest_change(dataset_dir: Path):
+    (dataset_dir / 'Data' / 'L001').mkdir()
+    (dataset_dir / 'Data' / 'L001' / 's_2.bcl').write_bytes(b'bcl')
+    scanner = change_sources.MtimeScanner(dataset_dir, num_workers=4)
+    assert scanner.scan() == change_sources.dir_last_modified_time(dataset_dir)
+    assert scanner.scan(newer_than=time.time() + 60) == change_sources.dir_last_modified_time(dataset_dir)
+
+
+def test_scanner_stops_at_a_recent_change_and_remembers_where(dataset_dir: Path, monkeypatch):
+    # ctimes are always recent, so look for changes newer than the future
+    future = time.time() + 3600
+    for lane in range(8):
+        (dataset_dir / f'L{lane:03}').mkdir()
+        (dataset_dir / f'L{lane:03}' / 's_1.bcl').write_bytes(b'bcl')
+    _set_change_time(dataset_dir / 'L005' / 's_1.bcl', future + 10)
+
+    scanner = change_sources.MtimeScanner(dataset_dir, num_workers=2)
+    assert scanner.scan(newer_than=future) == future + 10
+
+    scanned = []
+    scan_dir = change_sources.MtimeScanner._scan_dir
+
+    def record_scan(dir_path):
+        scanned.append(dir_path)
+        return scan_dir(dir_path)
+
+    monkeypatch.setattr(change_sources.MtimeScanner, '_scan_dir', staticmethod(record_scan))
+    assert scanner.scan(newer_than=future) == future + 10
+    # only the directory where the change was found last time
+    assert scanned == [str(dataset_dir / 'L005')]
+
+    # once it cools down, the whole tree is scanned again
+    scanned.clear()
+    assert scanner.scan(newer_than=future + 20) == future + 10
+    # the remembered directory, then the dataset directory, Data and the lanes
+    assert len(scanned) == 1 + 1 + 1 + 8
+
+
+def test_scanner_sees_entries_removed_from_the_root(dataset_dir: Path):
+    (dataset_dir / 'SampleSheet.csv').write_text('sample\n', encoding='utf-8')
+    future = time.time() + 3600
+    scanner = change_sources.MtimeScanner(dataset_dir)
+    assert scanner.scan(newer_than=future) < future
+
+    # only the mtime / ctime of the root changes when a top-level file is deleted
+    (dataset_dir / 'SampleSheet.csv').unlink()
+    _set_change_time(dataset_dir, future + 10)
+    assert scanner.scan(newer_than=future) == future + 10
+    assert scanner.scan() == change_sources.dir_last_modified_time(dataset_dir)
+
+
+def test_scanner_of_an_empty_directory(tmp_path: Path):
+    (tmp_path / 'run1').mkdir()
+    mtime = (tmp_path / 'run1').lstat().st_mtime
+    assert change_sources.MtimeScanner(tmp_path / 'run1').scan() == max(mtime, (tmp_path / 'run1').lstat().st_ctime)
+
+
+def test_scanner_of_a_missing_directory(tmp_path: Path):
+    before = time.time()
+    assert change_sources.MtimeScanner(tmp_path / 'missing').scan(newer_than=before) >= before
@@ -130,6 +130,7 @@ def dataset_setter(dataset: dict):
 def get_all_datasets(
         dataset_type=None,
         name=None,
+        staged=None,
         days_since_last_staged=None,
         deleted=False,
         archived=None,
@@ -142,6 +143,7 @@ def get_all_datasets(
         payload = {
             'type': dataset_type,
             'name': name,
+            'staged': staged,
             'days_since_last_staged': days_since_last_staged,
             'deleted': deleted,
             'archived': archived,
@@ -278,6 +280,19 @@ def delete_dataset(dataset_id: int):
         r.raise_for_status()
 
 
+def get_dataset_files(dataset_id, skip: int = 0, take: int = 1000, filetype: str = None) -> list[dict]:
+    """
+    One page of the files of a dataset (GET /datasets/<id>/files/search), ordered by name.
+    """
+    with APIServerSession() as s:
+        params = {'skip': skip, 'take': take}
+        if filetype is not None:
+            params['filetype'] = filetype
+        r = s.get(f'datasets/{dataset_id}/files/search', params=params)
+        r.raise_for_status()
+        return [str_to_int(f, 'size') for f in r.json()]
+
+
 def add_files_to_dataset(dataset_id, files: list[dict]):
     with APIServerSession() as s:
         req_body = [int_to_str(f, 'size') for f in files]
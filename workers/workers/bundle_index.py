@@ -0,0 +1,402 @@
+"""
+Bundle index - random access to the members of an archived bundle
+
+Next to every bundle, archive_dataset stores a sidecar index (get_bundle_index_name) with one line per member:
+its path, the offset of its data in the tar stream, its size and MD5. With it, a few files can be staged out of a
+multi-terabyte bundle by reading only the byte ranges of those members (read_members) instead of downloading
+and extracting the whole bundle.
+
+For seekable zstd bundles the offsets are offsets in the decompressed tar stream, and the index also carries
+the frame table of the bundle, so only the frames that hold the requested members are read and decompressed.
+
+The index is gzip-compressed JSON lines:
+    {"path": "lane1/reads.fastq.gz", "type": "file", "offset": 1536, "size": 1024, "md5": "...", ...}
+    {"path": "lane1/image.raw", "type": "file", "offset": 4096, "size": 16777216, "sparse": [[0, 512], ...], ...}
+    ...
+    {"frames": [[compressed size, decompressed size], ...]}     (seekable zstd bundles only, last line)
+
+Only the data regions of a GNU sparse member are stored in the bundle, back to back at its offset. Its entry carries
+the sparse map - [offset in the file, size] of every data region - and read_members expands the holes between them.
+"""
+from __future__ import annotations
+
+import gzip
+import hashlib
+import json
+import os
+import queue
+import tarfile
+import threading
+from collections.abc import Iterable, Iterator
+from pathlib import Path
+from typing import NamedTuple
+
+from workers import hashing, seekable_zstd
+from workers.utils import parallel_map
+
+
+class BundleIndexError(Exception):
+    pass
+
+
+class IndexEntry(NamedTuple):
+    # path relative to the dataset root, as in the dataset's file metadata
+    path: str
+    # file | hardlink | symlink | dir
+    type: str
+    # offset of the member's data in the (decompressed) tar stream; files only
+    offset: int = None
+    size: int = None
+    md5: str = None
+    mode: int = None
+    mtime: int = None
+    # symlink target, or the path of the file a hardlink points to
+    linkname: str = None
+    # [(offset in the file, size)] of the data regions of a sparse file
+    sparse: list[tuple[int, int]] = None
+
+    @property
+    def stored_size(self) -> int:
+        """
+        Bytes of the file's data in the tar stream - less than size for sparse files.
+        """
+        if self.sparse is None:
+            return self.size
+        return sum(numbytes for _, numbytes in self.sparse)
+
+
+def _relpath(name: str) -> str:
+    # GNU tar member names are './a/b' ('./a/b/' for directories); tarfile reads the root './' as '.'
+    name = name.rstrip('/')
+    if name == '.':
+        return ''
+    return name.removeprefix('./')
+
+
+class IndexWriter:
+    def __init__(self, path: Path | str):
+        self.path = Path(path)
+        self.num_entries = 0
+        self._file = gzip.open(self.path, 'wt', encoding='utf-8')
+
+    def add(self, entry: IndexEntry) -> None:
+        record = {k: v for k, v in entry._asdict().items() if v is not None}
+        self._file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self.num_entries += 1
+
+    def add_member(self, member: tarfile.TarInfo, md5: str = None) -> None:
+        """
+        Add the entry of a tar member whose data is at member.offset_data.
+        """
+        path = _relpath(member.name)
+        if not path:
+            # the './' member of the dataset root
+            return
+        if member.isreg():
+            sparse = None
+            if member.issparse():
+                # GNU tar ends sparse maps with empty regions
+                sparse = [(offset, numbytes) for offset, numbytes in member.sparse if numbytes]
+            entry = IndexEntry(path=path, type='file', offset=member.offset_data, size=member.size, md5=md5,
+                               mode=member.mode, mtime=int(member.mtime), sparse=sparse)
+        elif member.islnk():
+            entry = IndexEntry(path=path, type='hardlink', linkname=_relpath(member.linkname))
+        elif member.issym():
+            entry = IndexEntry(path=path, type='symlink', linkname=member.linkname)
+        elif member.isdir():
+            entry = IndexEntry(path=path, type='dir', mode=member.mode, mtime=int(member.mtime))
+        else:
+            return
+        self.add(entry)
+
+    def close(self, frames: list[tuple[int, int]] = None) -> None:
+        """
+        @param frames: [(compressed size, decompressed size)] of a seekable zstd bundle
+        """
+        if frames is not None:
+            self._file.write(json.dumps({'frames': [list(frame) for frame in frames]}) + '\n')
+        self._file.close()
+
+
+class TarIndexer:
+    _DONE = None
+
+    def __init__(self, index: IndexWriter, max_pending_chunks: int = 4):
+        """
+        Sink for a tar stream (see hashing.copy_stream) that indexes its members, including the MD5 of every file,
+        as the stream goes by. The stream is parsed by tarfile on a background thread; at most max_pending_chunks
+        chunks are buffered.
+
+        Use as a context manager. Leaving the context waits for the rest of the stream to be indexed and raises
+        any parse error.
+        """
+        self.index = index
+        self._chunks = queue.Queue(maxsize=max_pending_chunks)
+        self._error = None
+        self._end_of_stream = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _iter_chunks(self):
+        while (chunk := self._chunks.get()) is not self._DONE:
+            yield chunk
+        self._end_of_stream = True
+
+    def _run(self):
+        stream = seekable_zstd.ChunkStream(self._iter_chunks())
+        try:
+            with tarfile.open(fileobj=stream, mode='r|') as tar:
+                for member in tar:
+                    md5 = None
+                    if member.isreg():
+                        hasher = hashlib.md5()
+                        f = tar.extractfile(member)
+                        while data := f.read(1024 * 1024):
+                            hasher.update(data)
+                        md5 = hasher.hexdigest()
+                    self.index.add_member(member, md5=md5)
+        except Exception as e:
+            self._error = e
+        finally:
+            # drain the padding after the end-of-archive marker (or the rest of the stream after an error),
+            # so that write() never blocks on a reader that is gone
+            if not self._end_of_stream:
+                for _ in self._iter_chunks():
+                    pass
+
+    def write(self, data) -> int:
+        if self._error is not None:
+            raise BundleIndexError(f'unable to index the tar stream: {self._error}')
+        self._chunks.put(bytes(data))
+        return len(data)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._chunks.put(self._DONE)
+        self._thread.join()
+        if exc_type is None and self._error is not None:
+            raise BundleIndexError(f'unable to index the tar stream: {self._error}')
+        return False
+
+
+def _scan(path: Path | str, wanted: set[str] | None) -> tuple[dict[str, IndexEntry], list[tuple[int, int]] | None]:
+    entries = {}
+    frames = None
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            record = json.loads(line)
+            if 'frames' in record:
+                frames = [tuple(frame) for frame in record['frames']]
+            elif wanted is None or record['path'] in wanted:
+                if 'sparse' in record:
+                    record['sparse'] = [tuple(region) for region in record['sparse']]
+                entries[record['path']] = IndexEntry(**record)
+    return entries, frames
+
+
+def read_index(path: Path | str, paths: Iterable[str] = None) -> tuple[list[IndexEntry], list[tuple[int, int]] | None]:
+    """
+    Read the index at path.
+
+    @param paths: only return the entries of these paths. A hardlink whose target is not among them is returned
+                  as a file entry with the data of its target.
+    @return: entries, frames of a seekable zstd bundle (None for tar bundles)
+    """
+    if paths is None:
+        entries, frames = _scan(path, None)
+        return list(entries.values()), frames
+
+    wanted = set(paths)
+    entries, frames = _scan(path, wanted)
+    missing = wanted - entries.keys()
+    if missing:
+        raise BundleIndexError(f'{len(missing)} files are not in the bundle, e.g. {sorted(missing)[:5]}')
+
+    links = [e for e in entries.values() if e.type == 'hardlink' and e.linkname not in wanted]
+    if links:
+        targets, _ = _scan(path, {e.linkname for e in links})
+        for link in links:
+            entries[link.path] = targets[link.linkname]._replace(path=link.path)
+    return list(entries.values()), frames
+
+
+def _skip(stream, n: int, block_size: int) -> None:
+    if n < 0:
+        raise BundleIndexError('ranges must be read in increasing order')
+    if n == 0:
+        return
+    if stream.seekable():
+        stream.seek(n, os.SEEK_CUR)
+        return
+    while n > 0:
+        data = stream.read(min(n, block_size))
+        if not data:
+            raise BundleIndexError('unexpected end of bundle')
+        n -= len(data)
+
+
+def _read_exact(stream, n: int) -> bytes:
+    data = stream.read(n)
+    if len(data) != n:
+        raise BundleIndexError('unexpected end of bundle')
+    return data
+
+
+def _merge_ranges(entries: list[IndexEntry]) -> list[tuple[int, int]]:
+    ranges = []
+    for entry in sorted(entries, key=lambda e: e.offset):
+        start, end = entry.offset, entry.offset + entry.stored_size
+        if ranges and start <= ranges[-1][1]:
+            ranges[-1] = (ranges[-1][0], max(ranges[-1][1], end))
+        else:
+            ranges.append((start, end))
+    return ranges
+
+
+def _tar_blocks(stream, ranges: list[tuple[int, int]], block_size: int) -> Iterator[tuple[int, bytes]]:
+    position = 0
+    for start, end in ranges:
+        _skip(stream, start - position, block_size)
+        position = start
+        while position < end:
+            data = stream.read(min(block_size, end - position))
+            if not data:
+                raise BundleIndexError('unexpected end of bundle')
+            yield position, data
+            position += len(data)
+
+
+def _zstd_blocks(stream, frames: list[tuple[int, int]], ranges: list[tuple[int, int]],
+                 threads: int, block_size: int) -> Iterator[tuple[int, bytes]]:
+    # (compressed offset, compressed size, decompressed offset) of every frame that overlaps a range
+    needed = []
+    compressed_offset, decompressed_offset = 0, 0
+    i = 0
+    for compressed_size, decompressed_size in frames:
+        frame_end = decompressed_offset + decompressed_size
+        while i < len(ranges) and ranges[i][1] <= decompressed_offset:
+            i += 1
+        if i < len(ranges) and ranges[i][0] < frame_end:
+            needed.append((compressed_offset, compressed_size, decompressed_offset))
+        compressed_offset += compressed_size
+        decompressed_offset = frame_end
+
+    def read_frames():
+        position = 0
+        for offset, size, start in needed:
+            _skip(stream, offset - position, block_size)
+            yield start, _read_exact(stream, size)
+            position = offset + size
+
+    def decompress(frame):
+        start, data = frame
+        return start, seekable_zstd.decompress(data)
+
+    yield from parallel_map(decompress, read_frames(), num_workers=threads)
+
+
+def read_members(stream,
+                 entries: list[IndexEntry],
+                 target_dir: Path,
+                 frames: list[tuple[int, int]] = None,
+                 threads: int = 8,
+                 block_size: int = None) -> int:
+    """
+    Write the requested members to target_dir reading stream - the bundle, from its beginning - only forward.
+    Byte ranges that hold no requested member are skipped (seeked over when stream is seekable), and with frames
+    only the seekable zstd frames that hold requested members are decompressed.
+
+    The MD5 of every file is verified against the index.
+
+    @param entries: entries to extract, from read_index()
+    @param frames: frame table of a seekable zstd bundle, from read_index()
+    @return: number of bytes written
+    """
+    block_size = block_size or hashing.default_block_size()
+    by_path = {e.path: e for e in entries}
+    files = [e for e in entries if e.type == 'file']
+    ranges = _merge_ranges(files)
+    if frames is None:
+        blocks = _tar_blocks(stream, ranges, block_size)
+    else:
+        blocks = _zstd_blocks(stream, frames, ranges, threads, block_size)
+
+    block_start, block = 0, b''
+
+    def copy(position: int, size: int, f, hasher) -> None:
+        nonlocal block_start, block
+        end = position + size
+        while position < end:
+            while block_start + len(block) <= position:
+                block_start, block = next(blocks)
+            piece = memoryview(block)[position - block_start:end - block_start]
+            hasher.update(piece)
+            f.write(piece)
+            position += len(piece)
+
+    def hash_zeros(size: int, hasher) -> None:
+        zeros = bytes(min(size, block_size))
+        while size > 0:
+            hasher.update(zeros[:size])
+            size -= len(zeros)
+
+    written = 0
+    for entry in sorted(files, key=lambda e: e.offset):
+        path = target_dir / entry.path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        hasher = hashlib.md5()
+        with open(path, 'wb') as f:
+            if entry.sparse is None:
+                copy(entry.offset, entry.size, f, hasher)
+            else:
+                # the data regions are written where they belong, and the holes are left unallocated
+                stored, position = entry.offset, 0
+                for offset, numbytes in entry.sparse:
+                    hash_zeros(offset - position, hasher)
+                    f.seek(offset)
+                    copy(stored, numbytes, f, hasher)
+                    stored += numbytes
+                    position = offset + numbytes
+                hash_zeros(entry.size - position, hasher)
+                f.truncate(entry.size)
+        if hasher.hexdigest() != entry.md5:
+            raise BundleIndexError(f'checksum of {entry.path} does not match the bundle index')
+        os.chmod(path, entry.mode)
+        os.utime(path, (entry.mtime, entry.mtime))
+        written += entry.size
+
+    for entry in entries:
+        path = target_dir / entry.path
+        if entry.type == 'hardlink':
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.unlink(missing_ok=True)
+            os.link(target_dir / by_path[entry.linkname].path, path)
+        elif entry.type == 'symlink':
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.unlink(missing_ok=True)
+            path.symlink_to(entry.linkname)
+        elif entry.type == 'dir':
+            path.mkdir(parents=True, exist_ok=True)
+    return written
+
+
+def index_bundle(bundle: Path | str, index_path: Path | str) -> None:
+    """
+    Index an existing tar or seekable zstd bundle - for bundles archived before indexes were written.
+    """
+    index = IndexWriter(index_path)
+    frames = None
+    try:
+        with TarIndexer(index) as indexer:
+            if seekable_zstd.is_seekable(bundle):
+                frames = seekable_zstd.read_seek_table(bundle)
+                for chunk in seekable_zstd.iter_decompressed(bundle):
+                    indexer.write(chunk)
+            else:
+                with open(bundle, 'rb') as f:
+                    hashing.copy_stream(f, sinks=[indexer])
+    finally:
+        index.close(frames=[(f.compressed_size, f.decompressed_size) for f in frames] if frames else None)
+
@@ -0,0 +1,452 @@
+"""
+Change sources for await_stability
+
+await_stability waits until nothing under a dataset directory has changed for a while. A change source tells it
+when the directory last changed:
+
+- poll: scans the tree for the latest mtime / ctime every time it is asked, in parallel and stopping at the
+  first recent change (MtimeScanner)
+- inotify: scans the tree once, then watches every directory in it with inotify and records the time of every
+  event. inotify only sees changes made through the kernel it runs on - on Lustre and NFS, writes by other
+  clients are not reported, so use it only where the data is written on the worker's host
+- lustre_changelog: scans the tree once, then follows the changelog of the Lustre MDT
+  (config['registration']['change_source']['lustre']) for records about the directories and files of the
+  dataset. Reading the changelog needs a registered changelog user and the privileges of `lfs changelog`
+
+The event sources do not rescan the tree after the first scan. If an event source can not be set up (inotify
+watch limit reached, lfs not available, ...), the dataset is polled.
+"""
+from __future__ import annotations
+
+import ctypes
+import ctypes.util
+import errno
+import itertools
+import logging
+import os
+import re
+import select
+import struct
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+
+import workers.cmd as cmd
+from workers import fswalk
+from workers.config import config
+from workers.utils import FileType
+
+logger = logging.getLogger(__name__)
+
+
+class ChangeSourceError(Exception):
+    pass
+
+
+def dir_last_modified_time(dataset_path: Path) -> float:
+    """
+    Obtain the most recent modification time for a directory and all its contents in a recursive manner.
+    At times, when copying files, outdated modification times may be retained.
+    To address this, monitor the modification time of the root directory as well.
+
+    If the copy process is configured to preserve the metadata of the source file, it will update the m_time
+    of the target file after the copy process. This will update the c_time of the target file. In these cases,
+    c_time will be bigger than m_time. So, we will consider the maximum of c_time and m_time of the file / directory
+    as the last modified time.
+
+
+    Args:
+    dataset_path (Path): Path object to the directory.
+
+    Returns:
+    float: The last modified time in epoch seconds.
+    """
+    paths = itertools.chain([dataset_path], dataset_path.rglob('*'))
+    return max(
+        (max(p.lstat().st_mtime, p.lstat().st_ctime) for p in paths if p.exists()),
+        default=time.time()
+    )
+
+
+class ChangeSource:
+    def __init__(self, path: Path):
+        self.path = path
+
+    def last_modified(self, newer_than: float = None) -> float:
+        """
+        Time (epoch seconds) anything under path was last changed.
+
+        @param newer_than: the caller only needs to know whether anything changed after this time - a source may
+                           return any change time later than it instead of the latest one
+        """
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _change_time(st: os.stat_result) -> float:
+    return max(st.st_mtime, st.st_ctime)
+
+
+class MtimeScanner:
+    def __init__(self, root: Path, num_workers: int = 8, max_hot_dirs: int = 16, hot_dirs: list[str] = None):
+        """
+        Finds the latest change time (max of mtime and ctime, as dir_last_modified_time) under root, stopping as
+        soon as it finds one later than a cutoff.
+
+        Directories are listed and their entries lstat-ed on num_workers threads. The directories where recent
+        changes were found are remembered (up to max_hot_dirs) and scanned first the next time: while data is
+        being copied in, the check usually ends after a few stats in the directory being written.
+
+        @param hot_dirs: the hot_dirs of a previous scanner of root, to carry them over between processes
+        """
+        self.root = root
+        self.num_workers = num_workers
+        self.max_hot_dirs = max_hot_dirs
+        self._hot_dirs = list(hot_dirs or [])[:max_hot_dirs]
+
+    @property
+    def hot_dirs(self) -> list[str]:
+        """
+        The directories scanned first, most recently hot first.
+        """
+        return list(self._hot_dirs)
+
+    @staticmethod
+    def _scan_dir(dir_path: str) -> tuple[float | None, list[str]]:
+        """
+        (latest change time of the entries of dir_path - None if it has none, its subdirectories)
+        """
+        latest = None
+        subdirs = []
+        try:
+            with os.scandir(dir_path) as it:
+                for dir_entry in it:
+                    try:
+                        change_time = _change_time(dir_entry.stat(follow_symlinks=False))
+                    except FileNotFoundError:
+                        # removed while it was scanned
+                        continue
+                    latest = change_time if latest is None else max(latest, change_time)
+                    if dir_entry.is_dir(follow_symlinks=False):
+                        subdirs.append(dir_entry.path)
+        except (FileNotFoundError, NotADirectoryError):
+            pass
+        return latest, subdirs
+
+    def _remember(self, dir_path: str) -> None:
+        if dir_path in self._hot_dirs:
+            self._hot_dirs.remove(dir_path)
+        self._hot_dirs.insert(0, dir_path)
+        del self._hot_dirs[self.max_hot_dirs:]
+
+    def scan(self, newer_than: float = None) -> float:
+        """
+        The latest change time of root and everything under it or, if newer_than is given, the first change time
+        later than newer_than that is found. Like dir_last_modified_time, time.time() if root does not exist.
+        """
+        def is_recent(change_time: float | None) -> bool:
+            return newer_than is not None and change_time is not None and change_time > newer_than
+
+        # entries added to, removed from or renamed in root only change root itself
+        try:
+            latest = _change_time(os.lstat(self.root))
+        except FileNotFoundError:
+            return time.time()
+        if is_recent(latest):
+            return latest
+
+        for dir_path in list(self._hot_dirs):
+            dir_latest, _ = self._scan_dir(dir_path)
+            if is_recent(dir_latest):
+                self._remember(dir_path)
+                return dir_latest
+            # cooled down
+            self._hot_dirs.remove(dir_path)
+
+        root = os.fspath(self.root)
+        pool = ThreadPoolExecutor(max_workers=self.num_workers)
+        try:
+            pending = {pool.submit(self._scan_dir, root): root}
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    dir_path = pending.pop(future)
+                    dir_latest, subdirs = future.result()
+                    if is_recent(dir_latest):
+                        self._remember(dir_path)
+                        return dir_latest
+                    if dir_latest is not None:
+                        latest = max(latest, dir_latest)
+                    for subdir in subdirs:
+                        pending[pool.submit(self._scan_dir, subdir)] = subdir
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+        return latest
+
+
+class PollingSource(ChangeSource):
+    def __init__(self, path: Path, num_workers: int = 8, hot_dirs: list[str] = None):
+        super().__init__(path)
+        self._scanner = MtimeScanner(path, num_workers=num_workers, hot_dirs=hot_dirs)
+
+    @property
+    def hot_dirs(self) -> list[str]:
+        return self._scanner.hot_dirs
+
+    def last_modified(self, newer_than: float = None) -> float:
+        return self._scanner.scan(newer_than)
+
+
+class _EventSource(ChangeSource):
+    """
+    A change source that records the time of the change events it receives, after a first scan of the tree
+    for the changes made before it was set up.
+    """
+
+    def __init__(self, path: Path):
+        super().__init__(path)
+        self._last_event = 0.0
+        self._lock = threading.Lock()
+        self._baseline = dir_last_modified_time(path)
+
+    def changed(self, when: float = None) -> None:
+        with self._lock:
+            self._last_event = max(self._last_event, time.time() if when is None else when)
+
+    def last_modified(self, newer_than: float = None) -> float:
+        with self._lock:
+            return max(self._baseline, self._last_event)
+
+
+_IN_MODIFY = 0x00000002
+_IN_ATTRIB = 0x00000004
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_DELETE_SELF = 0x00000400
+_IN_MOVE_SELF = 0x00000800
+_IN_Q_OVERFLOW = 0x00004000
+_IN_ONLYDIR = 0x01000000
+_IN_DONT_FOLLOW = 0x02000000
+_IN_ISDIR = 0x40000000
+_IN_NONBLOCK = os.O_NONBLOCK
+_IN_CLOEXEC = os.O_CLOEXEC
+
+_WATCH_MASK = (_IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE |
+               _IN_DELETE | _IN_DELETE_SELF | _IN_MOVE_SELF | _IN_ONLYDIR | _IN_DONT_FOLLOW)
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+class InotifySource(_EventSource):
+    def __init__(self, path: Path):
+        """
+        Watch every directory under path with inotify. Directories created (or moved in) later are watched
+        as soon as their creation is reported.
+        """
+        libc_name = ctypes.util.find_library('c')
+        if libc_name is None:
+            raise ChangeSourceError('libc not found')
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        self._fd = self._libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self._fd < 0:
+            raise ChangeSourceError(f'inotify_init1 failed: {os.strerror(ctypes.get_errno())}')
+        self._dirs = {}
+        self._stop = threading.Event()
+        try:
+            # watched before the first scan, so nothing changed between the two is missed
+            self._watch_tree(str(path))
+            super().__init__(path)
+        except BaseException:
+            os.close(self._fd)
+            raise
+        self._thread = threading.Thread(target=self._read_events, name=f'inotify {path}', daemon=True)
+        self._thread.start()
+
+    def _watch(self, dir_path: str) -> None:
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(dir_path), _WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                raise ChangeSourceError('inotify watch limit reached (fs.inotify.max_user_watches)')
+            if err not in (errno.ENOENT, errno.ENOTDIR):
+                raise ChangeSourceError(f'inotify_add_watch {dir_path} failed: {os.strerror(err)}')
+            return
+        self._dirs[wd] = dir_path
+
+    def _watch_tree(self, root: str) -> None:
+        self._watch(root)
+        for entry in fswalk.walk(root, onerror=lambda path, e: None):
+            if entry.type == FileType.DIRECTORY:
+                self._watch(entry.path)
+
+    def _handle(self, wd: int, mask: int, name: str) -> None:
+        self.changed()
+        if mask & _IN_Q_OVERFLOW:
+            logger.warning(f'inotify events of {self.path} were lost')
+        if mask & _IN_ISDIR and mask & (_IN_CREATE | _IN_MOVED_TO) and wd in self._dirs:
+            try:
+                self._watch_tree(os.path.join(self._dirs[wd], name))
+            except ChangeSourceError as e:
+                logger.warning(f'{e} - changes under {name} may be missed')
+
+    def _read_events(self) -> None:
+        while not self._stop.is_set():
+            readable, _, _ = select.select([self._fd], [], [], 1.0)
+            if not readable:
+                continue
+            try:
+                buf = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                continue
+            except OSError:
+                return
+            offset = 0
+            while offset + _EVENT_HEADER.size <= len(buf):
+                wd, mask, _, name_len = _EVENT_HEADER.unpack_from(buf, offset)
+                offset += _EVENT_HEADER.size
+                name = os.fsdecode(buf[offset:offset + name_len].rstrip(b'\0'))
+                offset += name_len
+                self._handle(wd, mask, name)
+
+    def close(self) -> None:
+        self._stop.set()
+        self._thread.join()
+        os.close(self._fd)
+
+
+_FID = re.compile(r'^(t|p)=(\[[^]]+])$')
+# record types that change the contents or the attributes of their target, without a parent FID
+_DATA_RECORDS = {'CLOSE', 'MTIME', 'TRUNC', 'SATTR', 'XATTR', 'CTIME', 'ATIME', 'LYOUT', 'HSM'}
+
+
+def parse_changelog_record(line: str) -> tuple[int, str, str | None, str | None] | None:
+    """
+    (index, type, target FID, parent FID) of a record of `lfs changelog`, e.g.
+    12 01CREAT 15:22:33.123456789 2024.01.02 0x0 t=[0x200000402:0x1:0x0] ef=0xf u=0:0 p=[0x200000007:0x1:0x0] a
+    """
+    tokens = line.split()
+    if len(tokens) < 2 or not tokens[0].isdigit():
+        return None
+    fids = {}
+    for token in tokens[2:]:
+        m = _FID.match(token)
+        if m:
+            fids.setdefault(m.group(1), m.group(2))
+    return int(tokens[0]), tokens[1][2:], fids.get('t'), fids.get('p')
+
+
+class LustreChangelogSource(_EventSource):
+    def __init__(self, path: Path, mdt: str, poll_interval_seconds: float = 10):
+        """
+        Follow the changelog of the MDT that holds path. A record is about the dataset if its target or parent
+        FID is one of the dataset's directories or of the files and directories created in them since; the
+        targets of other content and attribute changes are resolved with `lfs fid2path`.
+        """
+        self.mdt = mdt
+        self._fids = set()
+        self._outside = set()
+        self._stop = threading.Event()
+        self._index = self._current_index()
+        root = str(path)
+        self._fids.update(self._path2fid([root] + [e.path for e in fswalk.walk(root, onerror=lambda p, e: None)
+                                                   if e.type == FileType.DIRECTORY]))
+        super().__init__(path)
+        self._poll_interval_seconds = poll_interval_seconds
+        self._thread = threading.Thread(target=self._follow, name=f'changelog {path}', daemon=True)
+        self._thread.start()
+
+    def _current_index(self) -> int:
+        stdout, _ = cmd.execute(['lctl', 'get_param', '-n', f'mdd.{self.mdt}.changelog_users'])
+        m = re.search(r'current[ _]index:\s*(\d+)', stdout)
+        if m is None:
+            raise ChangeSourceError(f'no changelog index in the changelog_users of {self.mdt}: {stdout}')
+        return int(m.group(1))
+
+    @staticmethod
+    def _path2fid(paths: list[str], batch_size: int = 1000) -> set[str]:
+        fids = set()
+        for i in range(0, len(paths), batch_size):
+            stdout, _ = cmd.execute(['lfs', 'path2fid', *paths[i:i + batch_size]])
+            fids.update(re.findall(r'\[0x[0-9a-f]+:0x[0-9a-f]+:0x[0-9a-f]+]', stdout))
+        return fids
+
+    def _inside(self, fid: str) -> bool:
+        if fid in self._fids:
+            return True
+        if fid in self._outside:
+            return False
+        try:
+            stdout, _ = cmd.execute(['lfs', 'fid2path', self.mdt.rsplit('-', 1)[0], fid])
+        except cmd.SubprocessError:
+            # removed since
+            stdout = ''
+        root = os.fspath(self.path).rstrip('/')
+        if any(p == root or p.startswith(root + '/') for p in stdout.splitlines()):
+            self._fids.add(fid)
+            return True
+        if len(self._outside) > 1_000_000:
+            self._outside.clear()
+        self._outside.add(fid)
+        return False
+
+    def consume(self, lines) -> None:
+        for line in lines:
+            record = parse_changelog_record(line)
+            if record is None:
+                continue
+            index, record_type, target, parent = record
+            self._index = max(self._index, index)
+            if parent is not None and parent in self._fids:
+                if target is not None:
+                    self._fids.add(target)
+                self.changed()
+            elif target is not None and (target in self._fids or (record_type in _DATA_RECORDS
+                                                                   and self._inside(target))):
+                self.changed()
+
+    def _follow(self) -> None:
+        while not self._stop.wait(self._poll_interval_seconds):
+            try:
+                stdout, _ = cmd.execute(['lfs', 'changelog', self.mdt, str(self._index + 1)],
+                                        encoding_errors='replace')
+            except cmd.SubprocessError as e:
+                # a changelog that can not be read is a change that can not be ruled out
+                logger.warning(f'unable to read the changelog of {self.mdt}: {e}')
+                self.changed()
+                continue
+            self.consume(stdout.splitlines())
+
+    def close(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+
+def open_change_source(path: Path, backend: str = None) -> ChangeSource:
+    """
+    Change source of the dataset directory at path: backend 'poll', 'inotify' or 'lustre_changelog'
+    (default: config['registration']['change_source']['backend']). Falls back to polling if the backend can not
+    be set up.
+    """
+    source_config = config['registration']['change_source']
+    backend = backend or source_config['backend']
+    if backend not in ('poll', 'inotify', 'lustre_changelog'):
+        raise ValueError(f'unknown change source {backend}')
+    try:
+        if backend == 'inotify':
+            return InotifySource(path)
+        if backend == 'lustre_changelog':
+            return LustreChangelogSource(path, **source_config['lustre'])
+    except (ChangeSourceError, cmd.SubprocessError, OSError) as e:
+        logger.warning(f'unable to follow the changes of {path} with {backend}, polling instead: {e}')
+    return PollingSource(path, num_workers=source_config['poll']['workers'])
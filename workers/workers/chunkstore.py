@@ -0,0 +1,554 @@
+"""
+Chunk store - deduplicated archive storage for bundles
+
+Re-archiving a dataset after a small change, or archiving a data product that overlaps another dataset, uploads
+the same bytes to SDA again. In archive mode 'chunks' the tar stream of a bundle is cut into content-defined
+chunks instead, and only chunks the store does not have yet are uploaded:
+
+- Chunk boundaries are chosen by the content, so an unchanged file produces the same chunks in every bundle
+  it is part of, at any position. Tar aligns member data on 512 byte blocks; a chunk ends after a block whose
+  CRC-32 has its low bits all zero (avg_size apart on average), and is between min_size and max_size bytes long.
+  Hashing 512 byte blocks with zlib keeps the cut search fast in Python, where a byte-wise rolling hash is not.
+- A chunk is identified by its SHA-256. New chunks are appended to pack files of about pack_size bytes, so SDA
+  stores a few large files instead of millions of small ones. Packs are uploaded to <store>/packs/.
+- The recipe of a bundle lists the chunks that make up its tar stream - (chunk id, pack, offset in the pack,
+  size) - as gzip JSON lines. It is archived in place of the bundle (dataset['archive_path'] points to it) and
+  is all restore() needs to rebuild the bundle byte for byte.
+- The chunk index is a node-local SQLite database (config['archive']['chunks']['index']) of the chunks in
+  every pack and the chunks every recipe references, at the location the recipe reads them from. It is only used for lookups while archiving and for
+  garbage collection: collect_garbage() returns the packs no recipe references any more.
+
+The pack store is shared, but the index is the only record of which recipes reference which chunks, and SQLite
+can not be shared over a parallel file system. Archiving in mode 'chunks', deleting a chunked dataset and
+garbage collection therefore have to run on one node, config['archive']['chunks']['index_host'] - route the
+archive_dataset and delete_dataset tasks of those datasets to a worker on that node. get_index() raises
+ChunkStoreError anywhere else, so a task on another node fails instead of archiving without deduplication or
+deleting without releasing its chunks. Staging only reads recipes and packs and runs on any node.
+
+Packs are written by a single archive run and never shared between runs, so the chunks of deleted datasets
+usually leave whole packs unreferenced. Two runs archiving at the same time can both store a new chunk; it is
+then in two packs, and each is kept for as long as a recipe reads the chunk from it.
+"""
+from __future__ import annotations
+
+import gzip
+import hashlib
+import json
+import logging
+import math
+import os
+import socket
+import sqlite3
+import tarfile
+import threading
+import time
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from sca_rhythm.progress import Progress
+
+import workers.workflow_utils as wf_utils
+from workers.config import config
+from workers.utils import parallel_map
+
+logger = logging.getLogger(__name__)
+
+RECIPE_SUFFIX = '.recipe.jsonl.gz'
+
+# references are written to the index in batches of this many chunks
+_REF_BATCH_SIZE = 1000
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS pack (
+    path        TEXT    PRIMARY KEY,
+    size        INTEGER NOT NULL,
+    created_at  REAL    NOT NULL
+);
+CREATE TABLE IF NOT EXISTS chunk (
+    id          TEXT    NOT NULL,
+    pack        TEXT    NOT NULL,
+    offset      INTEGER NOT NULL,
+    size        INTEGER NOT NULL,
+    PRIMARY KEY (id, pack)
+);
+CREATE INDEX IF NOT EXISTS chunk_pack ON chunk (pack);
+CREATE TABLE IF NOT EXISTS recipe (
+    path        TEXT    PRIMARY KEY,
+    complete    INTEGER NOT NULL,
+    created_at  REAL    NOT NULL
+);
+CREATE TABLE IF NOT EXISTS ref (
+    recipe      TEXT    NOT NULL,
+    chunk       TEXT    NOT NULL,
+    pack        TEXT    NOT NULL,
+    PRIMARY KEY (recipe, chunk, pack)
+);
+CREATE INDEX IF NOT EXISTS ref_pack ON ref (pack);
+"""
+
+# a pack is referenced by the recipes that read a chunk from it - not by those that read the chunk elsewhere
+_UNREFERENCED_PACKS = """
+SELECT path, size FROM pack
+WHERE created_at < ?
+AND NOT EXISTS (SELECT 1 FROM ref WHERE ref.pack = pack.path)
+"""
+
+
+class ChunkStoreError(Exception):
+    pass
+
+
+def recipe_archive_path(bundle_archive_path: str) -> str:
+    return f'{bundle_archive_path}{RECIPE_SUFFIX}'
+
+
+def is_recipe(archive_path: str | None) -> bool:
+    return archive_path is not None and archive_path.endswith(RECIPE_SUFFIX)
+
+
+class ChunkIndex:
+    def __init__(self, db_path: Path | str):
+        """
+        Open (and create if missing) the chunk index at db_path.
+
+        A single connection is shared by all threads of the process and guarded by a lock.
+        WAL mode and a busy timeout let several worker processes on the same node use the same file.
+        """
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.db_path), timeout=60, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(_SCHEMA)
+
+    def lookup(self, chunk_id: str) -> tuple[str, int, int] | None:
+        """
+        (pack, offset, size) of a stored chunk, or None. A chunk stored in several packs is found in one of them.
+        """
+        with self._lock:
+            return self._conn.execute('SELECT pack, offset, size FROM chunk WHERE id=? LIMIT 1',
+                                      (chunk_id,)).fetchone()
+
+    def add_pack(self, path: str, size: int, chunks: list[tuple[str, int, int]]) -> None:
+        """
+        Record an uploaded pack and its chunks: [(chunk id, offset, size)].
+        """
+        with self._lock:
+            with self._conn:
+                self._conn.execute('BEGIN IMMEDIATE')
+                self._conn.execute('INSERT OR REPLACE INTO pack VALUES (?, ?, ?)', (path, size, time.time()))
+                # a chunk another run stored meanwhile is recorded in both packs - recipes reference either
+                self._conn.executemany('INSERT OR IGNORE INTO chunk VALUES (?, ?, ?, ?)',
+                                       [(chunk_id, path, offset, size) for chunk_id, offset, size in chunks])
+
+    def begin_recipe(self, path: str) -> str:
+        """
+        Register a recipe that is being written, under a temporary name that commit_recipe() replaces with path.
+        """
+        pending = f'{path}#{uuid.uuid4().hex}'
+        with self._lock:
+            self._conn.execute('INSERT INTO recipe VALUES (?, 0, ?)', (pending, time.time()))
+        return pending
+
+    def add_refs(self, recipe: str, reused: list[tuple[str, str]], stored: list[tuple[str, str]]) -> None:
+        """
+        Reference chunks from a recipe that is being written, at the location the recipe reads them from:
+        [(chunk id, pack)].
+
+        @param reused: chunks found in the index - raises ChunkStoreError if one of them has been garbage
+                       collected since it was looked up
+        @param stored: chunks written to a pack by this run
+        """
+        with self._lock:
+            with self._conn:
+                self._conn.execute('BEGIN IMMEDIATE')
+                self._conn.executemany('INSERT OR IGNORE INTO ref VALUES (?, ?, ?)',
+                                       [(recipe, chunk_id, pack) for chunk_id, pack in [*reused, *stored]])
+                unique = set(reused)
+                found = 0
+                for chunk_id, pack in unique:
+                    found += self._conn.execute('SELECT count(*) FROM chunk WHERE id=? AND pack=?',
+                                                (chunk_id, pack)).fetchone()[0]
+                if found != len(unique):
+                    raise ChunkStoreError(f'{len(unique) - found} chunks were garbage collected while {recipe} '
+                                          f'was written')
+
+    def commit_recipe(self, pending: str, path: str) -> None:
+        """
+        Make a written recipe the recipe at path, releasing the references of the recipe it replaces.
+        """
+        with self._lock:
+            with self._conn:
+                self._conn.execute('BEGIN IMMEDIATE')
+                self._conn.execute('DELETE FROM ref WHERE recipe=?', (path,))
+                self._conn.execute('DELETE FROM recipe WHERE path=?', (path,))
+                self._conn.execute('UPDATE ref SET recipe=? WHERE recipe=?', (path, pending))
+                self._conn.execute('UPDATE recipe SET path=?, complete=1 WHERE path=?', (path, pending))
+
+    def forget_recipe(self, path: str) -> None:
+        """
+        Release the references of a recipe - its chunks can be garbage collected if no other recipe uses them.
+        """
+        with self._lock:
+            with self._conn:
+                self._conn.execute('BEGIN IMMEDIATE')
+                self._conn.execute('DELETE FROM ref WHERE recipe=?', (path,))
+                self._conn.execute('DELETE FROM recipe WHERE path=?', (path,))
+
+    def unreferenced_packs(self, grace_period_seconds: float) -> list[tuple[str, int]]:
+        """
+        The packs collect_garbage() would drop, not counting the recipes it would release: [(pack, size)].
+        """
+        cutoff = time.time() - grace_period_seconds
+        with self._lock:
+            return self._conn.execute(_UNREFERENCED_PACKS, (cutoff,)).fetchall()
+
+    def collect_garbage(self, grace_period_seconds: float) -> list[tuple[str, int]]:
+        """
+        Drop the packs that no recipe references from the index and return them: [(pack, size)]. The caller
+        deletes them from the archive.
+
+        Recipes that were never committed - their archive run failed or was lost - are released once they are
+        older than grace_period_seconds. Packs younger than that are kept.
+        """
+        cutoff = time.time() - grace_period_seconds
+        with self._lock:
+            with self._conn:
+                self._conn.execute('BEGIN IMMEDIATE')
+                self._conn.execute('DELETE FROM ref WHERE recipe IN '
+                                   '(SELECT path FROM recipe WHERE complete=0 AND created_at < ?)', (cutoff,))
+                self._conn.execute('DELETE FROM recipe WHERE complete=0 AND created_at < ?', (cutoff,))
+                packs = self._conn.execute(_UNREFERENCED_PACKS, (cutoff,)).fetchall()
+                for path, _ in packs:
+                    self._conn.execute('DELETE FROM chunk WHERE pack=?', (path,))
+                    self._conn.execute('DELETE FROM pack WHERE path=?', (path,))
+        return packs
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+_index: ChunkIndex | None = None
+_index_lock = threading.Lock()
+
+
+def check_index_host() -> None:
+    """
+    Raise ChunkStoreError unless this is the node of the chunk index (config['archive']['chunks']['index_host']).
+    Any node is, if it is None - for single-node deployments.
+    """
+    index_host = config['archive']['chunks']['index_host']
+    if index_host is not None and index_host not in (socket.gethostname(), socket.getfqdn()):
+        raise ChunkStoreError(f'the chunk index is on {index_host}, not on {socket.getfqdn()} - archiving in mode '
+                              f'chunks, deleting chunked datasets and garbage collection run on {index_host}')
+
+
+def get_index() -> ChunkIndex:
+    """
+    Process-wide chunk index configured in config['archive']['chunks']['index']. Raises ChunkStoreError on
+    any node but its index_host.
+    """
+    global _index
+    check_index_host()
+    with _index_lock:
+        if _index is None:
+            _index = ChunkIndex(config['archive']['chunks']['index'])
+    return _index
+
+
+class Chunker:
+    def __init__(self, min_size: int, avg_size: int, max_size: int):
+        """
+        Content-defined chunking of a stream of 512 byte aligned data (see the module docstring).
+        Feed the stream to push() and call finish() at its end; both return the chunks that are complete.
+        """
+        if min_size % tarfile.BLOCKSIZE or max_size % tarfile.BLOCKSIZE or not 0 < min_size <= avg_size <= max_size:
+            raise ValueError('chunk sizes must be multiples of 512 with min_size <= avg_size <= max_size')
+        self.min_size = min_size
+        self.max_size = max_size
+        bits = round(math.log2(max((avg_size - min_size) / tarfile.BLOCKSIZE, 1)))
+        self.mask = (1 << bits) - 1
+        self._buffer = bytearray()
+        # position up to which the buffer has been searched for a cut
+        self._scanned = 0
+
+    def _cut(self) -> int | None:
+        buffer = memoryview(self._buffer)
+        end = min(len(buffer), self.max_size)
+        position = max(self._scanned, self.min_size)
+        crc32, mask, block = zlib.crc32, self.mask, tarfile.BLOCKSIZE
+        while position + block <= end:
+            position += block
+            if crc32(buffer[position - block:position]) & mask == 0:
+                return position
+        if end == self.max_size:
+            return self.max_size
+        self._scanned = position
+        return None
+
+    def push(self, data) -> list[bytes]:
+        self._buffer += data
+        chunks = []
+        while len(self._buffer) >= self.min_size and (cut := self._cut()) is not None:
+            chunks.append(bytes(self._buffer[:cut]))
+            del self._buffer[:cut]
+            self._scanned = 0
+        return chunks
+
+    def finish(self) -> list[bytes]:
+        chunks = self.push(b'')
+        if self._buffer:
+            chunks.append(bytes(self._buffer))
+            self._buffer = bytearray()
+        return chunks
+
+
+class ChunkWriter:
+    def __init__(self, recipe_path: str, work_dir: Path, index: ChunkIndex = None):
+        """
+        Sink for a tar stream that stores it in the chunk store (config['archive']['chunks']) as the recipe at
+        recipe_path (an archive path, see recipe_archive_path()).
+
+        New chunks are collected in pack files in work_dir; a full pack is uploaded while the next one fills.
+        Use as a context manager: leaving the context uploads the last pack and the recipe. If the body raises,
+        nothing is committed.
+        """
+        chunks_config = config['archive']['chunks']
+        self.recipe_path = recipe_path
+        self.work_dir = work_dir
+        self.index = index or get_index()
+        self.pack_size = chunks_config['pack_size']
+        self.store = chunks_config['store']
+        self.chunker = Chunker(chunks_config['min_size'], chunks_config['avg_size'], chunks_config['max_size'])
+        self.size = 0
+        self.num_chunks = 0
+        # bytes of new chunks, uploaded to the store
+        self.stored_size = 0
+
+        self._pending_recipe = self.index.begin_recipe(recipe_path)
+        self._recipe_file = work_dir / Path(recipe_path).name
+        self._recipe = gzip.open(self._recipe_file, 'wt', encoding='utf-8')
+        # chunks stored by this run: id -> (pack, offset, size)
+        self._stored = {}
+        self._reused_refs, self._stored_refs = [], []
+        self._pack = None
+        self._uploader = ThreadPoolExecutor(max_workers=1)
+        self._upload = None
+
+    def _open_pack(self) -> None:
+        name = f'{uuid.uuid4().hex}.pack'
+        self._pack = {
+            'path': f'{self.store}/packs/{name}',
+            'local_path': self.work_dir / name,
+            'chunks': [],
+            'size': 0,
+        }
+        self._pack['file'] = open(self._pack['local_path'], 'wb')
+
+    def _close_pack(self) -> None:
+        pack, self._pack = self._pack, None
+        pack['file'].close()
+        self._wait_for_upload()
+        self._upload = self._uploader.submit(self._upload_pack, pack)
+
+    def _upload_pack(self, pack: dict) -> None:
+        wf_utils.archive(local_file_path=pack['local_path'], archive_path=pack['path'])
+        self.index.add_pack(pack['path'], pack['size'], pack['chunks'])
+        pack['local_path'].unlink()
+
+    def _wait_for_upload(self) -> None:
+        if self._upload is not None:
+            upload, self._upload = self._upload, None
+            upload.result()
+
+    def _add_chunk(self, chunk: bytes) -> None:
+        chunk_id = hashlib.sha256(chunk).hexdigest()
+        location = self._stored.get(chunk_id)
+        if location is not None:
+            self._stored_refs.append((chunk_id, location[0]))
+        elif (location := self.index.lookup(chunk_id)) is not None:
+            self._reused_refs.append((chunk_id, location[0]))
+        else:
+            if self._pack is None:
+                self._open_pack()
+            location = (self._pack['path'], self._pack['size'], len(chunk))
+            self._pack['file'].write(chunk)
+            self._pack['chunks'].append((chunk_id, self._pack['size'], len(chunk)))
+            self._pack['size'] += len(chunk)
+            self._stored[chunk_id] = location
+            self._stored_refs.append((chunk_id, location[0]))
+            self.stored_size += len(chunk)
+            if self._pack['size'] >= self.pack_size:
+                self._close_pack()
+
+        pack, offset, size = location
+        self._recipe.write(json.dumps({'id': chunk_id, 'pack': pack, 'offset': offset, 'size': size}) + '\n')
+        self.size += size
+        self.num_chunks += 1
+        if len(self._reused_refs) + len(self._stored_refs) >= _REF_BATCH_SIZE:
+            self._flush_refs()
+
+    def _flush_refs(self) -> None:
+        self.index.add_refs(self._pending_recipe, self._reused_refs, self._stored_refs)
+        self._reused_refs, self._stored_refs = [], []
+
+    def write(self, data) -> int:
+        for chunk in self.chunker.push(data):
+            self._add_chunk(chunk)
+        return len(data)
+
+    def close(self) -> None:
+        """
+        Store the last chunks, upload the recipe and make it the recipe at recipe_path.
+        """
+        for chunk in self.chunker.finish():
+            self._add_chunk(chunk)
+        if self._pack is not None:
+            self._close_pack()
+        self._wait_for_upload()
+        self._uploader.shutdown()
+        self._flush_refs()
+        self._recipe.write(json.dumps({'size': self.size, 'chunks': self.num_chunks}) + '\n')
+        self._recipe.close()
+
+        wf_utils.archive(local_file_path=self._recipe_file, archive_path=self.recipe_path)
+        self._recipe_file.unlink()
+        self.index.commit_recipe(self._pending_recipe, self.recipe_path)
+        logger.info(f'stored {self.size} bytes as {self.num_chunks} chunks at {self.recipe_path}; '
+                    f'{self.stored_size} bytes were new')
+
+    def abort(self) -> None:
+        self._recipe.close()
+        self._recipe_file.unlink(missing_ok=True)
+        if self._pack is not None:
+            self._pack['file'].close()
+            self._pack['local_path'].unlink(missing_ok=True)
+        self._uploader.shutdown(wait=True)
+        # packs that were uploaded are left to garbage collection
+        self.index.forget_recipe(self._pending_recipe)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+
+def read_recipe(path: Path | str) -> tuple[list[dict], int]:
+    """
+    Chunks of a recipe file, in order, and the size of the bundle it describes.
+    """
+    chunks = []
+    size = None
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            record = json.loads(line)
+            if 'id' in record:
+                chunks.append(record)
+            else:
+                size = record['size']
+    if size is None or size != sum(chunk['size'] for chunk in chunks):
+        raise ChunkStoreError(f'{path} is incomplete')
+    return chunks, size
+
+
+def _restore_pack(pack: str, chunks: list[tuple[int, int, int, str]], local_file: Path) -> int:
+    """
+    Read the chunks [(offset in pack, size, offset in bundle, id)] of one pack, in a single forward pass over
+    it, into local_file. Returns the number of bytes written.
+    """
+    written = 0
+    with wf_utils.open_archive_reader(pack) as stream, open(local_file, 'r+b') as out:
+        position = 0
+        data, data_offset = b'', None
+        for offset, size, bundle_offset, chunk_id in sorted(chunks):
+            if offset != data_offset:
+                if offset < position:
+                    raise ChunkStoreError(f'{pack}: overlapping chunks')
+                if stream.seekable():
+                    stream.seek(offset - position, os.SEEK_CUR)
+                else:
+                    remaining = offset - position
+                    while remaining > 0:
+                        skipped = len(stream.read(min(remaining, 16 * 1024 * 1024)))
+                        if skipped == 0:
+                            raise ChunkStoreError(f'unexpected end of {pack}')
+                        remaining -= skipped
+                data, data_offset = stream.read(size), offset
+                position = offset + len(data)
+                if len(data) != size or hashlib.sha256(data).hexdigest() != chunk_id:
+                    raise ChunkStoreError(f'chunk {chunk_id} in {pack} is corrupt')
+            # a chunk that repeats within the bundle is read once and written at every position
+            out.seek(bundle_offset)
+            out.write(data)
+            written += size
+    return written
+
+
+def restore(recipe_path: str,
+            local_file: Path,
+            ranges: list[tuple[int, int]] = None,
+            celery_task=None) -> int:
+    """
+    Rebuild the bundle described by the recipe at recipe_path (an archive path) into local_file. Every chunk is
+    verified against its SHA-256. Packs are read by config['sda']['parallel_transfers'] concurrent transfers.
+
+    @param ranges: only restore the chunks that overlap these [start, end) byte ranges of the bundle - e.g. the
+                   members stage_files() needs. The rest of local_file is left as a hole.
+    @return: size of the bundle
+    """
+    local_file.parent.mkdir(parents=True, exist_ok=True)
+    local_recipe = local_file.with_name(f'{local_file.name}{RECIPE_SUFFIX}')
+    wf_utils.stage(archive_path=recipe_path, local_file_path=local_recipe)
+    try:
+        chunks, size = read_recipe(local_recipe)
+    finally:
+        local_recipe.unlink(missing_ok=True)
+
+    by_pack = {}
+    bundle_offset = 0
+    for chunk in chunks:
+        start, end = bundle_offset, bundle_offset + chunk['size']
+        if ranges is None or any(range_start < end and start < range_end for range_start, range_end in ranges):
+            by_pack.setdefault(chunk['pack'], []).append((chunk['offset'], chunk['size'], start, chunk['id']))
+        bundle_offset = end
+
+    local_file.unlink(missing_ok=True)
+    with open(local_file, 'wb'):
+        pass
+    os.truncate(local_file, size)
+
+    progress = Progress(celery_task=celery_task, name='restore', total=size, units='bytes')
+    restored = 0
+    for written in parallel_map(lambda item: _restore_pack(item[0], item[1], local_file), by_pack.items(),
+                                num_workers=config['sda']['parallel_transfers']):
+        restored += written
+        progress.update(restored)
+    return size
+
+
+def forget_recipe(recipe_path: str) -> None:
+    get_index().forget_recipe(recipe_path)
+
+
+def collect_garbage(dry_run: bool = False) -> list[tuple[str, int]]:
+    """
+    Delete the packs no recipe references from the archive. Returns the packs: [(path, size)].
+    """
+    index = get_index()
+    grace_period_seconds = config['archive']['chunks']['grace_period_seconds']
+    if dry_run:
+        return index.unreferenced_packs(grace_period_seconds)
+
+    packs = index.collect_garbage(grace_period_seconds)
+    for path, _ in packs:
+        wf_utils.delete_from_archive(path)
+    return packs
@@ -4,9 +4,11 @@ import logging
 import os
 import socket
 import subprocess
+import tempfile
 import time
 from collections import namedtuple
 from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from email.message import EmailMessage
 from pathlib import Path
 from queue import Queue
@@ -169,6 +171,33 @@ def tar(tar_path: Path | str, source_dir: Path | str) -> None:
     execute(command)
 
 
+@contextmanager
+def tar_stream(source_dir: Path | str):
+    """
+    Run tar with the same options as tar() but write the archive to a pipe.
+    Yields the readable binary stream; raises SubprocessError on exit if tar failed.
+    """
+    command = ['tar', 'cf', '-', '--sparse', '-C', str(source_dir), '.']
+    with tempfile.TemporaryFile() as stderr:
+        p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr)
+        try:
+            yield p.stdout
+        except BaseException:
+            p.kill()
+            raise
+        finally:
+            p.stdout.close()
+            p.wait()
+        if p.returncode != 0:
+            stderr.seek(0)
+            raise SubprocessError({
+                'return_code': p.returncode,
+                'stdout': None,
+                'stderr': stderr.read().decode('utf-8', errors='replace'),
+                'args': command,
+            })
+
+
 def fastqc_parallel(fastq_files: list[Path | str], output_dir: Path | str, num_threads: int = 8) -> None:
     """
     Run the FastQC tool to check the quality of all fastq files
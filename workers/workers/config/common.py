@@ -24,6 +24,7 @@ ALIAS_SALT = os.environ['ALIAS_SALT']
 
 ONE_HOUR = 60 * 60
 ONE_GIGABYTE = 1024 * 1024 * 1024
+ONE_TERABYTE = 1024 * ONE_GIGABYTE
 FIVE_MINUTES = 5 * 60
 
 config = {
@@ -73,17 +74,98 @@ config = {
         'recency_threshold_seconds': ONE_HOUR,
         'minimum_dataset_size': ONE_GIGABYTE,
         'wait_between_stability_checks_seconds': FIVE_MINUTES,
+        # reschedule: every stability check is a task that scans the dataset once and, while it is not stable,
+        #   sends itself again to run after the wait - the worker runs other tasks in between
+        # sleep: one task checks the dataset until it is stable, sleeping in the worker between checks. Needed to
+        #   follow change events (change_source backends other than poll)
+        'stability_checks': 'reschedule',
         'poll_interval_seconds': 10,
-        'full_scan_every_n_scans': 90  # every 90th scan will be a full scan / full scan every 15 minutes
+        'full_scan_every_n_scans': 90,  # a full scan every 90 poll intervals / 15 minutes at poll_interval_seconds
+        # datasets known to be registered, which the watch service does not send to the API again - keep it on a
+        # node-local disk. See workers/dataset_index.py
+        'dataset_index': {
+            'enabled': True,
+            'path': '/path/to/dataset_index.sqlite3',
+            # replace the index with the datasets in the API this often
+            'sync_interval_seconds': 6 * ONE_HOUR,
+        },
+        # watch service poller - see workers/services/watchlib.py
+        'poller': {
+            'workers': 8,
+            # a source directory listing still running after this long counts as a failed scan
+            'scan_timeout_seconds': 300,
+            # idle source directories are polled up to max_interval_factor times less often
+            'backoff': 1.5,
+            'max_interval_factor': 6,
+            # how often the scan durations are sent to the API as metrics
+            'metrics_interval_seconds': 300,
+        },
+        # how await_stability learns about changes to a dataset - see workers/change_sources.py
+        'change_source': {
+            # poll | inotify | lustre_changelog
+            'backend': 'poll',
+            'poll': {
+                # threads listing directories and stat-ing their entries
+                'workers': 8,
+            },
+            'lustre': {
+                # MDT whose changelog is followed, with a registered changelog user
+                'mdt': 'lustre-MDT0000',
+                'poll_interval_seconds': 10,
+            },
+        },
     },
     'service_user': 'bioloopuser',
     'stage': {
+        # bundle: download the bundle, verify it, then extract it - the bundle stays available for download
+        # stream: verify and extract the bundle in one pass as it is read from the archive, without a local copy
+        'mode': 'bundle',
+        # stage from a copy of the bundle that is still on local disk when its MD5 matches, instead of
+        # downloading it from the archive - see stage.find_local_bundle
+        'local_bundles': True,
+        # parallel tar extraction - see workers/tarextract.py
+        'extract': {
+            # threads writing files and restoring their attributes
+            'workers': 8,
+            # larger files are written by the thread reading the bundle
+            'max_buffered_size': 8 * 1024 * 1024,
+            # extract with read permission for others, which setup_download would grant otherwise
+            'readable_by_others': True,
+        },
+        # staged datasets are kept as a cache of the archive - see workers/staging_cache.py
+        'cache': {
+            # bytes of staged datasets and staged bundles per dataset type
+            'budget': {
+                'RAW_DATA': 20 * ONE_TERABYTE,
+                'DATA_PRODUCT': 10 * ONE_TERABYTE,
+            },
+            # purge_staged_datasets evicts the least recently used datasets of a type once they take more than
+            # high_watermark * budget, until they take at most low_watermark * budget
+            'high_watermark': 0.9,
+            'low_watermark': 0.75,
+            # datasets accessed more recently than this are not evicted
+            'min_idle_seconds': ONE_HOUR,
+        },
         'purge': {
-            'days_to_live': 20,
-            'max_purges': 10
+            # evictions per run of purge_staged_datasets
+            'max_purges': 10,
         },
         'alias_salt': ALIAS_SALT
     },
+    'download': {
+        # threads granting read permission on the staged files, in setup_download
+        'permission_workers': 16,
+    },
+    'validate': {
+        # tier of validate_dataset in workflows whose validate step does not set one (kwargs: {'tier': ...})
+        # size: existence and size of every file | sample: and the MD5s of a random sample | full: every MD5
+        'tier': 'full',
+        'sample': {
+            # probability that the sample has a corrupt file if at least defect_rate of the files are corrupt
+            'confidence': 0.99,
+            'defect_rate': 0.001,
+        },
+    },
     'workflow_registry': {
         'stage': {
             'steps': [
@@ -92,8 +174,12 @@ config = {
                     'task': 'stage_dataset'
                 },
                 {
+                    # stage verifies the bundle checksum and the MD5 of every file it extracts
                     'name': 'validate',
-                    'task': 'validate_dataset'
+                    'task': 'validate_dataset',
+                    'kwargs': {
+                        'tier': 'sample'
+                    }
                 },
                 {
                     'name': 'setup_download',
@@ -128,6 +214,31 @@ config = {
                     'task': 'setup_dataset_download'
                 }
             ]
+        },
+        # integrated, with inspect and archive fused into one step that reads the dataset once
+        'integrated_single_read': {
+            'steps': [
+                {
+                    'name': 'await stability',
+                    'task': 'await_stability'
+                },
+                {
+                    'name': 'inspect and archive',
+                    'task': 'inspect_and_archive_dataset'
+                },
+                {
+                    'name': 'stage',
+                    'task': 'stage_dataset'
+                },
+                {
+                    'name': 'validate',
+                    'task': 'validate_dataset'
+                },
+                {
+                    'name': 'setup_download',
+                    'task': 'setup_dataset_download'
+                }
+            ]
         }
     },
     'celery': {
@@ -151,8 +262,66 @@ config = {
             'max_purge_count': 10
         }
     },
+    'hashing': {
+        # buffered | mmap | direct (O_DIRECT) - see workers/hashing.py and scripts/benchmark_hashing.py
+        'mode': 'buffered',
+        'block_size': 16 * 1024 * 1024,
+    },
+    'digest_ledger': {
+        # cache of file digests keyed by (device, inode, size, mtime, ctime) - keep it on a node-local disk
+        'enabled': True,
+        'path': '/path/to/digest_ledger.sqlite3',
+    },
+    'archive': {
+        # tar | stream | diskless | chunks - see workers/tasks/archive.py
+        'mode': 'stream',
+        # tar | tar.zst (seekable zstd, needs mode stream or diskless) - see workers/seekable_zstd.py
+        'format': 'tar',
+        # archive a member index (path, offset, size, md5) next to every bundle, for partial staging
+        'index': True,
+        'zstd': {
+            'level': 3,
+            # uncompressed bytes per independently decodable frame
+            'frame_size': 64 * 1024 * 1024,
+            # frames compressed / decompressed concurrently
+            'threads': 8,
+        },
+        # content-defined chunk store for archive mode 'chunks' - see workers/chunkstore.py
+        'chunks': {
+            # archive directory of the packs, shared by all dataset types so overlapping datasets share chunks
+            'store': 'development/chunks',
+            # node-local chunk index
+            'index': '/path/to/chunk_index.sqlite3',
+            # hostname of the node with the chunk index - chunked archiving, deletion and garbage collection only
+            # run there (see workers/chunkstore.py). None: any node, for single-node deployments
+            'index_host': 'archive-node.example.edu',
+            # chunk sizes, multiples of 512
+            'min_size': 1024 * 1024,
+            'avg_size': 4 * 1024 * 1024,
+            'max_size': 16 * 1024 * 1024,
+            'pack_size': ONE_GIGABYTE,
+            # chunks of archive runs that did not finish are kept this long before garbage collection
+            'grace_period_seconds': 2 * 24 * ONE_HOUR,
+        },
+    },
+    'sda': {
+        # bundles larger than this are stored on SDA in parts of this size (see workers/multipart.py); a retried
+        # transfer only moves the parts that did not complete. None: every bundle is one file, moved by one hsi.
+        # Opt-in: it changes how bundles are laid out on SDA, e.g. 8 * ONE_GIGABYTE
+        'part_size': None,
+        # parts transferred concurrently, each by its own hsi session
+        'parallel_transfers': 4,
+    },
     'inspect': {
-        'file_metadata_batch_size': 25000
+        'file_metadata_batch_size': 25000,
+        # batches of file metadata waiting to be posted to the API while hashing continues
+        'max_pending_batches': 2,
+        # files stored by a previous attempt are fetched from the API in pages of this size
+        'stored_files_page_size': 10000,
+        # number of files of a dataset that are read and hashed concurrently
+        'checksum_workers': 8,
+        # count the entries with a fast pre-pass (directory listings only) to report progress totals
+        'count_entries': True,
     },
     'enabled_features': {
         'notifications': False,
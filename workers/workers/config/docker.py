@@ -42,6 +42,20 @@ config = {
         'recency_threshold_seconds': 300,
         'wait_between_stability_checks_seconds': 5,  # poll frequently in docker dev
         'minimum_dataset_size': TEN_MEGABYTES,
+        'dataset_index': {
+            'path': '/opt/sca/data/scratch/dataset_index.sqlite3',
+        },
+    },
+    'digest_ledger': {
+        'path': '/opt/sca/data/scratch/digest_ledger.sqlite3',
+    },
+    'archive': {
+        'chunks': {
+            'store': '/opt/sca/data/archive/chunks',
+            'index': '/opt/sca/data/scratch/chunk_index.sqlite3',
+            # a single worker container
+            'index_host': None,
+        },
     },
     'register_ondemand': {
         'RAW_DATA': {
@@ -7,8 +7,16 @@ import workers.workflow_utils as wf_utils
 from workers import api
 from workers.config import config
 
-# Single place to change if the bundle format ever moves away from tar.
-_BUNDLE_EXTENSION = '.tar'
+# Bundle format -> file extension. The extension is the format marker: the format of an archived bundle is
+# read back from its name, so changing config['archive']['format'] only affects bundles created afterwards.
+BUNDLE_EXTENSIONS = {
+    'tar': '.tar',
+    # tar compressed as seekable zstd - see workers/seekable_zstd.py
+    'tar.zst': '.tar.zst',
+}
+
+# sidecar member index archived next to every bundle - see workers/bundle_index.py
+BUNDLE_INDEX_SUFFIX = '.index.jsonl.gz'
 
 
 def deterministic_uuid(input_string: str) -> str:
@@ -39,11 +47,26 @@ def compute_staging_path(dataset: dict) -> tuple[Path, str]:
     return staging_dir / alias / dataset['name'], alias
 
 
+def get_bundle_format(dataset: dict) -> str:
+    """Format of the dataset's bundle: taken from the name of its bundle if it has been archived,
+    config['archive']['format'] otherwise."""
+    bundle_name = glom(dataset, 'bundle.name', default=None)
+    if bundle_name:
+        for bundle_format, extension in BUNDLE_EXTENSIONS.items():
+            if bundle_name.endswith(extension):
+                return bundle_format
+    return config['archive'].get('format', 'tar')
+
+
+def _bundle_extension(dataset: dict) -> str:
+    return BUNDLE_EXTENSIONS[get_bundle_format(dataset)]
+
+
 def get_archive_path(dataset: dict) -> str:
     """Full path where archive_dataset stores the generated bundle.
 
     Formula (mirrors workers/tasks/archive.py):
-        get_archive_dir(type) / {name}{_BUNDLE_EXTENSION}
+        get_archive_dir(type) / {name}{bundle extension}
     """
     archive_dir = wf_utils.get_archive_dir(dataset['type'], create=False)
     return f'{archive_dir}/{get_archive_bundle_name(dataset)}'
@@ -54,7 +77,17 @@ def get_archive_bundle_name(dataset: dict) -> str:
 
     Distinct from get_bundle_name() which is the staged copy's filename.
     """
-    return f"{dataset['name']}{_BUNDLE_EXTENSION}"
+    return f"{dataset['name']}{_bundle_extension(dataset)}"
+
+
+def get_bundle_index_name(dataset: dict) -> str:
+    """Filename of the bundle's member index, stored next to the bundle in the archive."""
+    return f"{get_archive_bundle_name(dataset)}{BUNDLE_INDEX_SUFFIX}"
+
+
+def get_bundle_index_archive_path(dataset: dict) -> str:
+    """Archive location of the bundle's member index: next to the archived bundle (dataset['archive_path'])."""
+    return f"{dataset['archive_path'].rsplit('/', 1)[0]}/{get_bundle_index_name(dataset)}"
 
 
 def get_bundle_staged_path(dataset: dict) -> str:
@@ -63,8 +96,8 @@ def get_bundle_staged_path(dataset: dict) -> str:
 
 
 def get_bundle_name(dataset: dict) -> str:
-    """Filename of the staged bundle: {name}.{type}{_BUNDLE_EXTENSION}"""
-    return f"{dataset['name']}.{dataset['type']}{_BUNDLE_EXTENSION}"
+    """Filename of the staged bundle: {name}.{type}{bundle extension}"""
+    return f"{dataset['name']}.{dataset['type']}{_bundle_extension(dataset)}"
 
 
 def get_dataset_download_path(dataset: dict) -> Path:
@@ -0,0 +1,126 @@
+"""
+Dataset Index - node-local record of the datasets the watcher has registered
+
+The watch service hands every directory of a source directory to Register when it starts and on every full
+scan. Without a record of what is already registered, each of those is a bulk create request for datasets the
+API already has, answered with "conflicted".
+
+The index is a SQLite database of (type, name, origin_path) of the datasets that exist in the API. Register
+only sends the candidates whose (type, name) - the API's uniqueness key - is not in the index, and adds the
+created and conflicted ones to it. The names are also held in memory, so filtering a full scan costs no query.
+
+The index is synced from the API (all datasets of a type that are not deleted) when it is older than
+sync_interval_seconds, so datasets deleted in the API, or registered by other means, are picked up. It is
+configured in config['registration']['dataset_index']; if it is disabled or can not be opened, every candidate
+is sent to the API.
+"""
+from __future__ import annotations
+
+import logging
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from workers.config import config
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS dataset (
+    type        TEXT NOT NULL,
+    name        TEXT NOT NULL,
+    origin_path TEXT,
+    PRIMARY KEY (type, name)
+);
+CREATE TABLE IF NOT EXISTS sync (
+    type      TEXT PRIMARY KEY,
+    synced_at REAL NOT NULL
+);
+"""
+
+
+class DatasetIndex:
+    def __init__(self, db_path: Path | str):
+        """
+        Open (and create if missing) the index database at db_path and load the indexed names.
+
+        A single connection is shared by all threads of the process and guarded by a lock.
+        """
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.db_path), timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.executescript(_SCHEMA)
+        self._names: dict[str, set[str]] = {}
+        for dataset_type, name in self._conn.execute('SELECT type, name FROM dataset'):
+            self._names.setdefault(dataset_type, set()).add(name)
+
+    def contains(self, dataset_type: str, name: str) -> bool:
+        with self._lock:
+            return name in self._names.get(dataset_type, ())
+
+    def add(self, datasets: list[dict]) -> None:
+        """
+        Index datasets - dicts with 'type', 'name' and optionally 'origin_path'.
+        """
+        rows = [(d['type'], d['name'], d.get('origin_path')) for d in datasets]
+        if not rows:
+            return
+        with self._lock:
+            with self._conn:
+                self._conn.execute('BEGIN IMMEDIATE')
+                self._conn.executemany('INSERT OR REPLACE INTO dataset VALUES (?, ?, ?)', rows)
+            for dataset_type, name, _ in rows:
+                self._names.setdefault(dataset_type, set()).add(name)
+
+    def replace(self, dataset_type: str, datasets: list[dict]) -> None:
+        """
+        Make datasets the indexed datasets of dataset_type and record the time of the sync.
+        """
+        rows = [(dataset_type, d['name'], d.get('origin_path')) for d in datasets]
+        with self._lock:
+            with self._conn:
+                self._conn.execute('BEGIN IMMEDIATE')
+                self._conn.execute('DELETE FROM dataset WHERE type=?', (dataset_type,))
+                self._conn.executemany('INSERT OR REPLACE INTO dataset VALUES (?, ?, ?)', rows)
+                self._conn.execute('INSERT OR REPLACE INTO sync VALUES (?, ?)', (dataset_type, time.time()))
+            self._names[dataset_type] = set(name for _, name, _ in rows)
+
+    def synced_at(self, dataset_type: str) -> float | None:
+        with self._lock:
+            row = self._conn.execute('SELECT synced_at FROM sync WHERE type=?', (dataset_type,)).fetchone()
+        return row[0] if row else None
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+_index: DatasetIndex | None = None
+_index_lock = threading.Lock()
+_index_unavailable = False
+
+
+def get_index() -> DatasetIndex | None:
+    """
+    Process-wide index configured in config['registration']['dataset_index'], or None if it is disabled or can
+    not be opened.
+    """
+    global _index, _index_unavailable
+    if _index is not None or _index_unavailable:
+        return _index
+    with _index_lock:
+        if _index is None and not _index_unavailable:
+            index_config = config['registration'].get('dataset_index', {})
+            if not index_config.get('enabled'):
+                _index_unavailable = True
+            else:
+                try:
+                    _index = DatasetIndex(index_config['path'])
+                except (OSError, sqlite3.Error) as e:
+                    logger.warning(f'dataset index at {index_config["path"]} is unavailable, '
+                                   f'every candidate will be sent to the API: {e}')
+                    _index_unavailable = True
+    return _index
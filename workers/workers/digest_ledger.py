@@ -0,0 +1,245 @@
+"""
+Digest Ledger - node-local cache of file digests
+
+The same bytes are hashed by several stages: upload verification (BLAKE3), inspection (MD5), the SDA upload
+preflight check (MD5) and validation (MD5). When a stage is retried, or a dataset is re-inspected, all of
+that work is repeated even though the files have not changed.
+
+The ledger is a SQLite database that remembers every digest computed for a file, keyed by
+(st_dev, st_ino, st_size, st_mtime_ns, st_ctime_ns). Any write, truncate, rename-over, chmod or touch changes
+at least one of these fields, so an unchanged key means unchanged content and the lookup only costs a stat.
+
+Use file_digest() / file_digests() instead of hashing a file directly. The ledger is configured in
+config['digest_ledger']; it should live on a node-local disk, not on a parallel file system. If it is disabled
+or can not be opened, files are hashed every time.
+"""
+from __future__ import annotations
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from workers import hashing
+from workers.config import config
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS file_digest (
+    dev         INTEGER NOT NULL,
+    ino         INTEGER NOT NULL,
+    size        INTEGER NOT NULL,
+    mtime_ns    INTEGER NOT NULL,
+    ctime_ns    INTEGER NOT NULL,
+    algorithm   TEXT    NOT NULL,
+    digest      TEXT    NOT NULL,
+    recorded_at REAL    NOT NULL,
+    PRIMARY KEY (dev, ino, size, mtime_ns, ctime_ns, algorithm)
+)
+"""
+
+
+def make_key(st: os.stat_result) -> tuple[int, int, int, int, int]:
+    return st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns
+
+
+class DigestLedger:
+    def __init__(self, db_path: Path | str):
+        """
+        Open (and create if missing) the ledger database at db_path.
+
+        A single connection is shared by all threads of the process and guarded by a lock.
+        WAL mode and a busy timeout let several worker processes on the same node use the same file.
+        """
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.db_path), timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(_SCHEMA)
+
+    def lookup(self, key: tuple, algorithms: list[str]) -> dict[str, str]:
+        """
+        Return {algorithm: digest} for the requested algorithms that are recorded for key.
+        """
+        placeholders = ','.join('?' * len(algorithms))
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT algorithm, digest FROM file_digest '
+                'WHERE dev=? AND ino=? AND size=? AND mtime_ns=? AND ctime_ns=? '
+                f'AND algorithm IN ({placeholders})',
+                (*key, *algorithms)
+            ).fetchall()
+        return dict(rows)
+
+    def record(self, key: tuple, digests: dict[str, str]) -> None:
+        """
+        Record the digests of a file version. Rows of older versions of the same inode are dropped,
+        which keeps the ledger at one version per file.
+        """
+        now = time.time()
+        dev, ino = key[0], key[1]
+        with self._lock:
+            with self._conn:
+                self._conn.execute('BEGIN IMMEDIATE')
+                self._conn.execute(
+                    'DELETE FROM file_digest WHERE dev=? AND ino=? '
+                    'AND (size, mtime_ns, ctime_ns) != (?, ?, ?)',
+                    (dev, ino, *key[2:])
+                )
+                self._conn.executemany(
+                    'INSERT OR REPLACE INTO file_digest VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    [(*key, algorithm, digest, now) for algorithm, digest in digests.items()]
+                )
+
+    def record_many(self, records: list[tuple[tuple, dict[str, str]]]) -> None:
+        """
+        record() for many files - [(key, digests)] - in a single transaction.
+        """
+        now = time.time()
+        with self._lock:
+            with self._conn:
+                self._conn.execute('BEGIN IMMEDIATE')
+                for key, digests in records:
+                    self._conn.execute(
+                        'DELETE FROM file_digest WHERE dev=? AND ino=? '
+                        'AND (size, mtime_ns, ctime_ns) != (?, ?, ?)',
+                        (key[0], key[1], *key[2:])
+                    )
+                    self._conn.executemany(
+                        'INSERT OR REPLACE INTO file_digest VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                        [(*key, algorithm, digest, now) for algorithm, digest in digests.items()]
+                    )
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+_ledger: DigestLedger | None = None
+_ledger_lock = threading.Lock()
+_ledger_unavailable = False
+
+
+def get_ledger() -> DigestLedger | None:
+    """
+    Process-wide ledger configured in config['digest_ledger'], or None if it is disabled or can not be opened.
+    """
+    global _ledger, _ledger_unavailable
+    if _ledger is not None or _ledger_unavailable:
+        return _ledger
+    with _ledger_lock:
+        if _ledger is None and not _ledger_unavailable:
+            ledger_config = config.get('digest_ledger', {})
+            if not ledger_config.get('enabled'):
+                _ledger_unavailable = True
+            else:
+                try:
+                    _ledger = DigestLedger(ledger_config['path'])
+                except (OSError, sqlite3.Error) as e:
+                    logger.warning(f'digest ledger at {ledger_config["path"]} is unavailable, '
+                                   f'digests will not be cached: {e}')
+                    _ledger_unavailable = True
+    return _ledger
+
+
+def record_digests(path: Path | str,
+                   digests: dict[str, str],
+                   st: os.stat_result = None,
+                   ledger: DigestLedger = None) -> None:
+    """
+    Record digests that were computed outside of file_digests() - e.g. a bundle hashed as it was streamed to
+    disk, or files hashed while they were copied into a tar stream - so that later stages find them without
+    reading the file.
+
+    @param st: os.stat result of path taken before the digests were computed; if the file has changed since,
+               nothing is recorded
+    """
+    ledger = ledger or get_ledger()
+    if ledger is None:
+        return
+    key = make_key(os.stat(path))
+    if st is not None and make_key(st) != key:
+        return
+    try:
+        ledger.record(key, digests)
+    except sqlite3.Error as e:
+        logger.warning(f'unable to record digests of {path} in the digest ledger: {e}')
+
+
+def record_all_digests(digests: dict[Path | str, dict[str, str]],
+                       ledger: DigestLedger = None,
+                       batch_size: int = 10000) -> None:
+    """
+    record_digests() for many files - {path: digests} - in transactions of batch_size files. The files are
+    recorded as they are now; record them right after the digests are computed.
+    """
+    ledger = ledger or get_ledger()
+    if ledger is None:
+        return
+    batch = []
+    try:
+        for path, path_digests in digests.items():
+            batch.append((make_key(os.stat(path)), path_digests))
+            if len(batch) >= batch_size:
+                ledger.record_many(batch)
+                batch = []
+        if batch:
+            ledger.record_many(batch)
+    except sqlite3.Error as e:
+        logger.warning(f'unable to record digests in the digest ledger: {e}')
+
+
+def file_digests(path: Path | str,
+                 algorithms: list[str],
+                 st: os.stat_result = None,
+                 ledger: DigestLedger = None) -> dict[str, str]:
+    """
+    Return {algorithm: hex digest} of the file at path for every requested algorithm.
+
+    Digests the ledger already has for the current version of the file are not recomputed; all the
+    missing ones are computed together in a single read of the file and recorded.
+
+    @param path: file to hash (symlinks are followed)
+    @param algorithms: 'md5', 'blake3' or any other hashlib algorithm names
+    @param st: os.stat result of path if the caller already has it
+    @param ledger: ledger to use instead of the configured one
+    """
+    ledger = ledger or get_ledger()
+    if ledger is None:
+        return hashing.hash_file(path, algorithms)
+
+    key = make_key(st or os.stat(path))
+    try:
+        digests = ledger.lookup(key, algorithms)
+    except sqlite3.Error as e:
+        logger.warning(f'digest ledger lookup failed for {path}: {e}')
+        digests = {}
+
+    missing = [algorithm for algorithm in algorithms if algorithm not in digests]
+    if missing:
+        computed = hashing.hash_file(path, missing)
+        digests.update(computed)
+
+        # only record the digests if the file did not change while it was being read
+        if make_key(os.stat(path)) == key:
+            try:
+                ledger.record(key, computed)
+            except sqlite3.Error as e:
+                logger.warning(f'unable to record digests of {path} in the digest ledger: {e}')
+    return digests
+
+
+def file_digest(path: Path | str,
+                algorithm: str = 'md5',
+                st: os.stat_result = None,
+                ledger: DigestLedger = None) -> str:
+    """
+    Return the hex digest of the file at path, reading its contents only if the ledger has no digest
+    for the current version of the file. See file_digests().
+    """
+    return file_digests(path, [algorithm], st=st, ledger=ledger)[algorithm]
@@ -0,0 +1,282 @@
+"""
+Multi-digest file hashing
+
+Different stages need different digests of the same files: MD5 for dataset file metadata and bundles,
+BLAKE3 for upload manifest verification, SHA-256 for anything that needs a cryptographic digest.
+MultiHasher feeds every buffer it is given to one hash object per requested algorithm, so any set of
+digests costs a single read of the file.
+
+BLAKE3 requires the 'blake3' package; every other algorithm name is resolved by hashlib.
+
+I/O modes (config['hashing']['mode']):
+- buffered: readinto() a preallocated, per-thread buffer of block_size bytes; no per-chunk allocation
+- mmap:     map the file and hash block_size slices of the mapping. Only for data at rest - a file that is
+            truncated while it is mapped kills the process with SIGBUS.
+- direct:   O_DIRECT reads into a page-aligned buffer, bypassing the page cache. Falls back to buffered
+            reads on file systems that do not support O_DIRECT.
+
+In every mode the kernel is told the file is read sequentially and only once (posix_fadvise SEQUENTIAL /
+NOREUSE), and its pages are dropped from the cache afterwards so that hashing terabytes of data does not
+evict everything else from memory.
+
+Use benchmark() (or python -m workers.scripts.benchmark_hashing) to find the best mode and block size for a
+file system.
+"""
+from __future__ import annotations
+
+import hashlib
+import mmap
+import os
+import threading
+import time
+from pathlib import Path
+
+# 16 MB blocks - optimal for Lustre HPFS (>4 MB minimum, 10–32 MB ideal)
+DEFAULT_BLOCK_SIZE = 16 * 1024 * 1024
+MODES = ('buffered', 'mmap', 'direct')
+
+_thread_local = threading.local()
+
+
+def new_hasher(algorithm: str):
+    if algorithm == 'blake3':
+        import blake3
+        return blake3.blake3()
+    return hashlib.new(algorithm)
+
+
+class MultiHasher:
+    def __init__(self, algorithms: list[str]):
+        """
+        Compute several digests of the same byte stream.
+
+        :param algorithms: digest algorithm names, e.g. ['md5', 'blake3', 'sha256']
+        """
+        if not algorithms:
+            raise ValueError('at least one algorithm is required')
+        self.hashers = {algorithm: new_hasher(algorithm) for algorithm in dict.fromkeys(algorithms)}
+
+    def update(self, data) -> None:
+        for hasher in self.hashers.values():
+            hasher.update(data)
+
+    def hexdigests(self) -> dict[str, str]:
+        return {algorithm: hasher.hexdigest() for algorithm, hasher in self.hashers.items()}
+
+
+def _settings() -> dict:
+    # imported here because workers.config imports workers.utils, which hashes through this module
+    from workers.config import config
+    return config.get('hashing', {})
+
+
+def default_block_size() -> int:
+    return _settings().get('block_size', DEFAULT_BLOCK_SIZE)
+
+
+def _buffer(block_size: int) -> memoryview:
+    """
+    Page-aligned buffer of block_size bytes, reused by every call on the same thread.
+    Anonymous mmaps are page-aligned, which O_DIRECT requires.
+    """
+    buf = getattr(_thread_local, 'buffer', None)
+    if buf is None or len(buf) != block_size:
+        buf = mmap.mmap(-1, block_size)
+        _thread_local.buffer = buf
+    return memoryview(buf)
+
+
+def _fadvise(fd: int, *advice: str) -> None:
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    for name in advice:
+        try:
+            os.posix_fadvise(fd, 0, 0, getattr(os, name))
+        except OSError:
+            pass
+
+
+def _read_buffered(fd: int, hasher: MultiHasher, block_size: int) -> None:
+    view = _buffer(block_size)
+    while n := os.readv(fd, [view]):
+        hasher.update(view[:n])
+
+
+def _read_mmap(fd: int, hasher: MultiHasher, block_size: int) -> None:
+    size = os.fstat(fd).st_size
+    if size == 0:
+        # empty files can not be mapped
+        return
+    with mmap.mmap(fd, size, access=mmap.ACCESS_READ) as m:
+        if hasattr(m, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+            m.madvise(mmap.MADV_SEQUENTIAL)
+        view = memoryview(m)
+        try:
+            for offset in range(0, size, block_size):
+                hasher.update(view[offset:offset + block_size])
+        finally:
+            view.release()
+
+
+def _open_direct(path: Path | str) -> int | None:
+    if not hasattr(os, 'O_DIRECT'):
+        return None
+    try:
+        return os.open(path, os.O_RDONLY | os.O_DIRECT)
+    except OSError:
+        # EINVAL - the file system does not support O_DIRECT
+        return None
+
+
+def hash_file(path: Path | str,
+              algorithms: list[str],
+              mode: str = None,
+              block_size: int = None) -> dict[str, str]:
+    """
+    Read the file once and return {algorithm: hex digest} for every requested algorithm.
+
+    @param path: file to hash
+    @param algorithms: digest algorithm names
+    @param mode: one of MODES; default config['hashing']['mode'] or 'buffered'
+    @param block_size: bytes per read; default config['hashing']['block_size'] or DEFAULT_BLOCK_SIZE.
+                       Must be a multiple of the page size in direct mode.
+    """
+    settings = _settings()
+    mode = mode or settings.get('mode', 'buffered')
+    block_size = block_size or default_block_size()
+    if mode not in MODES:
+        raise ValueError(f'unknown hashing mode {mode}; expected one of {MODES}')
+
+    hasher = MultiHasher(algorithms)
+
+    fd = _open_direct(path) if mode == 'direct' else None
+    if fd is None:
+        fd = os.open(path, os.O_RDONLY)
+        if mode == 'direct':
+            mode = 'buffered'
+    try:
+        _fadvise(fd, 'POSIX_FADV_SEQUENTIAL', 'POSIX_FADV_NOREUSE')
+        try:
+            if mode == 'mmap':
+                _read_mmap(fd, hasher, block_size)
+            else:
+                _read_buffered(fd, hasher, block_size)
+        except OSError:
+            if mode != 'direct':
+                raise
+            # some file systems accept O_DIRECT on open but reject unaligned reads; start over buffered
+            buffered_fd = os.open(path, os.O_RDONLY)
+            os.close(fd)
+            fd = buffered_fd
+            hasher = MultiHasher(algorithms)
+            _read_buffered(fd, hasher, block_size)
+        _fadvise(fd, 'POSIX_FADV_DONTNEED')
+    finally:
+        os.close(fd)
+    return hasher.hexdigests()
+
+
+def copy_stream(src,
+                sinks: list = (),
+                algorithms: list[str] = ('md5',),
+                block_size: int = None,
+                on_progress=None) -> tuple[int, dict[str, str]]:
+    """
+    Read the binary stream src to the end, writing every block to each of the sinks and hashing it on the way.
+    Lets a stream (e.g. the stdout of tar) be hashed while it is written, instead of being read back later.
+
+    @param src: binary file object supporting readinto (a pipe, socket or file)
+    @param sinks: writable binary file objects
+    @param algorithms: digest algorithm names
+    @param block_size: bytes per read; default config['hashing']['block_size'] or DEFAULT_BLOCK_SIZE
+    @param on_progress: called with the number of bytes copied so far after every block
+    @return: number of bytes copied, {algorithm: hex digest}
+    """
+    block_size = block_size or default_block_size()
+    hasher = MultiHasher(list(algorithms))
+    view = _buffer(block_size)
+    copied = 0
+    while n := src.readinto(view):
+        chunk = view[:n]
+        hasher.update(chunk)
+        for sink in sinks:
+            sink.write(chunk)
+        copied += n
+        if on_progress is not None:
+            on_progress(copied)
+    return copied, hasher.hexdigests()
+
+
+class HashingReader:
+    def __init__(self, src, algorithms: list[str] = ('md5',), on_progress=None):
+        """
+        Readable binary stream over src that hashes every byte read through it - for consumers that read a
+        stream themselves (e.g. tarfile extracting it) when the digest of the stream is needed too.
+
+        @param src: readable binary stream
+        @param on_progress: called with the number of bytes read so far after every read
+        """
+        self.src = src
+        self.hasher = MultiHasher(list(algorithms))
+        self.on_progress = on_progress
+        self.size = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.src.read(size)
+        self.hasher.update(data)
+        self.size += len(data)
+        if self.on_progress is not None and data:
+            self.on_progress(self.size)
+        return data
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return False
+
+    def drain(self, block_size: int = None) -> None:
+        """
+        Read (and hash) the rest of the stream.
+        """
+        block_size = block_size or default_block_size()
+        while self.read(block_size):
+            pass
+
+    def hexdigests(self) -> dict[str, str]:
+        """
+        Digests of the bytes read so far (call drain() first for the digests of the whole stream).
+        """
+        return self.hasher.hexdigests()
+
+
+def benchmark(path: Path | str,
+              modes: list[str] = MODES,
+              block_sizes: list[int] = (1024 * 1024, 4 * 1024 * 1024, 16 * 1024 * 1024, 64 * 1024 * 1024),
+              algorithms: list[str] = ('md5',),
+              repeat: int = 2) -> list[dict]:
+    """
+    Hash the file with every combination of mode and block size and report the throughput of each,
+    fastest first. Use a file at least a few GB in size on the file system being tuned.
+
+    Pages are dropped from the cache after every read (POSIX_FADV_DONTNEED), but some file systems keep a
+    client-side cache regardless - each combination is run `repeat` times and the slowest run is reported.
+
+    returns: [{'mode': 'buffered', 'block_size': 16777216, 'seconds': 1.2, 'bytes_per_second': 1.4e9}, ...]
+    """
+    size = os.stat(path).st_size
+    results = []
+    for mode in modes:
+        for block_size in block_sizes:
+            seconds = 0.0
+            for _ in range(repeat):
+                start = time.perf_counter()
+                hash_file(path, list(algorithms), mode=mode, block_size=block_size)
+                seconds = max(seconds, time.perf_counter() - start)
+            results.append({
+                'mode': mode,
+                'block_size': block_size,
+                'seconds': seconds,
+                'bytes_per_second': size / seconds if seconds else None,
+            })
+    return sorted(results, key=lambda r: r['seconds'])
@@ -0,0 +1,301 @@
+"""
+Multi-part SDA transfers
+
+One hsi session moves a bundle at the speed of a single transfer stream, and a transfer that is interrupted
+halfway - e.g. a worker lost with task_reject_on_worker_lost - starts over from byte zero when it is retried.
+
+Bundles larger than config['sda']['part_size'] are stored on SDA as a directory of fixed-size parts next to the
+bundle's archive path:
+
+    <archive_path>.parts/00000
+    <archive_path>.parts/00001
+    ...
+    <archive_path>.parts/manifest.json     {"size": ..., "part_size": ..., "md5": ...,
+                                            "parts": [{"size": ..., "md5": ...}, ...]}
+
+The parts are transferred by several concurrent hsi sessions. The manifest is written last - a multi-part
+bundle is complete on SDA once its manifest exists. The MD5 of the whole bundle is recorded in the manifest when
+it is known, so a bundle that is already on SDA, or already on local disk, is not transferred again. Every part
+that is transferred is recorded in a journal next to the local file (<local file>.parts.jsonl), so a retried
+transfer only moves the parts that are missing.
+On download, the parts are written at their offsets into the local file, which reassembles the bundle.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import threading
+from collections.abc import Callable
+from contextlib import contextmanager
+from pathlib import Path
+from typing import NamedTuple
+
+from workers import hashing, sda, seekable_zstd
+from workers.utils import parallel_map
+
+MANIFEST_NAME = 'manifest.json'
+JOURNAL_SUFFIX = '.parts.jsonl'
+
+
+class MultipartError(Exception):
+    pass
+
+
+class Part(NamedTuple):
+    index: int
+    offset: int
+    size: int
+
+
+def parts_dir(sda_file: str) -> str:
+    return f'{sda_file}.parts'
+
+
+def part_path(sda_file: str, index: int) -> str:
+    return f'{parts_dir(sda_file)}/{index:05d}'
+
+
+def manifest_path(sda_file: str) -> str:
+    return f'{parts_dir(sda_file)}/{MANIFEST_NAME}'
+
+
+def journal_path(local_file: Path) -> Path:
+    return local_file.with_name(f'{local_file.name}{JOURNAL_SUFFIX}')
+
+
+def split(size: int, part_size: int) -> list[Part]:
+    return [Part(index, offset, min(part_size, size - offset))
+            for index, offset in enumerate(range(0, size, part_size))]
+
+
+class _Journal:
+    def __init__(self, path: Path, key: dict):
+        """
+        Append-only record of the parts of a transfer that completed: {part index: md5}.
+
+        The first line identifies the transfer (key). A journal written for another transfer - a regenerated
+        local file, a bundle that was archived again - is discarded.
+        """
+        self.path = path
+        self.completed = {}
+        self._lock = threading.Lock()
+        header = json.dumps({'key': key}, sort_keys=True)
+
+        lines = path.read_text(encoding='utf-8').splitlines() if path.exists() else []
+        if lines and lines[0] == header:
+            for line in lines[1:]:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # the last line of a journal whose worker was lost while writing it
+                    break
+                self.completed[record['index']] = record['md5']
+            self._file = open(path, 'a', encoding='utf-8')
+        else:
+            self._file = open(path, 'w', encoding='utf-8')
+            self._file.write(header + '\n')
+            self._file.flush()
+
+    def record(self, index: int, md5: str) -> None:
+        with self._lock:
+            self._file.write(json.dumps({'index': index, 'md5': md5}) + '\n')
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self) -> None:
+        self._file.close()
+
+    def remove(self) -> None:
+        self.close()
+        self.path.unlink(missing_ok=True)
+
+
+def read_manifest(sda_file: str) -> dict | None:
+    """
+    Manifest of the multi-part bundle stored at sda_file, or None if sda_file is not stored in parts (or its parts
+    are incomplete).
+    """
+    path = manifest_path(sda_file)
+    if not sda.exists(path):
+        return None
+    with sda.get_stream(sda_file=path) as f:
+        return json.loads(f.read())
+
+
+def _put_part(local_file: Path, part: Part, sda_path: str, block_size: int, verify_checksum: bool = True) -> str:
+    hasher = hashlib.md5()
+    with open(local_file, 'rb') as f, sda.put_stream(sda_file=sda_path, verify_checksum=verify_checksum) as out:
+        f.seek(part.offset)
+        remaining = part.size
+        while remaining > 0:
+            data = f.read(min(block_size, remaining))
+            if not data:
+                raise MultipartError(f'{local_file} changed while it was uploaded')
+            hasher.update(data)
+            out.write(data)
+            remaining -= len(data)
+    return hasher.hexdigest()
+
+
+def put(local_file: Path,
+        sda_file: str,
+        part_size: int,
+        parallel_transfers: int = 4,
+        on_part: Callable[[Part], None] = None,
+        verify_checksum: bool = True,
+        md5: str = None) -> None:
+    """
+    Upload local_file to SDA as parts of part_size bytes, parallel_transfers parts at a time.
+
+    Parts recorded in the journal of an earlier attempt that are still on SDA (with the recorded MD5, if
+    verify_checksum) are not uploaded again.
+
+    @param on_part: called on the calling thread with every part once it is on SDA, skipped parts included
+    @param verify_checksum: have SDA compute the MD5 of every part and check it against the MD5 of the bytes
+                            that were sent
+    @param md5: MD5 of local_file, recorded in the manifest
+    """
+    st = local_file.stat()
+    parts = split(st.st_size, part_size)
+    block_size = hashing.default_block_size()
+
+    # until the new manifest is written, the bundle is incomplete on SDA
+    previous = read_manifest(sda_file)
+    if previous is not None:
+        sda.delete(manifest_path(sda_file))
+        for index in range(len(parts), len(previous['parts'])):
+            sda.delete(part_path(sda_file, index))
+    sda.ensure_directory(parts_dir(sda_file))
+
+    journal = _Journal(journal_path(local_file),
+                       key={'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'part_size': part_size})
+
+    def upload(part: Part) -> str:
+        path = part_path(sda_file, part.index)
+        part_md5 = journal.completed.get(part.index)
+        if part_md5 is not None:
+            if verify_checksum and sda.get_hash(path, missing_ok=True) == part_md5:
+                return part_md5
+            if not verify_checksum and sda.exists(path):
+                return part_md5
+        part_md5 = _put_part(local_file, part, path, block_size, verify_checksum=verify_checksum)
+        if verify_checksum:
+            sda_md5 = sda.get_hash(path)
+            if sda_md5 != part_md5:
+                raise MultipartError(f'checksum of {path} on SDA is {sda_md5}, expected {part_md5}')
+        journal.record(part.index, part_md5)
+        return part_md5
+
+    try:
+        manifest_parts = []
+        for part, part_md5 in zip(parts, parallel_map(upload, parts, num_workers=parallel_transfers)):
+            manifest_parts.append({'size': part.size, 'md5': part_md5})
+            if on_part is not None:
+                on_part(part)
+
+        manifest = {'size': st.st_size, 'part_size': part_size, 'md5': md5, 'parts': manifest_parts}
+        with sda.put_stream(sda_file=manifest_path(sda_file)) as out:
+            out.write(json.dumps(manifest).encode('utf-8'))
+    except BaseException:
+        journal.close()
+        raise
+    journal.remove()
+
+
+def _get_part(sda_path: str, local_file: Path, part: Part, block_size: int) -> str:
+    hasher = hashlib.md5()
+    received = 0
+    with sda.get_stream(sda_file=sda_path) as stream, open(local_file, 'r+b') as f:
+        f.seek(part.offset)
+        while data := stream.read(block_size):
+            hasher.update(data)
+            f.write(data)
+            received += len(data)
+        f.flush()
+        # a part is recorded in the journal only once its bytes are on disk
+        os.fsync(f.fileno())
+    if received != part.size:
+        raise MultipartError(f'{sda_path} has {received} bytes, expected {part.size}')
+    return hasher.hexdigest()
+
+
+def get(sda_file: str,
+        local_file: Path,
+        manifest: dict,
+        parallel_transfers: int = 4,
+        on_part: Callable[[Part], None] = None,
+        verify_checksum: bool = True) -> None:
+    """
+    Download the multi-part bundle sda_file into local_file, parallel_transfers parts at a time.
+
+    Parts recorded in the journal of an earlier attempt are not downloaded again.
+
+    @param manifest: from read_manifest()
+    @param on_part: called on the calling thread with every part once it is on disk, skipped parts included
+    @param verify_checksum: check every part against the MD5 in the manifest
+    """
+    parts = split(manifest['size'], manifest['part_size'])
+    block_size = hashing.default_block_size()
+
+    local_file.parent.mkdir(parents=True, exist_ok=True)
+    if not local_file.exists():
+        # nothing to resume
+        journal_path(local_file).unlink(missing_ok=True)
+    journal = _Journal(journal_path(local_file), key=manifest)
+    if not journal.completed:
+        local_file.unlink(missing_ok=True)
+    with open(local_file, 'ab'):
+        pass
+    os.truncate(local_file, manifest['size'])
+
+    def download(part: Part) -> Part:
+        if part.index not in journal.completed:
+            path = part_path(sda_file, part.index)
+            md5 = _get_part(path, local_file, part, block_size)
+            expected = manifest['parts'][part.index]['md5']
+            if verify_checksum and md5 != expected:
+                raise MultipartError(f'checksum of {path} is {md5}, expected {expected}')
+            journal.record(part.index, md5)
+        return part
+
+    try:
+        for part in parallel_map(download, parts, num_workers=parallel_transfers):
+            if on_part is not None:
+                on_part(part)
+    except BaseException:
+        journal.close()
+        raise
+    journal.remove()
+
+
+@contextmanager
+def open_reader(sda_file: str, manifest: dict):
+    """
+    Readable, forward-only binary stream of the multi-part bundle sda_file - its parts read one after another.
+    """
+    block_size = hashing.default_block_size()
+
+    def chunks():
+        for part in split(manifest['size'], manifest['part_size']):
+            with sda.get_stream(sda_file=part_path(sda_file, part.index)) as f:
+                while data := f.read(block_size):
+                    yield data
+
+    it = chunks()
+    try:
+        yield seekable_zstd.ChunkStream(it)
+    finally:
+        # stops the hsi session of the current part if the caller did not read to the end
+        it.close()
+
+
+def delete(sda_file: str) -> None:
+    """
+    Delete the parts of sda_file, if there are any - those of an interrupted upload without a manifest included.
+    """
+    if not sda.exists(parts_dir(sda_file)):
+        return
+    # the bundle is incomplete once its manifest is gone
+    sda.delete(manifest_path(sda_file))
+    sda.delete_recursive(parts_dir(sda_file))
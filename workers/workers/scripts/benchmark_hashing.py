@@ -0,0 +1,43 @@
+import logging
+
+import fire
+
+from workers import hashing
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+MEGABYTE = 1024 * 1024
+
+
+def benchmark(path, modes=hashing.MODES, block_sizes_mb=(1, 4, 16, 64), algorithms=('md5',), repeat=2):
+    """
+    Measure file hashing throughput for every I/O mode and block size and recommend the
+    config['hashing'] settings for the file system that path is on.
+
+    :param path: a large file (a few GB) on the file system to tune
+    :param modes: I/O modes to try (buffered, mmap, direct)
+    :param block_sizes_mb: read sizes to try, in MiB
+    :param algorithms: digest algorithms to compute while reading
+    :param repeat: runs per combination; the slowest run is reported
+
+    example usage:
+
+    python -m workers.scripts.benchmark_hashing /N/scratch/bioloop/large_file.tar --block_sizes_mb='[8,16,32]'
+    """
+    results = hashing.benchmark(path,
+                                modes=list(modes),
+                                block_sizes=[int(mb * MEGABYTE) for mb in block_sizes_mb],
+                                algorithms=list(algorithms),
+                                repeat=repeat)
+    for r in results:
+        logger.info(f"mode={r['mode']:<8} block_size={r['block_size'] // MEGABYTE:>4} MiB "
+                    f"time={r['seconds']:8.2f}s throughput={(r['bytes_per_second'] or 0) / MEGABYTE:10.1f} MiB/s")
+
+    best = results[0]
+    logger.info(f"recommended config: 'hashing': {{'mode': '{best['mode']}', 'block_size': {best['block_size']}}}")
+    return best
+
+
+if __name__ == '__main__':
+    fire.Fire(benchmark)
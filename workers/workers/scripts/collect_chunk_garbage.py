@@ -0,0 +1,36 @@
+import logging
+
+import fire
+
+from workers import chunkstore
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+GIGABYTE = 1024 * 1024 * 1024
+
+
+def collect_chunk_garbage(dry_run=False):
+    """
+    Delete the packs of the chunk store (archive mode 'chunks') that no archived dataset references any more.
+
+    Datasets deleted by delete_dataset release their chunks; the packs that hold only released chunks are
+    deleted from the archive by this script. It runs on the node of the chunk index
+    (config['archive']['chunks']['index_host']). See workers/chunkstore.py.
+
+    :param dry_run: only list the packs that would be deleted
+
+    example usage:
+
+    python -m workers.scripts.collect_chunk_garbage --dry_run
+    """
+    packs = chunkstore.collect_garbage(dry_run=dry_run)
+    for path, size in packs:
+        logger.info(f'{"would delete" if dry_run else "deleted"} {path} ({size} bytes)')
+    total = sum(size for _, size in packs)
+    logger.info(f'{"would free" if dry_run else "freed"} {total / GIGABYTE:.2f} GiB in {len(packs)} packs')
+    return len(packs)
+
+
+if __name__ == '__main__':
+    fire.Fire(collect_chunk_garbage)
@@ -3,43 +3,55 @@ import shutil
 from pathlib import Path
 
 import workers.api as api
+from workers import staging_cache
 from workers.config import config
 from workers.dataset import get_bundle_staged_path
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# sanity check. If the API accidentally returns all datasets do not blindly delete them
+# sanity check. If the API accidentally returns wrong datasets or sizes do not blindly delete them
 MAX_PURGES = config['stage']['purge']['max_purges']
 
 
-def main():
-    datasets = api.get_all_datasets(days_since_last_staged=config['stage']['purge']['days_to_live'], bundle=True)
+def purge(dataset: dict) -> None:
+    staged_path = Path(dataset['staged_path'])
+    bundle_path = Path(get_bundle_staged_path(dataset=dataset))
 
-    if len(datasets) > MAX_PURGES:
-        logger.warning(
-            f"Number of staged datasets to purge is more than {MAX_PURGES} MAX_PURGES. "
-            f"Only the first {MAX_PURGES} staged datasets will be purged")
+    # a dataset without an entry is not served from the cache while it is deleted
+    staging_cache.forget(staged_path)
+    if staged_path.exists():
+        shutil.rmtree(staged_path)
+    if bundle_path.exists():
+        bundle_path.unlink()
 
     update_data = {
         'is_staged': False,
         'staged_path': None
     }
-    for dataset in datasets[:MAX_PURGES]:
-        try:
-            staged_path = Path(dataset['staged_path'])
-            bundle_path = Path(get_bundle_staged_path(dataset=dataset))
+    api.update_dataset(dataset_id=dataset['id'], update_data=update_data)
+    api.add_state_to_dataset(dataset_id=dataset['id'], state='PURGED')
 
-            if staged_path.exists():
-                shutil.rmtree(staged_path)
-            if bundle_path.exists():
-                bundle_path.unlink()
 
-            api.update_dataset(dataset_id=dataset['id'], update_data=update_data)
-            api.add_state_to_dataset(dataset_id=dataset['id'], state='PURGED')
+def main():
+    """
+    Evict the least recently used staged datasets of every dataset type whose staged datasets exceed their
+    share of config['stage']['cache'] - see workers/staging_cache.py - at most MAX_PURGES per run
+    """
+    datasets = api.get_all_datasets(staged=True, bundle=True)
+
+    evictions = staging_cache.evictions(datasets)
+    if len(evictions) > MAX_PURGES:
+        logger.warning(
+            f"Number of staged datasets to purge is more than {MAX_PURGES} MAX_PURGES. "
+            f"Only the first {MAX_PURGES} staged datasets will be purged")
 
+    for dataset in evictions[:MAX_PURGES]:
+        try:
+            purge(dataset)
             logger.info(
-                f'Purged staged dataset id:{dataset["id"]} name:{dataset["name"]} staged_path:{staged_path}')
+                f'Purged staged dataset id:{dataset["id"]} name:{dataset["name"]} '
+                f'staged_path:{dataset["staged_path"]} size:{dataset["size"]}')
 
         except Exception as e:
             logger.error(f'Error purging staged dataset #{dataset["id"]} {dataset["name"]}', exc_info=e)
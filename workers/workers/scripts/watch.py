@@ -1,5 +1,6 @@
 import fnmatch
 import logging
+import time
 from pathlib import Path
 from typing import Any
 
@@ -7,6 +8,7 @@ from sca_rhythm import Workflow
 
 import workers.api as api
 import workers.workflow_utils as wf_utils
+from workers import dataset_index
 from workers.api import DatasetAlreadyExistsError
 from workers.celery_app import app as celery_app
 from workers.config import config
@@ -44,6 +46,12 @@ class Register:
         # apply node level rules to filter out bad directories
         candidates = [p for p in new_dirs if not self.is_a_reject(p.name)]
 
+        # the directories of datasets that are already registered are not sent to the API again
+        index = dataset_index.get_index()
+        if index is not None:
+            self.sync_index(index)
+            candidates = [p for p in candidates if not index.contains(self.dataset_type, p.name)]
+
         # for candidate in candidates:
         #     try:
         #         self.register_candidate(candidate)
@@ -54,6 +62,23 @@ class Register:
         for batch in batched(candidates, n=self.batch_size):
             self.register_batch(batch)
 
+    def sync_index(self, index: dataset_index.DatasetIndex) -> None:
+        """
+        Replace the indexed datasets of this type with the ones in the API, if the index was last synced more than
+        sync_interval_seconds ago.
+        """
+        synced_at = index.synced_at(self.dataset_type)
+        sync_interval = config['registration']['dataset_index']['sync_interval_seconds']
+        if synced_at is not None and time.time() - synced_at < sync_interval:
+            return
+        try:
+            datasets = api.get_all_datasets(dataset_type=self.dataset_type)
+        except Exception as e:
+            logger.error(f'Error syncing the dataset index: {e}')
+            return
+        index.replace(self.dataset_type, datasets)
+        logger.info(f'synced the dataset index: {len(datasets)} {self.dataset_type} datasets')
+
     def register_candidate(self, candidate: Path) -> None:
         # idempotence: if dataset already exists, do nothing
         # fault tolerance:
@@ -77,9 +102,11 @@ class Register:
             dataset_payload['metadata'] = self.metadata
         try:
             created_dataset = api.create_dataset(dataset_payload)
+            self._index([dataset_payload])
             self.run_workflows(created_dataset)
         except DatasetAlreadyExistsError:
             # nothing to do if dataset already exists
+            self._index([dataset_payload])
             return
 
     def register_batch(self, candidates: list[Path]) -> None:
@@ -101,6 +128,9 @@ class Register:
             # failure point but has built in retry ability
             result = api.bulk_create_datasets(data)
             # result looks like {created: [], conflicted: [], errored: []}
+            # created and conflicted datasets exist in the API, errored ones are tried again on the next scan
+            registered = set(d['name'] for d in result['created'] + result['conflicted'])
+            self._index([payload for payload in data if payload['name'] in registered])
             # only create workflows for created datasets
             for dataset in result['created']:
                 try:
@@ -110,6 +140,11 @@ class Register:
         except Exception as e:
             logger.error(f'Error bulk creating datasets: {e}')
 
+    def _index(self, datasets: list[dict]) -> None:
+        index = dataset_index.get_index()
+        if index is not None:
+            index.add(datasets)
+
     def run_workflows(self, dataset):
         logger.info(f'Registered {self.dataset_type} {dataset["name"]}')
         dataset_id = dataset['id']
@@ -150,7 +185,15 @@ if __name__ == "__main__":
         full_scan_every_n_scans=config['registration']['full_scan_every_n_scans']
     )
 
-    poller = Poller()
+    poller_config = config['registration']['poller']
+    poller = Poller(
+        num_workers=poller_config['workers'],
+        scan_timeout=poller_config['scan_timeout_seconds'],
+        backoff=poller_config['backoff'],
+        max_interval_factor=poller_config['max_interval_factor'],
+        metrics_callback=api.send_metrics,
+        metrics_interval=poller_config['metrics_interval_seconds'],
+    )
     poller.register(obs1)
     poller.register(obs2)
     poller.poll()
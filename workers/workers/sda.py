@@ -1,5 +1,10 @@
 from __future__ import annotations
 
+import io
+import subprocess
+import tempfile
+from contextlib import contextmanager
+
 import workers.cmd as cmd
 
 
@@ -21,6 +26,38 @@ def put(local_file: str, sda_file: str, verify_checksum: bool = True):
     return cmd.execute(command)
 
 
+@contextmanager
+def put_stream(sda_file: str, verify_checksum: bool = True):
+    """
+    Transfer a stream to SDA without a local file.
+
+    Yields a writable binary stream connected to the stdin of `hsi put - : sda_file`.
+    Raises cmd.SubprocessError on exit if hsi failed. If the body raises, the transfer is aborted and the
+    partially written sda_file is removed.
+    """
+    put_cmd = 'put -c on' if verify_checksum else 'put'
+    command = ['hsi', '-P', f'{put_cmd} - : {sda_file}']
+    with tempfile.TemporaryFile() as output:
+        p = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=output, stderr=subprocess.STDOUT)
+        try:
+            yield p.stdin
+            p.stdin.close()
+        except BaseException:
+            p.kill()
+            p.wait()
+            delete(sda_file)
+            raise
+        p.wait()
+        if p.returncode != 0:
+            output.seek(0)
+            raise cmd.SubprocessError({
+                'return_code': p.returncode,
+                'stdout': output.read().decode('utf-8', errors='replace'),
+                'stderr': None,
+                'args': command,
+            })
+
+
 def get_size(sda_path: str):
     command = ['hsi', '-P', f'ls -s1 {sda_path}']
     stdout, stderr = cmd.execute(command)
@@ -46,6 +83,57 @@ def get(sda_file: str, local_file: str, verify_checksum=True):
     return cmd.execute(command)
 
 
+class _PipeReader(io.RawIOBase):
+    """
+    The stdout of a process, noting whether it has been read to its end.
+    """
+
+    def __init__(self, pipe):
+        self.pipe = pipe
+        self.at_eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = self.pipe.readinto(b)
+        if n == 0 and len(b) > 0:
+            self.at_eof = True
+        return n
+
+
+@contextmanager
+def get_stream(sda_file: str):
+    """
+    Read an SDA file as a stream, without a local copy.
+
+    Yields a readable binary stream connected to the stdout of `hsi get - : sda_file`. Leaving the context before
+    the end of the file has been read stops the transfer. Once the end has been read, or if hsi has exited,
+    raises cmd.SubprocessError on exit if hsi failed - a failed transfer can look like a short file.
+    """
+    command = ['hsi', '-P', f'get - : {sda_file}']
+    with tempfile.TemporaryFile() as errors:
+        p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=errors, bufsize=0)
+        reader = _PipeReader(p.stdout)
+        try:
+            yield io.BufferedReader(reader)
+        finally:
+            check = reader.at_eof or p.poll() is not None
+            if not check:
+                # the caller left before the end: it has what it needed
+                p.kill()
+            p.stdout.close()
+            p.wait()
+        if check and p.returncode != 0:
+            errors.seek(0)
+            raise cmd.SubprocessError({
+                'return_code': p.returncode,
+                'stdout': None,
+                'stderr': errors.read().decode('utf-8', errors='replace'),
+                'args': command,
+            })
+
+
 def get_hash(sda_path: str, missing_ok: bool = False) -> str | None:
     command = ['hsi', '-P', f'hashlist {sda_path}']
     try:
@@ -67,6 +155,24 @@ def delete(path: str) -> None:
         cmd.execute(command)
 
 
+def delete_directory(path: str) -> None:
+    """
+    Delete an empty directory.
+    """
+    if exists(path):
+        command = ['hsi', '-P', f'rmdir {path}']
+        cmd.execute(command)
+
+
+def delete_recursive(path: str) -> None:
+    """
+    Delete a directory and everything in it.
+    """
+    if exists(path):
+        command = ['hsi', '-P', f'rm -R {path}']
+        cmd.execute(command)
+
+
 def exists(path: str) -> bool:
     command = ['hsi', '-P', f'ls {path}']
     try:
@@ -0,0 +1,307 @@
+"""
+Seekable zstd - compressed bundles made of independently decodable frames
+
+The stream is split into frames of frame_size uncompressed bytes. Every frame is compressed by its own `zstd`
+process, several at a time, and the frames are written out in order. A concatenation of zstd frames is a
+valid zstd stream, so `zstd -d` / `tar --zstd` read these bundles as usual.
+
+After the last frame a seek table is appended in the zstd seekable format
+(https://github.com/facebook/zstd/blob/dev/contrib/seekable_format/zstd_seekable_compression_format.md):
+a skippable frame - ignored by regular decoders - listing the compressed and decompressed size of every frame.
+With it, a reader can decompress the frames in parallel or start at any frame.
+
+The zstd command line tool is used instead of a Python binding, so that nothing has to be added to the
+worker's dependencies.
+"""
+from __future__ import annotations
+
+import os
+import struct
+import subprocess
+import threading
+from collections import deque
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import NamedTuple
+
+from workers import hashing
+from workers.utils import parallel_map
+
+SKIPPABLE_MAGIC = 0x184D2A5E
+SEEKABLE_MAGIC = 0x8F92EAB1
+# number of frames (u32), descriptor (u8), seekable magic number (u32)
+_FOOTER = struct.Struct('<IBI')
+# compressed size (u32), decompressed size (u32)
+_ENTRY = struct.Struct('<II')
+# skippable frame magic number (u32), frame size (u32)
+_SKIPPABLE_HEADER = struct.Struct('<II')
+
+# the seek table stores sizes as u32
+MAX_FRAME_SIZE = 2 ** 32 - 1
+
+
+class SeekableZstdError(Exception):
+    pass
+
+
+class Frame(NamedTuple):
+    # offset of the frame in the compressed file
+    offset: int
+    compressed_size: int
+    decompressed_size: int
+
+
+def _compress(data: bytes, level: int) -> bytes:
+    proc = subprocess.run(['zstd', f'-{level}', '-q', '-c', '-'], input=data, capture_output=True)
+    if proc.returncode != 0:
+        raise SeekableZstdError(f'zstd failed: {proc.stderr.decode(errors="replace")}')
+    return proc.stdout
+
+
+def decompress(data: bytes) -> bytes:
+    proc = subprocess.run(['zstd', '-d', '-q', '-c', '-'], input=data, capture_output=True)
+    if proc.returncode != 0:
+        raise SeekableZstdError(f'zstd failed: {proc.stderr.decode(errors="replace")}')
+    return proc.stdout
+
+
+@contextmanager
+def decompressing_reader(src, block_size: int = None):
+    """
+    Readable binary stream of the decompressed contents of the zstd stream src - for a compressed bundle that
+    can only be read forward, e.g. from `hsi get`, where the seek table at its end is out of reach.
+
+    src is fed to `zstd -d` on a background thread and is always read to its end, also when the caller stops
+    reading early.
+    """
+    block_size = block_size or hashing.default_block_size()
+    p = subprocess.Popen(['zstd', '-d', '-q', '-c', '-'], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE)
+    errors = []
+
+    def feed():
+        try:
+            while data := src.read(block_size):
+                p.stdin.write(data)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            try:
+                p.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+    try:
+        yield p.stdout
+        # let zstd finish the stream so the feeder reads src to its end
+        while p.stdout.read(block_size):
+            pass
+    except BaseException:
+        p.kill()
+        raise
+    finally:
+        feeder.join()
+        p.stdout.close()
+        stderr = p.stderr.read()
+        p.stderr.close()
+        p.wait()
+    if errors:
+        raise errors[0]
+    if p.returncode != 0:
+        raise SeekableZstdError(f'zstd failed: {stderr.decode(errors="replace")}')
+
+
+class SeekableZstdWriter:
+    def __init__(self, sink, level: int = 3, frame_size: int = 64 * 1024 * 1024, threads: int = 8,
+                 algorithms: list[str] = ('md5',)):
+        """
+        Compress everything written to this object into sink as seekable zstd.
+
+        At most `threads` frames are compressed at a time and at most 2 * threads frames (uncompressed and
+        compressed) are held in memory.
+
+        :param sink: writable binary stream that receives the compressed bytes
+        :param level: zstd compression level
+        :param frame_size: uncompressed bytes per frame
+        :param threads: number of frames compressed concurrently
+        :param algorithms: digests computed over the compressed output - see hexdigests()
+
+        Call close() - or use as a context manager - to write the seek table once all data is written.
+        """
+        if not 0 < frame_size <= MAX_FRAME_SIZE:
+            raise ValueError(f'frame_size must be between 1 and {MAX_FRAME_SIZE}')
+        self.sink = sink
+        self.level = level
+        self.frame_size = frame_size
+        self.threads = max(threads, 1)
+        self.hasher = hashing.MultiHasher(list(algorithms))
+        # compressed bytes written to sink
+        self.size = 0
+        self._buffer = bytearray()
+        # (compressed size, decompressed size) of the frames written so far
+        self.frames = []
+        self._pool = ThreadPoolExecutor(max_workers=self.threads)
+        self._pending = deque()
+        self._closed = False
+
+    def _emit(self, data: bytes) -> None:
+        self.hasher.update(data)
+        self.sink.write(data)
+        self.size += len(data)
+
+    def _submit(self, frame: bytes) -> None:
+        self._pending.append((len(frame), self._pool.submit(_compress, frame, self.level)))
+        while len(self._pending) > self.threads:
+            self._write_next_frame()
+
+    def _write_next_frame(self) -> None:
+        decompressed_size, future = self._pending.popleft()
+        compressed = future.result()
+        self.frames.append((len(compressed), decompressed_size))
+        self._emit(compressed)
+
+    def write(self, data) -> int:
+        self._buffer += data
+        while len(self._buffer) >= self.frame_size:
+            self._submit(bytes(self._buffer[:self.frame_size]))
+            del self._buffer[:self.frame_size]
+        return len(data)
+
+    def close(self) -> None:
+        """
+        Compress the last partial frame, wait for all frames to be written and append the seek table.
+        Does not close sink.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            if self._buffer:
+                self._submit(bytes(self._buffer))
+                self._buffer = bytearray()
+            while self._pending:
+                self._write_next_frame()
+        finally:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+
+        table = b''.join(_ENTRY.pack(*entry) for entry in self.frames)
+        table += _FOOTER.pack(len(self.frames), 0, SEEKABLE_MAGIC)
+        self._emit(_SKIPPABLE_HEADER.pack(SKIPPABLE_MAGIC, len(table)) + table)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            # the output is going to be discarded; do not compress the frames still queued
+            self._closed = True
+            self._pool.shutdown(wait=True, cancel_futures=True)
+        return False
+
+    def hexdigests(self) -> dict[str, str]:
+        """
+        Digests of the compressed output written so far (call after close() for the digests of the whole file).
+        """
+        return self.hasher.hexdigests()
+
+
+def read_seek_table(path: Path | str) -> list[Frame]:
+    """
+    Return the frames of a seekable zstd file, in order.
+
+    Raises SeekableZstdError if the file does not end with a seek table.
+    """
+    with open(path, 'rb') as f:
+        file_size = f.seek(0, os.SEEK_END)
+        if file_size < _SKIPPABLE_HEADER.size + _FOOTER.size:
+            raise SeekableZstdError(f'{path} is not a seekable zstd file')
+        f.seek(file_size - _FOOTER.size)
+        num_frames, descriptor, magic = _FOOTER.unpack(f.read(_FOOTER.size))
+        if magic != SEEKABLE_MAGIC:
+            raise SeekableZstdError(f'{path} is not a seekable zstd file')
+
+        # bit 7 of the descriptor: every entry is followed by a 4 byte checksum
+        entry_size = _ENTRY.size + (4 if descriptor & 0x80 else 0)
+        table_size = num_frames * entry_size + _FOOTER.size
+        if table_size + _SKIPPABLE_HEADER.size > file_size:
+            raise SeekableZstdError(f'{path} has a corrupt seek table')
+        f.seek(file_size - table_size - _SKIPPABLE_HEADER.size)
+        skippable_magic, frame_size = _SKIPPABLE_HEADER.unpack(f.read(_SKIPPABLE_HEADER.size))
+        if skippable_magic != SKIPPABLE_MAGIC or frame_size != table_size:
+            raise SeekableZstdError(f'{path} has a corrupt seek table')
+        table = f.read(num_frames * entry_size)
+
+    frames = []
+    offset = 0
+    for i in range(num_frames):
+        compressed_size, decompressed_size = _ENTRY.unpack_from(table, i * entry_size)
+        frames.append(Frame(offset, compressed_size, decompressed_size))
+        offset += compressed_size
+    return frames
+
+
+def is_seekable(path: Path | str) -> bool:
+    try:
+        read_seek_table(path)
+        return True
+    except SeekableZstdError:
+        return False
+
+
+def iter_decompressed(path: Path | str, threads: int = 8) -> Iterator[bytes]:
+    """
+    Yield the decompressed contents of a seekable zstd file frame by frame, in order, decompressing up to
+    `threads` frames concurrently.
+    """
+    frames = read_seek_table(path)
+
+    def decompress_frame(frame: Frame) -> bytes:
+        with open(path, 'rb') as f:
+            f.seek(frame.offset)
+            data = decompress(f.read(frame.compressed_size))
+        if len(data) != frame.decompressed_size:
+            raise SeekableZstdError(f'{path}: frame at offset {frame.offset} decompressed to {len(data)} bytes, '
+                                    f'expected {frame.decompressed_size}')
+        return data
+
+    yield from parallel_map(decompress_frame, frames, num_workers=threads)
+
+
+class ChunkStream:
+    def __init__(self, chunks: Iterator[bytes]):
+        """
+        Read-only, non-seekable binary stream over an iterator of byte chunks - e.g. iter_decompressed() -
+        for consumers like tarfile.open(fileobj=..., mode='r|').
+        """
+        self._chunks = chunks
+        self._current = memoryview(b'')
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return False
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            parts = [bytes(self._current), *self._chunks]
+            self._current = memoryview(b'')
+            return b''.join(parts)
+        parts = []
+        while size > 0:
+            if not self._current:
+                chunk = next(self._chunks, None)
+                if chunk is None:
+                    break
+                self._current = memoryview(chunk)
+            part = self._current[:size]
+            self._current = self._current[len(part):]
+            parts.append(part)
+            size -= len(part)
+        return b''.join(parts)
@@ -1,6 +1,8 @@
 import logging
+import socket
 import time
 from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from pathlib import Path
 from typing import Callable
 
@@ -26,7 +28,8 @@ class Observer:
         :param dir_path: Directory path to watch.
         :param callback: Callback function to call on directory changes.
         :param interval: Polling interval in seconds.
-        :param full_scan_every_n_scans: Perform a full scan every n scans. If None, no full scans will be performed.
+        :param full_scan_every_n_scans: Perform a full scan every n intervals (n * interval seconds, whatever the
+            number of scans in between). If None, no full scans will be performed.
         :param max_retries: Maximum number of retries before stopping the observer.
         """
         self.name = name
@@ -43,13 +46,15 @@ class Observer:
             'FULL_SCAN': 'full_scan'
         }
 
-    def watch(self, scan_type='incremental') -> None:
+    def watch(self, scan_type='incremental') -> bool:
         """
         Watch the directory for changes and call the callback function on changes.
+
+        :return: True if directories were added or deleted since the last call.
         """
         if not self.dir_path.exists():
             logger.warning(f'Directory {self.dir_path} does not exist. Skipping.')
-            return
+            return False
         dirs = [p for p in self.dir_path.iterdir() if p.is_dir()]
         current_directories = set(p.name for p in dirs)
         added_directories = current_directories - self.directories
@@ -64,23 +69,55 @@ class Observer:
             self.callback(self.events['FULL_SCAN'], dirs)
 
         self.directories = current_directories
+        return len(added_directories) > 0 or len(deleted_directories) > 0
 
     def __str__(self):
         return f'Observer(name={self.name}, dir_path={self.dir_path}, interval={self.interval}, full_scan_every_n_scans={self.full_scan_every_n_scans})'
 
 
 class Poller:
-    def __init__(self):
+    def __init__(self, num_workers: int = 8, scan_timeout: float = 300, backoff: float = 1.5,
+                 max_interval_factor: float = 6, metrics_callback: Callable[[list[dict]], None] = None,
+                 metrics_interval: float = 300):
         """
         Calls the registered observers at their specified intervals. Accurate intervals are not guaranteed.
         An observer will be called at most once in the interval specified by the observer.
 
+        Every call runs on a worker thread, so a slow or hung directory listing (NFS, Lustre) only delays its own
+        observer. A call still running scan_timeout seconds after it started counts as a failed call (see
+        Observer.max_retries); the observer is not called again until it returns, as a thread cannot be
+        interrupted.
+
+        Intervals adapt to activity: after a call that finds no added or deleted directories, the interval of
+        the observer grows by a factor of backoff, up to max_interval_factor * observer.interval. A call that
+        finds changes brings it back to observer.interval. Full scans are timed by the clock
+        (observer.full_scan_every_n_scans * observer.interval seconds apart), not by the number of calls, so
+        backing off does not delay them.
+
+        The duration of every call is kept in scan_stats and, with a metrics_callback, sent every
+        metrics_interval seconds (see metrics()).
+
         WARNING: This is a blocking function. It will run indefinitely.
+
+        :param num_workers: Threads calling the observers. Hung calls hold a thread each.
         """
         self.observers = dict()
         self.last_call_times = defaultdict(int)
-        self.scan_count = defaultdict(int)
+        self.last_full_scan_times = dict()
         self.retries = defaultdict(int)
+        self.intervals = dict()
+        self.scan_stats = dict()
+
+        self.scan_timeout = scan_timeout
+        self.backoff = backoff
+        self.max_interval_factor = max_interval_factor
+        self.metrics_callback = metrics_callback
+        self.metrics_interval = metrics_interval
+        self.last_metrics_time = time.time()
+
+        self.executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix='observer')
+        # observer name -> (future of the running call, start time, timed out)
+        self.running: dict[str, tuple[Future, float, bool]] = dict()
 
     def register(self, observer: Observer) -> None:
         """
@@ -91,6 +128,9 @@ class Poller:
         observer.interval = int(observer.interval)
         assert observer.interval >= 1
         self.observers[observer.name] = observer
+        self.intervals[observer.name] = observer.interval
+        self.last_full_scan_times[observer.name] = time.time()
+        self.scan_stats[observer.name] = {'scans': 0, 'timeouts': 0, 'last_seconds': None, 'max_seconds': None}
         logger.info(
             f'Registered: {observer}.'
         )
@@ -108,51 +148,160 @@ class Poller:
             return False
         self.observers.pop(name)
         self.last_call_times.pop(name, None)
-        self.scan_count.pop(name, None)
+        self.last_full_scan_times.pop(name, None)
         self.retries.pop(name, None)
+        self.intervals.pop(name, None)
+        self.scan_stats.pop(name, None)
+        self.running.pop(name, None)
         return True
 
-    def _poll(self):
+    def _on_failure(self, observer: Observer) -> None:
+        self.retries[observer.name] += 1
+        if self.retries[observer.name] >= observer.max_retries:
+            logger.error(f"Max retries reached for {observer.name}. Stopping.")
+            self.unregister(observer.name)
+
+    def _collect(self, now: float) -> None:
+        """
+        Handle the calls that returned or ran out of time.
+        """
+        for name, (future, started, timed_out) in list(self.running.items()):
+            observer = self.observers[name]
+            if not future.done():
+                if not timed_out and now - started > self.scan_timeout:
+                    logger.error(f'observer {name} has not returned in {int(now - started)}s: '
+                                 f'{observer.dir_path} is slow or hung')
+                    self.running[name] = (future, started, True)
+                    self.scan_stats[name]['timeouts'] += 1
+                    self._on_failure(observer)
+                continue
+
+            self.running.pop(name)
+            elapsed = now - started
+            stats = self.scan_stats[name]
+            stats['scans'] += 1
+            stats['last_seconds'] = elapsed
+            stats['max_seconds'] = max(stats['max_seconds'] or 0, elapsed)
+            if elapsed > observer.interval:
+                logger.warning(f'observer {name} took {elapsed:.1f}s to scan {observer.dir_path}')
+
+            try:
+                changed = future.result()
+            except Exception as e:
+                logger.error(f'exception in calling observer {name}', exc_info=e)
+                self._on_failure(observer)
+                continue
+            self.retries[name] = 0
+            # back off while the directory is idle, speed up after activity
+            if changed:
+                self.intervals[name] = observer.interval
+            else:
+                self.intervals[name] = min(self.intervals[name] * self.backoff,
+                                           observer.interval * self.max_interval_factor)
+
+    def _full_scan_time(self, observer: Observer) -> float | None:
+        """
+        When the next full scan of the observer is due, or None if it does no full scans.
+        """
+        if not observer.full_scan_every_n_scans:
+            return None
+        return self.last_full_scan_times[observer.name] + observer.full_scan_every_n_scans * observer.interval
+
+    def _due_time(self, observer: Observer) -> float:
+        due = self.last_call_times[observer.name] + self.intervals[observer.name]
+        full_scan_time = self._full_scan_time(observer)
+        return due if full_scan_time is None else min(due, full_scan_time)
+
+    def _schedule(self, now: float) -> None:
+        """
+        Start the calls of the observers that are due and not running.
+        """
         for observer in self.observers.values():
-            current_time = time.time()
-            elapsed_since_last_call = current_time - self.last_call_times[observer.name]
-            # print(observer.name, elapsed_since_last_call, observer.interval)
-            # print(observer.name, observer.full_scan_every_n_scans, self.scan_count)
-            if elapsed_since_last_call >= observer.interval:
-                self.scan_count[observer.name] = self.scan_count[observer.name] + 1
+            if observer.name in self.running:
+                continue
+            if now >= self._due_time(observer):
                 scan_type = 'incremental'
-                if observer.full_scan_every_n_scans and (
-                        self.scan_count[observer.name] >= observer.full_scan_every_n_scans
-                ):
+                full_scan_time = self._full_scan_time(observer)
+                if full_scan_time is not None and now >= full_scan_time:
                     scan_type = 'full'
-                    self.scan_count[observer.name] = 0
-                try:
-                    observer.watch(scan_type=scan_type)
-                    self.retries[observer.name] = 0
-                except KeyboardInterrupt:
-                    logger.info('KeyboardInterrupt received. Exiting.')
-                    return
-                except Exception as e:
-                    logger.error(f'exception in calling observer {observer.name}', exc_info=e)
-                    self.retries[observer.name] += 1
-                    if self.retries[observer.name] >= observer.max_retries:
-                        logger.error(f"Max retries reached for {observer.name}. Stopping.")
-                        self.unregister(observer.name)
-                        continue
-                self.last_call_times[observer.name] = int(current_time)
+                    self.last_full_scan_times[observer.name] = now
+                self.running[observer.name] = (self.executor.submit(observer.watch, scan_type=scan_type), now, False)
+                self.last_call_times[observer.name] = now
+
+    def _next_wakeup(self, now: float) -> float:
+        """
+        Seconds until an observer is due, a running call times out or metrics are due.
+        """
+        times = [self._due_time(observer) for name, observer in self.observers.items() if name not in self.running]
+        times += [started + self.scan_timeout for _, started, timed_out in self.running.values() if not timed_out]
+        if self.metrics_callback is not None:
+            times.append(self.last_metrics_time + self.metrics_interval)
+        return max(0.0, min(times, default=now + 1) - now)
+
+    def _send_metrics(self, now: float) -> None:
+        if self.metrics_callback is None or now - self.last_metrics_time < self.metrics_interval:
+            return
+        self.last_metrics_time = now
+        try:
+            self.metrics_callback(self.metrics())
+        except Exception as e:
+            logger.warning(f'unable to send the observer metrics: {e}')
+
+    def metrics(self) -> list[dict]:
+        """
+        The duration of the last call of every observer, as metrics for workers.api.send_metrics. The limit is
+        the scan timeout; a hung call reports the time it has been running.
+        """
+        now = time.time()
+        hostname = socket.getfqdn()
+        metrics = []
+        for name, stats in self.scan_stats.items():
+            seconds = stats['last_seconds']
+            if name in self.running:
+                _, started, timed_out = self.running[name]
+                if timed_out:
+                    seconds = now - started
+            if seconds is None:
+                continue
+            metrics.append({
+                'measurement': f'watch_scan_seconds:{name}',
+                'subject': hostname,
+                'usage': seconds,
+                'limit': self.scan_timeout,
+                'tags': [],
+            })
+        return metrics
+
+    def _poll(self) -> float:
+        """
+        :return: Seconds until the poller has something to do.
+        """
+        now = time.time()
+        self._collect(now)
+        self._schedule(now)
+        self._send_metrics(now)
+        return self._next_wakeup(now)
 
     def poll(self, loop=True) -> None:
         """
         Call the registered observers at their specified intervals.
+        With loop=False, call the observers that are due and wait for them to return (up to the scan timeout).
         """
 
         if loop:
             try:
                 while True:
-                    self._poll()
-                    time.sleep(1)
+                    sleep_seconds = self._poll()
+                    # wake up early when a call returns
+                    futures = [future for future, _, _ in self.running.values()]
+                    if futures:
+                        wait(futures, timeout=sleep_seconds, return_when=FIRST_COMPLETED)
+                    else:
+                        time.sleep(sleep_seconds)
             except KeyboardInterrupt:
                 logger.info('KeyboardInterrupt received. Exiting.')
                 return
         else:
             self._poll()
+            wait([future for future, _, _ in self.running.values()], timeout=self.scan_timeout)
+            self._collect(time.time())
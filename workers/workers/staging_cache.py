@@ -0,0 +1,189 @@
+"""
+Staging cache
+
+Staged datasets are kept in the staging area as a cache of the archive, within a byte budget per dataset type
+(config['stage']['cache']). purge_staged_datasets evicts the least recently used datasets of a type once its
+staged datasets take more than high_watermark * budget bytes, until they take at most low_watermark * budget.
+
+Every staged dataset has an entry next to its staging directory (<stage alias>/<name>.cache.json):
+
+    {"dataset_id": ..., "bundle_md5": ..., "size": ..., "last_access": ..., "readable_by_others": ...}
+
+The entry is written once the dataset is staged and verified, so it marks a complete copy of the bundle with
+that MD5, and it is removed before the dataset is staged again. A stage request for a dataset with a current
+entry is served from the staging area without reading the archive.
+
+The last access of a staged dataset is the latest of
+- the access recorded in its entry: staging, stage requests served from the cache and setup_download
+- the access times of its download symlinks, which the download server follows (with the relatime mount
+  option, the access time of a symlink is updated at most once a day)
+"""
+from __future__ import annotations
+
+import json
+import logging
+import os
+import time
+from pathlib import Path
+
+from glom import glom
+
+from workers.config import config
+from workers.dataset import get_bundle_download_path, get_bundle_staged_path, get_dataset_download_path
+
+logger = logging.getLogger(__name__)
+
+ENTRY_SUFFIX = '.cache.json'
+
+
+def entry_path(staging_dir: Path) -> Path:
+    return staging_dir.with_name(f'{staging_dir.name}{ENTRY_SUFFIX}')
+
+
+def read_entry(staging_dir: Path) -> dict | None:
+    try:
+        return json.loads(entry_path(staging_dir).read_text(encoding='utf-8'))
+    except FileNotFoundError:
+        return None
+    except (OSError, json.JSONDecodeError) as e:
+        logger.warning(f'unable to read the staging cache entry of {staging_dir}: {e}')
+        return None
+
+
+def _write_entry(staging_dir: Path, entry: dict) -> None:
+    path = entry_path(staging_dir)
+    tmp_path = path.with_name(f'.{path.name}.tmp')
+    tmp_path.write_text(json.dumps(entry), encoding='utf-8')
+    os.replace(tmp_path, path)
+
+
+def staged_size(dataset: dict) -> int:
+    """
+    Bytes a staged dataset takes: the size of the dataset (du_size) and of its staged bundle, if there is one.
+    """
+    bundle_path = Path(get_bundle_staged_path(dataset=dataset))
+    bundle_size = bundle_path.stat().st_size if bundle_path.exists() else 0
+    return int(dataset.get('du_size') or 0) + bundle_size
+
+
+def record(dataset: dict, staging_dir: Path, last_access: float = None, readable_by_others: bool = False) -> dict:
+    """
+    Add the dataset, staged and verified in staging_dir, to the cache.
+
+    @param readable_by_others: the staged files were extracted with read permission for others, which
+                               setup_download does not have to grant again
+    """
+    entry = {
+        'dataset_id': dataset['id'],
+        'bundle_md5': dataset['bundle']['md5'],
+        'size': staged_size(dataset),
+        'last_access': time.time() if last_access is None else last_access,
+        'readable_by_others': readable_by_others,
+    }
+    _write_entry(staging_dir, entry)
+    return entry
+
+
+def forget(staging_dir: Path) -> None:
+    entry_path(staging_dir).unlink(missing_ok=True)
+
+
+def touch(staging_dir: Path) -> None:
+    """
+    Record an access of the dataset staged in staging_dir, if it is in the cache.
+    """
+    entry = read_entry(staging_dir)
+    if entry is not None:
+        _write_entry(staging_dir, {**entry, 'last_access': time.time()})
+
+
+def lookup(dataset: dict, staging_dir: Path) -> bool:
+    """
+    Whether staging_dir holds a complete copy of the dataset's current bundle. A hit counts as an access.
+    """
+    entry = read_entry(staging_dir)
+    hit = (entry is not None
+           and entry['bundle_md5'] == glom(dataset, 'bundle.md5', default=None)
+           and staging_dir.is_dir())
+    if hit:
+        touch(staging_dir)
+    return hit
+
+
+def last_access(dataset: dict, entry: dict) -> float:
+    times = [entry['last_access']]
+    download_paths = [get_bundle_download_path(dataset)]
+    if glom(dataset, 'metadata.stage_alias', default=None):
+        download_paths.append(get_dataset_download_path(dataset))
+    for path in download_paths:
+        if path.is_symlink():
+            times.append(path.lstat().st_atime)
+    return max(times)
+
+
+def select_evictions(datasets: list[dict],
+                     budget: int,
+                     high_watermark: float,
+                     low_watermark: float,
+                     min_idle_seconds: float,
+                     now: float = None) -> list[dict]:
+    """
+    Least recently used datasets to evict so that the staged datasets of a type fit their budget.
+
+    @param datasets: the staged datasets of a type, with their 'size' and 'last_access'
+    @return: no datasets while their total size is at most high_watermark * budget; otherwise the least
+             recently used datasets whose eviction brings it to low_watermark * budget. Datasets accessed in the
+             last min_idle_seconds are not evicted, even if the budget stays exceeded
+    """
+    now = time.time() if now is None else now
+    used = sum(d['size'] for d in datasets)
+    if used <= high_watermark * budget:
+        return []
+
+    evictions = []
+    for dataset in sorted(datasets, key=lambda d: d['last_access']):
+        if used <= low_watermark * budget:
+            break
+        if now - dataset['last_access'] < min_idle_seconds:
+            break
+        evictions.append(dataset)
+        used -= dataset['size']
+    return evictions
+
+
+def cached_datasets(datasets: list[dict]) -> list[dict]:
+    """
+    The staged datasets with the 'size' and 'last_access' of their cache entry.
+
+    Datasets staged without an entry (e.g. before the staging cache existed) are added to the cache, last
+    accessed when their staging directory was last modified.
+    """
+    cached = []
+    for dataset in datasets:
+        staging_dir = Path(dataset['staged_path'])
+        if not staging_dir.exists():
+            continue
+        entry = read_entry(staging_dir)
+        if entry is None and dataset.get('bundle'):
+            entry = record(dataset, staging_dir, last_access=staging_dir.stat().st_mtime)
+        if entry is None:
+            continue
+        cached.append({**dataset, 'size': entry['size'], 'last_access': last_access(dataset, entry)})
+    return cached
+
+
+def evictions(datasets: list[dict], now: float = None) -> list[dict]:
+    """
+    The staged datasets to evict to bring every dataset type within its budget (see select_evictions).
+    Dataset types without a budget are not evicted.
+    """
+    cache_config = config['stage']['cache']
+    selected = []
+    for dataset_type, budget in cache_config['budget'].items():
+        selected += select_evictions(cached_datasets([d for d in datasets if d['type'] == dataset_type]),
+                                     budget=budget,
+                                     high_watermark=cache_config['high_watermark'],
+                                     low_watermark=cache_config['low_watermark'],
+                                     min_idle_seconds=cache_config['min_idle_seconds'],
+                                     now=now)
+    return selected
@@ -0,0 +1,192 @@
+"""
+Parallel tar extraction
+
+tarfile.extractall creates, writes, closes and sets the attributes of one member at a time. On Lustre each of
+those is a round trip to a metadata or object server, so a bundle of millions of small files (BCL run folders)
+extracts at the latency of the file system rather than at its bandwidth.
+
+extract() reads the tar stream on the calling thread and hands the regular files to a pool of writer threads:
+
+- directories are created by the reader as they are read, so a directory always exists before any member in
+  it is handed to a writer
+- files up to max_buffered_size are read into memory and written by the writers; larger files are written by
+  the reader as they are read
+- sparse members (tar --sparse) are written by the reader, seeking over their holes, so they stay sparse
+- hard links and symbolic links are created once every file is written, so the target of a hard link exists
+- ownership, modes and modification times are set in a final pass on the writer pool, directories last - the
+  same order tarfile.extractall uses, so extracting into a directory does not change its restored mtime
+
+Archives opened as a stream (mode 'r|') are supported: the member data is only read by the reader, in order.
+Every regular file is hashed from the bytes written, as hashing.copy_stream does.
+"""
+from __future__ import annotations
+
+import copy
+import logging
+import os
+import stat
+import tarfile
+from pathlib import Path
+
+from workers import hashing
+from workers.utils import parallel_map
+
+logger = logging.getLogger(__name__)
+
+
+class TarExtractError(Exception):
+    pass
+
+
+def _target_path(root: str, member: tarfile.TarInfo) -> str:
+    name = member.name.rstrip('/')
+    if os.path.isabs(name) or '..' in name.split('/'):
+        raise TarExtractError(f'{member.name} would be extracted outside of {root}')
+    return os.path.join(root, name)
+
+
+def _write(target: str, data: bytes) -> str:
+    with open(target, 'wb') as f:
+        f.write(data)
+    hasher = hashing.MultiHasher(['md5'])
+    hasher.update(data)
+    return hasher.hexdigests()['md5']
+
+
+def _copy(src, target: str, block_size: int) -> str:
+    hasher = hashing.MultiHasher(['md5'])
+    with open(target, 'wb') as f:
+        while data := src.read(block_size):
+            hasher.update(data)
+            f.write(data)
+    return hasher.hexdigests()['md5']
+
+
+def _copy_sparse(src, member: tarfile.TarInfo, target: str, block_size: int) -> str:
+    """
+    _copy() of a sparse member that writes only the data regions of its sparse map and leaves the holes
+    unallocated. The holes are hashed as the zeros they read as.
+    """
+    hasher = hashing.MultiHasher(['md5'])
+
+    def copy(size: int, f=None) -> None:
+        while size > 0:
+            data = src.read(min(size, block_size))
+            if not data:
+                raise TarExtractError(f'unexpected end of data of {member.name}')
+            hasher.update(data)
+            if f is not None:
+                f.write(data)
+            size -= len(data)
+
+    with open(target, 'wb') as f:
+        position = 0
+        for offset, numbytes in member.sparse:
+            # GNU tar ends the map with empty regions
+            if numbytes == 0:
+                continue
+            copy(offset - position)
+            f.seek(offset)
+            copy(numbytes, f)
+            position = offset + numbytes
+        copy(member.size - position)
+        f.truncate(member.size)
+    return hasher.hexdigests()['md5']
+
+
+def _set_attrs(archive: tarfile.TarFile, member: tarfile.TarInfo, target: str, readable_by_others: bool) -> None:
+    try:
+        archive.chown(member, target, numeric_owner=False)
+        if not member.issym():
+            if readable_by_others and member.mode is not None:
+                member = copy.copy(member)
+                member.mode |= stat.S_IROTH | stat.S_IXOTH if member.isdir() else stat.S_IROTH
+            archive.chmod(member, target)
+            archive.utime(member, target)
+    except tarfile.ExtractError as e:
+        # non-fatal, like in tarfile.extractall
+        if archive.errorlevel > 1:
+            raise
+        logger.debug(f'{member.name}: {e}')
+
+
+def extract(archive: tarfile.TarFile,
+            path: Path | str,
+            num_workers: int = 8,
+            max_buffered_size: int = 8 * 1024 * 1024,
+            readable_by_others: bool = False) -> dict[str, str]:
+    """
+    Extract every member of archive into path, like archive.extractall(path).
+
+    @param num_workers: writer threads; with num_workers <= 1 the members are extracted one at a time
+    @param max_buffered_size: largest file read into memory for a writer. At most 2 * num_workers files are
+                              waiting for a writer at any time
+    @param readable_by_others: restore the modes with read permission (and traverse permission on directories)
+                               for others added, so the tree does not have to be walked again to share it
+    @return: {member name: MD5} of the regular files and the hard links to them
+    """
+    root = str(path)
+    block_size = hashing.default_block_size()
+    digests = {}
+    created_dirs = {root}
+    links = []
+    attrs = []
+
+    def ensure_parent(target: str) -> None:
+        parent = os.path.dirname(target)
+        if parent not in created_dirs:
+            os.makedirs(parent, exist_ok=True)
+            created_dirs.add(parent)
+
+    def read_members():
+        for member in archive:
+            target = _target_path(root, member)
+            if member.isdir():
+                # 0o700 until the final pass - the directory has to stay writable while it is extracted into
+                os.makedirs(target, 0o700, exist_ok=True)
+                created_dirs.add(target)
+            elif member.isreg():
+                ensure_parent(target)
+                src = archive.extractfile(member)
+                if member.issparse():
+                    digests[member.name] = _copy_sparse(src, member, target, block_size)
+                elif member.size <= max_buffered_size:
+                    yield member.name, target, src.read()
+                else:
+                    digests[member.name] = _copy(src, target, block_size)
+            elif member.islnk() or member.issym():
+                links.append((member, target))
+                continue
+            else:
+                # devices and fifos
+                ensure_parent(target)
+                archive.extract(member, root, set_attrs=False)
+            attrs.append((member, target))
+
+    def write(job: tuple[str, str, bytes]) -> tuple[str, str]:
+        name, target, data = job
+        return name, _write(target, data)
+
+    for name, digest in parallel_map(write, read_members(), num_workers=num_workers):
+        digests[name] = digest
+
+    for member, target in links:
+        ensure_parent(target)
+        if member.issym():
+            os.symlink(member.linkname, target)
+        else:
+            os.link(_target_path(root, tarfile.TarInfo(member.linkname)), target)
+            if member.linkname in digests:
+                digests[member.name] = digests[member.linkname]
+            continue
+        attrs.append((member, target))
+
+    # directories last, deepest first
+    files = [(member, target) for member, target in attrs if not member.isdir()]
+    dirs = sorted(((member, target) for member, target in attrs if member.isdir()),
+                  key=lambda item: item[0].name, reverse=True)
+    for batch in (files, dirs):
+        for _ in parallel_map(lambda item: _set_attrs(archive, *item, readable_by_others=readable_by_others),
+                              batch, num_workers=num_workers):
+            pass
+    return digests
@@ -0,0 +1,261 @@
+"""
+Streaming tar writer that reads every source file exactly once
+
+GNU tar (cmd.tar / cmd.tar_stream) reads the source files to write the bundle, and inspection reads them
+again to compute per-file MD5s. TarWriter writes a tar stream from fswalk entries and hands the same bytes
+it writes for a member to the member's hashers, so per-file digests, the tar stream and the digest of the
+tar stream itself come from one read of the source.
+
+The stream is GNU format with the same member names GNU tar produces for `tar cf - -C source_dir .`
+('./', './dir/', './dir/file'), so bundles extract identically.
+
+Sparse files are read with SEEK_DATA / SEEK_HOLE: only the data regions are read and the holes are written
+out as zeros. Members are always stored as regular files - SDA has trouble with sparse tar headers, so
+none are ever produced.
+"""
+from __future__ import annotations
+
+import errno
+import grp
+import mmap
+import os
+import pwd
+import stat
+import tarfile
+from functools import lru_cache
+
+from workers import hashing
+from workers.bundle_index import IndexEntry, IndexWriter
+from workers.fswalk import Entry
+
+_TAR_TYPES = {
+    stat.S_IFDIR: tarfile.DIRTYPE,
+    stat.S_IFLNK: tarfile.SYMTYPE,
+    stat.S_IFIFO: tarfile.FIFOTYPE,
+    stat.S_IFCHR: tarfile.CHRTYPE,
+    stat.S_IFBLK: tarfile.BLKTYPE,
+}
+
+
+class TarStreamError(Exception):
+    pass
+
+
+@lru_cache(maxsize=None)
+def _uname(uid: int) -> str:
+    try:
+        return pwd.getpwuid(uid).pw_name
+    except KeyError:
+        return ''
+
+
+@lru_cache(maxsize=None)
+def _gname(gid: int) -> str:
+    try:
+        return grp.getgrgid(gid).gr_name
+    except KeyError:
+        return ''
+
+
+def _data_segments(fd: int, st: os.stat_result):
+    """
+    Yield (is_data, start, end) byte ranges covering [0, st_size). Files that are not sparse are one data range.
+    """
+    size = st.st_size
+    if size == 0:
+        return
+    if st.st_blocks * 512 >= size or not hasattr(os, 'SEEK_DATA'):
+        yield True, 0, size
+        return
+
+    offset = 0
+    while offset < size:
+        try:
+            data_start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # no more data: the rest of the file is a hole
+                data_start = size
+            elif e.errno == errno.EINVAL:
+                # the file system does not support SEEK_DATA
+                yield True, offset, size
+                return
+            else:
+                raise
+        data_start = min(data_start, size)
+        if data_start > offset:
+            yield False, offset, data_start
+        if data_start >= size:
+            return
+        data_end = min(os.lseek(fd, data_start, os.SEEK_HOLE), size)
+        yield True, data_start, data_end
+        offset = data_end
+
+
+class TarWriter:
+    def __init__(self, sink, file_algorithms: list[str] = ('md5',), stream_algorithms: list[str] = ('md5',),
+                 block_size: int = None, index: IndexWriter = None):
+        """
+        Write a tar stream to sink (a writable binary stream).
+
+        :param sink: where the tar stream is written
+        :param file_algorithms: digests computed over the contents of every regular file member
+        :param stream_algorithms: digests computed over the tar stream itself - see hexdigests()
+        :param block_size: bytes per read of a source file; default config['hashing']['block_size']
+        :param index: bundle index the members are added to (see workers/bundle_index.py)
+        """
+        self.sink = sink
+        self.file_algorithms = list(file_algorithms)
+        self.index = index
+        if index is not None and 'md5' not in self.file_algorithms:
+            self.file_algorithms.append('md5')
+        self.stream_hasher = hashing.MultiHasher(list(stream_algorithms))
+        self.size = 0
+        self._block_size = block_size or hashing.default_block_size()
+        self._buffer = memoryview(mmap.mmap(-1, self._block_size))
+        self._zeros = memoryview(bytes(self._block_size))
+        # (st_dev, st_ino) -> (arcname, digests) of regular files with more than one link
+        self._hard_links = {}
+        self._closed = False
+
+    def _write(self, data) -> None:
+        self.stream_hasher.update(data)
+        self.sink.write(data)
+        self.size += len(data)
+
+    def _header(self, arcname: str, st: os.stat_result, type_: bytes, size: int = 0, linkname: str = '') -> None:
+        info = tarfile.TarInfo(arcname)
+        info.type = type_
+        info.mode = stat.S_IMODE(st.st_mode)
+        info.uid, info.gid = st.st_uid, st.st_gid
+        info.uname, info.gname = _uname(st.st_uid), _gname(st.st_gid)
+        info.mtime = int(st.st_mtime)
+        info.size = size
+        info.linkname = linkname
+        if type_ in (tarfile.CHRTYPE, tarfile.BLKTYPE):
+            info.devmajor, info.devminor = os.major(st.st_rdev), os.minor(st.st_rdev)
+        self._write(info.tobuf(format=tarfile.GNU_FORMAT, encoding='utf-8', errors='surrogateescape'))
+
+    def add_root(self, root: str) -> None:
+        """
+        Write the './' member for the source directory itself, as GNU tar does.
+        """
+        self._header('./', os.stat(root), tarfile.DIRTYPE)
+
+    def add(self, entry: Entry) -> dict[str, str] | None:
+        """
+        Write entry as './{entry.relpath}'.
+
+        :return: {algorithm: hex digest} of the contents for regular files (and hard links to them), else None
+        """
+        arcname = f'./{entry.relpath}'
+        st = entry.stat
+        mode = stat.S_IFMT(st.st_mode)
+
+        if mode == stat.S_IFREG:
+            if st.st_nlink > 1:
+                key = (st.st_dev, st.st_ino)
+                if key in self._hard_links:
+                    target, digests = self._hard_links[key]
+                    self._header(arcname, st, tarfile.LNKTYPE, linkname=target)
+                    self._index(entry.relpath, 'hardlink', linkname=target[2:])
+                    return digests
+                digests = self._add_file(entry, arcname)
+                self._hard_links[key] = (arcname, digests)
+                return digests
+            return self._add_file(entry, arcname)
+
+        if mode == stat.S_IFSOCK:
+            # GNU tar ignores sockets too
+            return None
+        if mode not in _TAR_TYPES:
+            raise TarStreamError(f'{entry.path}: unsupported file type')
+        linkname = os.readlink(entry.path) if mode == stat.S_IFLNK else ''
+        self._header(arcname, st, _TAR_TYPES[mode], linkname=linkname)
+        if mode == stat.S_IFLNK:
+            self._index(entry.relpath, 'symlink', linkname=linkname)
+        elif mode == stat.S_IFDIR:
+            self._index(entry.relpath, 'dir', mode=stat.S_IMODE(st.st_mode), mtime=int(st.st_mtime))
+        return None
+
+    def _index(self, relpath: str, type_: str, **kwargs) -> None:
+        if self.index is not None:
+            self.index.add(IndexEntry(path=relpath, type=type_, **kwargs))
+
+    def _add_file(self, entry: Entry, arcname: str) -> dict[str, str]:
+        path, st = entry.path, entry.stat
+        file_hasher = hashing.MultiHasher(self.file_algorithms)
+        self._header(arcname, st, tarfile.REGTYPE, size=st.st_size)
+        offset = self.size
+
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            for is_data, start, end in _data_segments(fd, st):
+                if is_data:
+                    self._copy_range(fd, path, start, end, file_hasher)
+                else:
+                    self._write_zeros(end - start, file_hasher)
+            after = os.fstat(fd)
+            if (after.st_size, after.st_mtime_ns) != (st.st_size, st.st_mtime_ns):
+                # the header is already written, the member would not match it
+                raise TarStreamError(f'{path}: file changed as we read it')
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+        remainder = st.st_size % tarfile.BLOCKSIZE
+        if remainder:
+            self._write(self._zeros[:tarfile.BLOCKSIZE - remainder])
+        digests = file_hasher.hexdigests()
+        self._index(entry.relpath, 'file', offset=offset, size=st.st_size, md5=digests['md5'],
+                    mode=stat.S_IMODE(st.st_mode), mtime=int(st.st_mtime))
+        return digests
+
+    def _copy_range(self, fd: int, path: str, start: int, end: int, file_hasher: hashing.MultiHasher) -> None:
+        os.lseek(fd, start, os.SEEK_SET)
+        remaining = end - start
+        while remaining > 0:
+            view = self._buffer[:min(remaining, self._block_size)]
+            n = os.readv(fd, [view])
+            if n == 0:
+                raise TarStreamError(f'{path}: file shrank while it was being read')
+            chunk = view[:n]
+            file_hasher.update(chunk)
+            self._write(chunk)
+            remaining -= n
+
+    def _write_zeros(self, length: int, file_hasher: hashing.MultiHasher) -> None:
+        while length > 0:
+            chunk = self._zeros[:min(length, self._block_size)]
+            file_hasher.update(chunk)
+            self._write(chunk)
+            length -= len(chunk)
+
+    def close(self) -> None:
+        """
+        Write the end-of-archive marker (two zero blocks) and pad the stream to a full record, as GNU tar does.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._write(bytes(2 * tarfile.BLOCKSIZE))
+        remainder = self.size % tarfile.RECORDSIZE
+        if remainder:
+            self._write(bytes(tarfile.RECORDSIZE - remainder))
+
+    def hexdigests(self) -> dict[str, str]:
+        """
+        Digests of the tar stream written so far (call after close() for the digests of the whole bundle).
+        """
+        return self.stream_hasher.hexdigests()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        return False
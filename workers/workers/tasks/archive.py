@@ -1,18 +1,21 @@
 import json
 import shutil
+from contextlib import ExitStack
 from pathlib import Path
 
 from celery import Celery
 from celery.utils.log import get_task_logger
 from sca_rhythm import WorkflowTask
+from sca_rhythm.progress import Progress
 
 import workers.api as api
 import workers.cmd as cmd
 import workers.config.celeryconfig as celeryconfig
 import workers.utils as utils
 import workers.workflow_utils as wf_utils
+from workers import bundle_index, chunkstore, digest_ledger, hashing, seekable_zstd
 from workers.config import config
-from workers.dataset import get_archive_bundle_name
+from workers.dataset import get_archive_bundle_name, get_bundle_format, get_bundle_index_name
 
 app = Celery("tasks")
 app.config_from_object(celeryconfig)
@@ -46,28 +49,171 @@ def make_tarfile(celery_task: WorkflowTask, tar_path: Path, source_dir: str, sou
     return tar_path
 
 
-def archive(celery_task: WorkflowTask, dataset: dict, delete_local_file: bool = False):
-    bundle = Path(config["paths"][dataset["type"]]["bundle"]["generate"]) / get_archive_bundle_name(dataset)
+def stream_tarfile(celery_task: WorkflowTask, sinks: list, source_dir: str, source_size: int) -> tuple[int, str]:
+    """
+    Stream a tar of source_dir (same format as make_tarfile) into the sinks, computing its MD5 on the way.
+
+    @param celery_task:
+    @param sinks: writable binary streams that receive the tar
+    @param source_dir:
+    @param source_size: expected size in bytes, for progress reporting
+    @return: size and md5 of the tar stream
+    """
+    progress = Progress(celery_task=celery_task, name='tar', total=source_size, units='bytes')
+    with cmd.tar_stream(source_dir=source_dir) as tar_stream:
+        size, digests = hashing.copy_stream(tar_stream, sinks=sinks, algorithms=['md5'],
+                                            on_progress=progress.update)
+    return size, digests['md5']
+
+
+def stream_bundle(celery_task: WorkflowTask, sink, source_dir: str, source_size: int,
+                  bundle_format: str, index: bundle_index.IndexWriter = None) -> tuple[int, str]:
+    """
+    Stream a bundle of source_dir in bundle_format ('tar' or 'tar.zst') into sink.
+
+    If index is given, the members of the tar stream are indexed on the way and the index is closed.
+
+    @return: size and md5 of the bundle as written to sink
+    """
+    compressor = None
+    with ExitStack() as stack:
+        if bundle_format == 'tar':
+            tar_sinks = [sink]
+        else:
+            compressor = stack.enter_context(seekable_zstd.SeekableZstdWriter(sink, **config['archive']['zstd']))
+            tar_sinks = [compressor]
+        if index is not None:
+            tar_sinks.append(stack.enter_context(bundle_index.TarIndexer(index)))
+        size, md5 = stream_tarfile(celery_task=celery_task, sinks=tar_sinks, source_dir=source_dir,
+                                   source_size=source_size)
+
+    if compressor is not None:
+        size, md5 = compressor.size, compressor.hexdigests()['md5']
+    if index is not None:
+        index.close(frames=compressor.frames if compressor is not None else None)
+    return size, md5
+
+
+def index_tarfile(tar_path: Path, index: bundle_index.IndexWriter) -> str:
+    """
+    Index the tar file and close the index, computing the MD5 of the tar file in the same read.
+    """
+    with open(tar_path, 'rb') as tar_file, bundle_index.TarIndexer(index) as indexer:
+        _, digests = hashing.copy_stream(tar_file, sinks=[indexer], algorithms=['md5'])
+    index.close()
+    return digests['md5']
 
-    make_tarfile(celery_task=celery_task,
-                 tar_path=bundle,
-                 source_dir=dataset['origin_path'],
-                 source_size=dataset['du_size'])
 
-    bundle_size = bundle.stat().st_size
-    bundle_checksum = utils.checksum(bundle)
+def open_index(dataset: dict) -> bundle_index.IndexWriter | None:
+    """
+    Index for the dataset's bundle, written to the bundle generation directory, if config['archive']['index'] is set.
+    """
+    if not config['archive']['index']:
+        return None
+    index_path = Path(config["paths"][dataset["type"]]["bundle"]["generate"]) / get_bundle_index_name(dataset)
+    index_path.parent.mkdir(parents=True, exist_ok=True)
+    return bundle_index.IndexWriter(index_path)
+
+
+def archive_index(index: bundle_index.IndexWriter | None, archive_dir: str) -> None:
+    if index is not None:
+        # stored next to the bundle, under the name get_bundle_index_name() expects
+        wf_utils.archive(local_file_path=index.path, archive_path=f'{archive_dir}/{index.path.name}')
+
+
+def archive(celery_task: WorkflowTask, dataset: dict, delete_local_file: bool = False):
+    """
+    Create a tar bundle of the dataset and store it in the archive location.
+
+    config['archive']['mode'] selects how:
+    - tar:      write the bundle with tar, read it back to compute its MD5, then upload it
+    - stream:   hash the tar stream while it is written to the bundle file; the MD5 is recorded in the
+                digest ledger so the upload preflight check does not read the bundle again either
+    - diskless: pipe the tar stream, hashed on the way, straight into the archive location;
+                no local bundle is written
+    - chunks:   cut the tar stream into content-defined chunks and upload only the chunks the chunk store does
+                not have yet (workers/chunkstore.py); the archive path is the bundle's recipe
+
+    config['archive']['format'] selects the bundle format: 'tar', or 'tar.zst' (seekable zstd, compressed with
+    config['archive']['zstd']) which needs the stream or diskless mode.
+
+    If config['archive']['index'] is set, a member index (workers/bundle_index.py) is built from the same
+    stream and archived next to the bundle.
+    """
+    bundle_name = get_archive_bundle_name(dataset)
+    bundle_format = get_bundle_format(dataset)
+    dataset_type_archive_dir = wf_utils.get_archive_dir(dataset['type'])
+    dataset_bundle_path = f'{dataset_type_archive_dir}/{bundle_name}'
+    mode = config['archive']['mode']
+    if bundle_format != 'tar' and mode in ('tar', 'chunks'):
+        raise ValueError(f"bundle format {bundle_format} requires archive mode 'stream' or 'diskless'")
+    index = open_index(dataset)
+
+    if mode == 'chunks':
+        recipe_path = chunkstore.recipe_archive_path(dataset_bundle_path)
+        work_dir = Path(config["paths"][dataset["type"]]["bundle"]["generate"])
+        logger.info(f'storing tar of {dataset["origin_path"]} in the chunk store as {recipe_path}')
+        with chunkstore.ChunkWriter(recipe_path=recipe_path, work_dir=work_dir) as chunk_writer:
+            bundle_size, bundle_checksum = stream_bundle(celery_task=celery_task,
+                                                         sink=chunk_writer,
+                                                         source_dir=dataset['origin_path'],
+                                                         source_size=dataset['du_size'],
+                                                         bundle_format=bundle_format,
+                                                         index=index)
+        archive_index(index, dataset_type_archive_dir)
+        return recipe_path, {
+            'name': bundle_name,
+            'size': bundle_size,
+            'md5': bundle_checksum,
+        }
+
+    if mode == 'diskless':
+        logger.info(f'streaming tar of {dataset["origin_path"]} to {dataset_bundle_path}')
+        with wf_utils.open_archive_stream(archive_path=dataset_bundle_path) as archive_stream:
+            bundle_size, bundle_checksum = stream_bundle(celery_task=celery_task,
+                                                         sink=archive_stream,
+                                                         source_dir=dataset['origin_path'],
+                                                         source_size=dataset['du_size'],
+                                                         bundle_format=bundle_format,
+                                                         index=index)
+        archive_index(index, dataset_type_archive_dir)
+        return dataset_bundle_path, {
+            'name': bundle_name,
+            'size': bundle_size,
+            'md5': bundle_checksum,
+        }
+
+    bundle = Path(config["paths"][dataset["type"]]["bundle"]["generate"]) / bundle_name
+
+    if mode == 'stream':
+        logger.info(f'creating tar of {dataset["origin_path"]} at {bundle}')
+        bundle.unlink(missing_ok=True)
+        with open(bundle, 'wb') as bundle_file:
+            bundle_size, bundle_checksum = stream_bundle(celery_task=celery_task,
+                                                         sink=bundle_file,
+                                                         source_dir=dataset['origin_path'],
+                                                         source_size=dataset['du_size'],
+                                                         bundle_format=bundle_format,
+                                                         index=index)
+        digest_ledger.record_digests(bundle, {'md5': bundle_checksum})
+    else:
+        make_tarfile(celery_task=celery_task,
+                     tar_path=bundle,
+                     source_dir=dataset['origin_path'],
+                     source_size=dataset['du_size'])
+        bundle_size = bundle.stat().st_size
+        bundle_checksum = index_tarfile(bundle, index) if index is not None else utils.checksum(bundle)
+
     bundle_attrs = {
         'name': bundle.name,
         'size': bundle_size,
         'md5': bundle_checksum,
     }
 
-    dataset_type_archive_dir = wf_utils.get_archive_dir(dataset['type'])
-    dataset_bundle_path = f'{dataset_type_archive_dir}/{bundle.name}'
-
     wf_utils.archive(local_file_path=bundle,
                       archive_path=dataset_bundle_path,
                       celery_task=celery_task)
+    archive_index(index, dataset_type_archive_dir)
 
     if delete_local_file:
         # file successfully uploaded to SDA, delete the local copy
@@ -1,13 +1,14 @@
 import datetime
-import itertools
 import time
 from pathlib import Path
 
 from celery import Celery
+from celery.exceptions import Ignore
 from celery.utils.log import get_task_logger
 
 import workers.api as api
 import workers.config.celeryconfig as celeryconfig
+from workers.change_sources import ChangeSource, PollingSource, open_change_source
 from workers.config import config
 
 logger = get_task_logger(__name__)
@@ -16,31 +17,6 @@ app = Celery("tasks")
 app.config_from_object(celeryconfig)
 
 
-def dir_last_modified_time(dataset_path: Path) -> float:
-    """
-    Obtain the most recent modification time for a directory and all its contents in a recursive manner.
-    At times, when copying files, outdated modification times may be retained.
-    To address this, monitor the modification time of the root directory as well.
-
-    If the copy process is configured to preserve the metadata of the source file, it will update the m_time
-    of the target file after the copy process. This will update the c_time of the target file. In these cases,
-    c_time will be bigger than m_time. So, we will consider the maximum of c_time and m_time of the file / directory
-    as the last modified time.
-
-
-    Args:
-    dataset_path (Path): Path object to the directory.
-
-    Returns:
-    float: The last modified time in epoch seconds.
-    """
-    paths = itertools.chain([dataset_path], dataset_path.rglob('*'))
-    return max(
-        (max(p.lstat().st_mtime, p.lstat().st_ctime) for p in paths if p.exists()),
-        default=time.time()
-    )
-
-
 def update_progress(celery_task, mod_time, time_remaining_sec):
     d1 = datetime.datetime.utcfromtimestamp(mod_time)
     prog_obj = {
@@ -50,7 +26,42 @@ def update_progress(celery_task, mod_time, time_remaining_sec):
     celery_task.update_progress(prog_obj)
 
 
-def await_stability(celery_task, dataset_id, wait_seconds: int = None, recency_threshold=None, **kwargs):
+def _check(celery_task, dataset: dict, change_source: ChangeSource, threshold: float) -> float | None:
+    """
+    Seconds to wait before the next stability check, None if the dataset is stable.
+    """
+    # any change within the threshold is enough to know the dataset is not stable yet
+    now = time.time()
+    mod_time = change_source.last_modified(newer_than=now - threshold)
+    delta = now - mod_time
+
+    logger.info(f'{dataset["name"]} dataset is last modified {int(delta)}s ago')
+    update_progress(celery_task, mod_time, threshold - delta)
+
+    if delta > threshold:
+        return None
+    # the dataset is stable once threshold seconds have passed since mod_time
+    return threshold - delta + 1
+
+
+def _reschedules(celery_task) -> bool:
+    return (config['registration']['stability_checks'] == 'reschedule'
+            and celery_task is not None
+            and not celery_task.request.called_directly)
+
+
+def _reschedule(celery_task, countdown: float, **kwargs) -> None:
+    """
+    Send the task again with the same id, to run in countdown seconds with its kwargs updated with kwargs, and
+    give its worker slot back. The workflow step keeps the same task run until a check finds the dataset stable.
+    """
+    request = celery_task.request
+    celery_task.signature_from_request(kwargs={**request.kwargs, **kwargs}, countdown=countdown).apply_async()
+    raise Ignore()
+
+
+def await_stability(celery_task, dataset_id, wait_seconds: int = None, recency_threshold=None,
+                    hot_dirs: list[str] = None, **kwargs):
     dataset = api.get_dataset(dataset_id=dataset_id)
     origin_path = Path(dataset['origin_path'])
     dataset_type = dataset['type']
@@ -71,17 +82,24 @@ def await_stability(celery_task, dataset_id, wait_seconds: int = None, recency_t
                      config['registration']['wait_between_stability_checks_seconds'])
     logger.info(f'{dataset["name"]} - wait_seconds: {_wait_seconds} seconds')
 
-    while origin_path.exists():
-        mod_time = dir_last_modified_time(origin_path)
-        delta = time.time() - mod_time
-
-        logger.info(f'{dataset["name"]} dataset is last modified {int(delta)}s ago')
-        update_progress(celery_task, mod_time, threshold - delta)
-
-        if delta > threshold:
-            break
-
-        time.sleep(_wait_seconds)
+    if _reschedules(celery_task):
+        # one check per task run; the directories where the scan found recent changes are passed on to the next
+        if origin_path.exists():
+            change_source = PollingSource(origin_path,
+                                          num_workers=config['registration']['change_source']['poll']['workers'],
+                                          hot_dirs=hot_dirs)
+            next_check = _check(celery_task, dataset, change_source, threshold)
+            if next_check is not None:
+                _reschedule(celery_task, max(1, min(_wait_seconds, next_check)), hot_dirs=change_source.hot_dirs)
+    else:
+        # polled sources rescan the dataset on every check; event sources (config['registration']['change_source'])
+        # scan it once and then only wait for change events
+        with open_change_source(origin_path) as change_source:
+            while origin_path.exists():
+                next_check = _check(celery_task, dataset, change_source, threshold)
+                if next_check is None:
+                    break
+                time.sleep(max(1, min(_wait_seconds, next_check)))
 
     api.add_state_to_dataset(dataset_id=dataset_id, state='READY')
     return dataset_id,
@@ -49,6 +49,20 @@ def inspect_dataset(celery_task, dataset_id, **kwargs):
         raise exc.RetryableException(e)
 
 
+@app.task(base=WorkflowTask, bind=True, name='inspect_and_archive_dataset',
+          autoretry_for=(exc.RetryableException,),
+          max_retries=3,
+          default_retry_delay=5)
+def inspect_and_archive_dataset(celery_task, dataset_id, **kwargs):
+    from workers.tasks.inspect_and_archive import inspect_and_archive_dataset as task_body
+    try:
+        return task_body(celery_task, dataset_id, **kwargs)
+    except exc.InspectionFailed:
+        raise
+    except Exception as e:
+        raise exc.RetryableException(e)
+
+
 @app.task(base=WorkflowTask, bind=True, name='generate_qc',
           autoretry_for=(Exception,),
           max_retries=3,
@@ -67,6 +81,20 @@ def stage_dataset(celery_task, dataset_id, **kwargs):
     return task_body(celery_task, dataset_id, **kwargs)
 
 
+@app.task(base=WorkflowTask, bind=True, name='stage_dataset_files',
+          autoretry_for=(exc.RetryableException,),
+          max_retries=3,
+          default_retry_delay=5)
+def stage_dataset_files(celery_task, dataset_id, files: list[str] = None, **kwargs):
+    from workers.tasks.stage import stage_dataset_files as task_body
+    try:
+        return task_body(celery_task, dataset_id, files=files, **kwargs)
+    except exc.ValidationFailed:
+        raise
+    except Exception as e:
+        raise exc.RetryableException(e)
+
+
 @app.task(base=WorkflowTask, bind=True, name='validate_dataset',
           autoretry_for=(exc.RetryableException,),
           max_retries=3,
@@ -1,11 +1,10 @@
-from pathlib import Path
-
 from celery import Celery
 
 import workers.api as api
 import workers.config.celeryconfig as celeryconfig
-import workers.sda as sda
-from workers.config import app_env
+import workers.workflow_utils as wf_utils
+from workers import chunkstore
+from workers.dataset import get_bundle_index_archive_path
 
 app = Celery("tasks")
 app.config_from_object(celeryconfig)
@@ -13,17 +12,16 @@ app.config_from_object(celeryconfig)
 
 def delete_dataset(celery_task, dataset_id, **kwargs):
     dataset = api.get_dataset(dataset_id=dataset_id)
-    sda_path = dataset['archive_path']
+    archive_path = dataset['archive_path']
 
-    if app_env == 'docker':
-        # In Docker mode, remote archive storage is not available — delete the
-        # locally-archived file directly.
-        if sda_path:
-            archive_file = Path(sda_path)
-            if archive_file.exists():
-                archive_file.unlink()
-    else:
-        sda.delete(sda_path)
+    if archive_path:
+        if chunkstore.is_recipe(archive_path):
+            # chunks no other recipe uses are deleted by the next garbage collection. Before the recipe is
+            # deleted: on a node without the chunk index this fails while the dataset can still be deleted again
+            chunkstore.forget_recipe(archive_path)
+        wf_utils.delete_from_archive(archive_path)
+        # the member index uploaded next to the bundle, if the bundle has one
+        wf_utils.delete_from_archive(get_bundle_index_archive_path(dataset))
 
     # id is appended to name to make it unique (database constraint) to allow new datasets to have this same name
     update_data = {
@@ -1,6 +1,7 @@
-import itertools
+import os
 import shutil
 import stat
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from pathlib import Path
 
 from celery import Celery
@@ -8,7 +9,9 @@ from celery.utils.log import get_task_logger
 
 import workers.api as api
 import workers.config.celeryconfig as celeryconfig
+from workers import staging_cache
 from workers.config import config
+from workers.utils import batched
 from workers.exceptions import ValidationFailed
 from workers.dataset import get_bundle_staged_path, get_dataset_download_path, get_bundle_download_path
 
@@ -28,12 +31,74 @@ def rm(p: Path):
                 p.unlink()
 
 
-def grant_read_permissions_to_others(root: Path):
-    for p in itertools.chain([root], root.rglob('*')):
-        if p.is_dir():
-            p.chmod(p.stat().st_mode | stat.S_IROTH | stat.S_IXOTH)
-        else:
-            p.chmod(p.stat().st_mode | stat.S_IROTH)
+def _grant(path: str, is_dir: bool) -> int:
+    """
+    Let others read path (and traverse it, if it is a directory) unless its mode already does.
+    returns: 1 if the mode was changed, 0 otherwise
+    """
+    bits = stat.S_IROTH | stat.S_IXOTH if is_dir else stat.S_IROTH
+    mode = os.stat(path).st_mode
+    if mode & bits == bits:
+        return 0
+    os.chmod(path, stat.S_IMODE(mode) | bits)
+    return 1
+
+
+def _list_dir(path: str) -> tuple[list[str], list[tuple[str, bool]]]:
+    """
+    The subdirectories of path and its entries as (path, is directory), typed by d_type without a stat.
+    Symlinks are skipped.
+    """
+    subdirs = []
+    entries = []
+    with os.scandir(path) as it:
+        for dir_entry in it:
+            if dir_entry.is_symlink():
+                continue
+            is_dir = dir_entry.is_dir(follow_symlinks=False)
+            entries.append((dir_entry.path, is_dir))
+            if is_dir:
+                subdirs.append(dir_entry.path)
+    return subdirs, entries
+
+
+def grant_read_permissions_to_others(root: Path, num_workers: int = None, batch_size: int = 1000) -> int:
+    """
+    Let others read root and everything under it, and traverse the directories.
+
+    Directories are listed with os.scandir and their entries are stat-ed and chmod-ed in batches of batch_size,
+    all on a pool of num_workers threads (config['download']['permission_workers'] by default). Entries whose
+    mode already has the bits are not changed. Symlinks under root are skipped, root itself is followed.
+
+    returns: the number of entries whose mode was changed
+    """
+    num_workers = num_workers or config['download']['permission_workers']
+    is_dir = root.is_dir()
+    changed = _grant(str(root), is_dir)
+    if not is_dir:
+        return changed
+
+    def grant_all(batch: list[tuple[str, bool]]) -> int:
+        return sum(_grant(path, entry_is_dir) for path, entry_is_dir in batch)
+
+    pool = ThreadPoolExecutor(max_workers=num_workers)
+    try:
+        listings = {pool.submit(_list_dir, str(root))}
+        grants = set()
+        while listings or grants:
+            done, _ = wait(listings | grants, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in grants:
+                    grants.remove(future)
+                    changed += future.result()
+                    continue
+                listings.remove(future)
+                subdirs, entries = future.result()
+                listings.update(pool.submit(_list_dir, subdir) for subdir in subdirs)
+                grants.update(pool.submit(grant_all, batch) for batch in batched(entries, batch_size))
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+    return changed
 
 
 def grant_access_to_parent_chain(leaf: Path, root: Path):
@@ -60,12 +125,20 @@ def setup_download(celery_task, dataset_id, **kwargs):
     download_path.symlink_to(staged_path, target_is_directory=True)
     # do the same for the bundle file
     rm(bundle_download_path)
-    bundle_download_path.symlink_to(bundle_path)
+    if bundle_path.exists():
+        bundle_download_path.symlink_to(bundle_path)
+    else:
+        # staged without a local copy of the bundle (config['stage']['mode'] 'stream')
+        logger.info(f'{bundle_path} does not exist - the bundle of dataset {dataset_id} is not offered for download')
 
     # enable others to read and cd into stage directory
-    grant_read_permissions_to_others(staged_path)
-    grant_read_permissions_to_others(bundle_download_path)
+    # (unless stage extracted the dataset with those permissions already)
+    if not (staging_cache.read_entry(staged_path) or {}).get('readable_by_others'):
+        grant_read_permissions_to_others(staged_path)
+    if bundle_download_path.is_symlink():
+        grant_read_permissions_to_others(bundle_download_path)
 
     # enable others to navigate to leaf by granting execute permission on parent directories
     grant_access_to_parent_chain(staged_path, root=Path(config['paths']['root']))
+    staging_cache.touch(staged_path)
     return dataset_id,
@@ -1,14 +1,19 @@
-from pathlib import Path
+from __future__ import annotations
+
+import queue
+import threading
+from collections.abc import Callable
+from pathlib import Path, PurePosixPath
 
 from celery import Celery
 from celery.utils.log import get_task_logger
 from sca_rhythm.progress import Progress
 
 import workers.api as api
-import workers.cmd as cmd
 import workers.config.celeryconfig as celeryconfig
 import workers.utils as utils
 from workers import exceptions as exc
+from workers import digest_ledger, fswalk
 from workers.config import config
 
 app = Celery("tasks")
@@ -16,13 +21,134 @@ app.config_from_object(celeryconfig)
 logger = get_task_logger(__name__)
 
 
-def generate_metadata(celery_task, source: Path):
+class FileMetadataPoster:
+    _DONE = object()
+
+    def __init__(self, dataset_id, batch_size: int, max_pending_batches: int = 2, stored_files: dict = None):
+        """
+        Posts file metadata records to the API (api.add_files_to_dataset) in batches of batch_size from a
+        background thread, so that the network time overlaps with hashing and at most about
+        max_pending_batches + 1 batches are held in memory.
+
+        add() blocks when max_pending_batches batches are waiting to be posted, which keeps the producer from
+        running away from the API.
+
+        Posting is idempotent - the API skips files whose path is already associated with the dataset.
+        stored_files ({path: md5}) are the files a previous attempt already stored; records that match them
+        are not sent again.
+
+        Use as a context manager; leaving the context flushes the last batch and waits for all posts to finish.
+        An error in the background thread is raised from the next add() or on exit.
+        """
+        self.dataset_id = dataset_id
+        self.batch_size = batch_size
+        self.stored_files = stored_files or {}
+        self.num_skipped = 0
+        self._batch = []
+        self._queue = queue.Queue(maxsize=max_pending_batches)
+        self._error = None
+        self._thread = threading.Thread(target=self._post_batches, daemon=True)
+
+    def _post_batches(self):
+        while (batch := self._queue.get()) is not self._DONE:
+            if self._error is None:
+                try:
+                    api.add_files_to_dataset(dataset_id=self.dataset_id, files=batch)
+                except Exception as e:
+                    self._error = e
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def add(self, record: dict) -> None:
+        self._raise_error()
+        path = record['path']
+        if path in self.stored_files and self.stored_files[path] == record['md5']:
+            self.num_skipped += 1
+            return
+        self._batch.append(record)
+        if len(self._batch) >= self.batch_size:
+            self._queue.put(self._batch)
+            self._batch = []
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None and self._batch:
+            self._queue.put(self._batch)
+        self._batch = []
+        if exc_type is not None:
+            # stop posting queued batches; the work is going to be redone
+            self._error = self._error or exc_val
+        self._queue.put(self._DONE)
+        self._thread.join()
+        if exc_type is None:
+            self._raise_error()
+        if self.num_skipped:
+            logger.info(f'dataset {self.dataset_id}: skipped {self.num_skipped} files that were already stored')
+        return False
+
+
+def is_genome_file(relpath: str) -> bool:
+    suffixes = ''.join(PurePosixPath(relpath).suffixes)
+    return suffixes in config['genome_file_types']
+
+
+def _inspect_entry(entry: fswalk.Entry) -> tuple[str, dict | str | None]:
+    """
+    Inspect a single entry yielded by fswalk.walk. Runs on the checksum worker threads.
+
+    returns: ('file', file metadata) | ('dir', None) | ('other', None) | ('error', message)
+    """
+    if not entry.readable:
+        return 'error', f'{entry.path} is not readable/traversable'
+    if entry.target_type == utils.FileType.FILE:
+        # if symlink, only add the size of the symlink, not the pointed file
+        is_symlink = entry.type == utils.FileType.SYMBOLIC_LINK
+        # do not compute checksum for symlinks
+        hex_digest = digest_ledger.file_digest(entry.path, st=entry.stat) if not is_symlink else None
+        return 'file', {
+            'path': entry.relpath,
+            'md5': hex_digest,
+            'size': entry.stat.st_size,
+            'type': entry.type,
+            'is_genome_file': not is_symlink and is_genome_file(entry.relpath),
+        }
+    if entry.target_type == utils.FileType.DIRECTORY:
+        return 'dir', None
+    return 'other', None
+
+
+def generate_metadata(celery_task,
+                      source: Path,
+                      num_workers: int = None,
+                      total: int = None,
+                      on_file: Callable[[dict], None] = None):
     """
     source is a directory that exists and has to readable and executable (see files inside)
     all the files and directories under source should be readable
+
+    The tree is streamed with fswalk.walk (one lstat per entry, no list of paths is held in memory).
+    files are hashed by a bounded pool of num_workers reader threads (default: config['inspect']['checksum_workers']);
+    the records are produced in walk order.
+
+    du_size (the apparent size reported by `du -sb`) is computed from the same walk, so the tree is
+    stat-ed only once.
+
+    If on_file is given, it is called with every file metadata record as soon as it is ready and the
+    returned metadata list is empty, so the caller can stream the records instead of holding all of them.
+
+    total is the number of entries used for progress reporting. When it is not given, the entries are counted
+    with a fast pre-pass if config['inspect']['count_entries'] is set, otherwise progress is reported without
+    a total.
+
     returns:    number of files, 
                 number of directories, 
                 sum of stat size of all files, 
+                apparent size of the directory tree (du -sb),
                 number of genome data files,
                 the md5 digest and relative filenames of genome data files
     """
@@ -33,36 +159,52 @@ def generate_metadata(celery_task, source: Path):
         msg = f'source {source} is either not readable or not traversable'
         raise exc.InspectionFailed(msg)
 
-    paths = list(source.rglob('*'))
-    progress = Progress(celery_task=celery_task, name='', units='items')
-
-    for p in progress(paths):
-        if utils.is_readable(p):
-            if p.is_file():
-                num_files += 1
-                # if symlink, only add the size of the symlink, not the pointed file
-                file_size = p.lstat().st_size
-                size += file_size
-                # do not compute checksum for symlinks
-                hex_digest = utils.checksum(p) if not p.is_symlink() else None
-                relpath = p.relative_to(source)
-                metadata.append({
-                    'path': str(relpath),
-                    'md5': hex_digest,
-                    'size': file_size,
-                    'type': utils.filetype(p)
-                })
-                if ''.join(p.suffixes) in config['genome_file_types'] and not p.is_symlink():
-                    num_genome_files += 1
-            elif p.is_dir():
-                num_directories += 1
-        else:
-            errors.append(f'{p} is not readable/traversable')
+    num_workers = num_workers or config['inspect']['checksum_workers']
+    if total is None and config['inspect']['count_entries']:
+        total = fswalk.count_entries(source)
+    progress = Progress(celery_task=celery_task, name='', units='items', total=total)
+
+    du_size = fswalk.ApparentSize(source)
+    entries = fswalk.walk(source, onerror=lambda path, e: errors.append(f'{path} is not readable/traversable'))
+    results = utils.parallel_map(_inspect_entry, du_size.tally(entries), num_workers=num_workers)
+    for kind, result in progress(results):
+        if kind == 'file':
+            num_files += 1
+            size += result['size']
+            if result.pop('is_genome_file'):
+                num_genome_files += 1
+            if on_file is not None:
+                on_file(result)
+            else:
+                metadata.append(result)
+        elif kind == 'dir':
+            num_directories += 1
+        elif kind == 'error':
+            errors.append(result)
 
     if len(errors) > 0:
         raise exc.InspectionFailed(errors)
 
-    return num_files, num_directories, size, num_genome_files, metadata
+    return num_files, num_directories, size, du_size.total, num_genome_files, metadata
+
+
+def get_stored_files(dataset_id, page_size: int = None) -> dict[str, str]:
+    """
+    {path: md5} of the files a previous attempt of inspection already stored for the dataset, fetched from the API
+    page_size files at a time (default: config['inspect']['stored_files_page_size']).
+
+    The first inspection of a dataset costs a single request for an empty page. The pages are ordered by name,
+    which is not unique, so a file may be missed - it is sent again and skipped by the API.
+    """
+    page_size = page_size or config['inspect']['stored_files_page_size']
+    stored_files = {}
+    skip = 0
+    while page := api.get_dataset_files(dataset_id=dataset_id, skip=skip, take=page_size, filetype='file'):
+        stored_files.update((f['path'], f['md5']) for f in page)
+        if len(page) < page_size:
+            break
+        skip += page_size
+    return stored_files
 
 
 def inspect_dataset(celery_task, dataset_id, **kwargs):
@@ -76,8 +218,20 @@ def inspect_dataset(celery_task, dataset_id, **kwargs):
     if not source.exists():
         raise exc.InspectionFailed(f'origin_path does not exist: {source}')
 
-    du_size = cmd.total_size(source)
-    num_files, num_directories, size, num_genome_files, metadata = generate_metadata(celery_task, source)
+    # a previous attempt's counts are a good enough progress estimate and save the counting pre-pass
+    estimated_total = None
+    if dataset.get('num_files') is not None and dataset.get('num_directories') is not None:
+        estimated_total = dataset['num_files'] + dataset['num_directories']
+
+    # file metadata is posted in batches in the background while hashing continues
+    # batching avoids large payloads to the API
+    # files stored by a previous attempt are not sent again
+    with FileMetadataPoster(dataset_id=dataset_id,
+                            batch_size=config['inspect']['file_metadata_batch_size'],
+                            max_pending_batches=config['inspect']['max_pending_batches'],
+                            stored_files=get_stored_files(dataset_id)) as poster:
+        num_files, num_directories, size, du_size, num_genome_files, _ = generate_metadata(
+            celery_task, source, total=estimated_total, on_file=poster.add)
 
     update_data = {
         'du_size': du_size,
@@ -90,9 +244,5 @@ def inspect_dataset(celery_task, dataset_id, **kwargs):
 
     }
     api.update_dataset(dataset_id=dataset_id, update_data=update_data)
-    # split metadata into batches and add to dataset
-    # this is to avoid large payloads to the API
-    for batch in utils.batched(metadata, n=config['inspect']['file_metadata_batch_size']):
-        api.add_files_to_dataset(dataset_id=dataset_id, files=batch)
 
     return dataset_id,
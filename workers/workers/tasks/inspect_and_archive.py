@@ -0,0 +1,178 @@
+from __future__ import annotations
+
+from collections.abc import Callable
+from contextlib import contextmanager
+from pathlib import Path
+
+from celery import Celery
+from celery.utils.log import get_task_logger
+from sca_rhythm import WorkflowTask
+from sca_rhythm.progress import Progress
+
+import workers.api as api
+import workers.config.celeryconfig as celeryconfig
+import workers.utils as utils
+import workers.workflow_utils as wf_utils
+from workers import chunkstore, digest_ledger, exceptions as exc, fswalk, seekable_zstd
+from workers.bundle_index import IndexWriter
+from workers.config import config
+from workers.dataset import get_archive_bundle_name, get_bundle_format
+from workers.tarstream import TarWriter
+from workers.tasks.archive import archive_index, open_index
+from workers.tasks.inspect import FileMetadataPoster, get_stored_files, is_genome_file
+
+app = Celery("tasks")
+app.config_from_object(celeryconfig)
+logger = get_task_logger(__name__)
+
+
+def write_bundle(celery_task: WorkflowTask,
+                 sink,
+                 source: Path,
+                 on_file: Callable[[dict], None],
+                 total: int = None,
+                 index: IndexWriter = None) -> tuple[dict, int, str]:
+    """
+    Walk source once, writing a tar of it (same members as `tar cf - -C source .`) to sink. Every file is read
+    once: the bytes written to the tar are also hashed to produce the file's MD5 and the MD5 of the bundle.
+
+    The file MD5s are recorded in the digest ledger and on_file is called with the metadata record of every
+    file (the same records inspect_dataset produces). If index is given, every member is added to it.
+
+    Unlike inspect_dataset, which reports every unreadable entry, this stops at the first one - the bundle
+    would be incomplete anyway.
+
+    returns: inspection results (the update_data of inspect_dataset), bundle size, bundle md5
+    """
+    num_files, num_directories, size, num_genome_files = 0, 0, 0, 0
+    if total is None and config['inspect']['count_entries']:
+        total = fswalk.count_entries(source)
+    progress = Progress(celery_task=celery_task, name='', units='items', total=total)
+
+    du_size = fswalk.ApparentSize(source)
+    with TarWriter(sink, file_algorithms=['md5'], stream_algorithms=['md5'], index=index) as writer:
+        writer.add_root(source)
+        for entry in progress(du_size.tally(fswalk.walk(source))):
+            if not entry.readable:
+                raise exc.InspectionFailed(f'{entry.path} is not readable/traversable')
+            digests = writer.add(entry)
+
+            if entry.target_type == utils.FileType.FILE:
+                # symlinks are archived as links; like inspect_dataset, they have no checksum
+                is_symlink = entry.type == utils.FileType.SYMBOLIC_LINK
+                if digests is not None:
+                    digest_ledger.record_digests(entry.path, digests, st=entry.stat)
+                num_files += 1
+                size += entry.stat.st_size
+                if not is_symlink and is_genome_file(entry.relpath):
+                    num_genome_files += 1
+                on_file({
+                    'path': entry.relpath,
+                    'md5': digests['md5'] if digests is not None else None,
+                    'size': entry.stat.st_size,
+                    'type': entry.type,
+                })
+            elif entry.target_type == utils.FileType.DIRECTORY:
+                num_directories += 1
+
+    inspection = {
+        'du_size': du_size.total,
+        'size': size,
+        'num_files': num_files,
+        'num_directories': num_directories,
+        'metadata': {
+            'num_genome_files': num_genome_files,
+        }
+    }
+    return inspection, writer.size, writer.hexdigests()['md5']
+
+
+@contextmanager
+def _bundle_sink(dataset: dict, bundle_name: str, archive_path: str):
+    """
+    Yields (sink, local bundle path or None). In diskless archive mode the tar is piped straight to the archive,
+    in chunks mode it is stored in the chunk store as the recipe at archive_path, otherwise it is written to the
+    bundle generation directory and uploaded afterwards.
+    """
+    mode = config['archive']['mode']
+    if mode == 'chunks':
+        work_dir = Path(config["paths"][dataset["type"]]["bundle"]["generate"])
+        logger.info(f'storing tar of {dataset["origin_path"]} in the chunk store as {archive_path}')
+        with chunkstore.ChunkWriter(recipe_path=archive_path, work_dir=work_dir) as chunk_writer:
+            yield chunk_writer, None
+    elif mode == 'diskless':
+        logger.info(f'streaming tar of {dataset["origin_path"]} to {archive_path}')
+        with wf_utils.open_archive_stream(archive_path=archive_path) as archive_stream:
+            yield archive_stream, None
+    else:
+        bundle = Path(config["paths"][dataset["type"]]["bundle"]["generate"]) / bundle_name
+        logger.info(f'creating tar of {dataset["origin_path"]} at {bundle}')
+        bundle.unlink(missing_ok=True)
+        with open(bundle, 'wb') as bundle_file:
+            yield bundle_file, bundle
+
+
+def inspect_and_archive_dataset(celery_task, dataset_id, **kwargs):
+    """
+    inspect_dataset and archive_dataset in a single read of the dataset - for workflows with an
+    'inspect and archive' step in place of the separate 'inspect' and 'archive' steps.
+    """
+    dataset = api.get_dataset(dataset_id=dataset_id, bundle=True)
+
+    if dataset.get('is_deleted'):
+        raise exc.InspectionFailed(f'Dataset {dataset_id} is already deleted; nothing to inspect.')
+
+    source = Path(dataset['origin_path']).resolve()
+    if not source.exists():
+        raise exc.InspectionFailed(f'origin_path does not exist: {source}')
+    if not utils.is_readable(source):
+        raise exc.InspectionFailed(f'source {source} is either not readable or not traversable')
+
+    estimated_total = None
+    if dataset.get('num_files') is not None and dataset.get('num_directories') is not None:
+        estimated_total = dataset['num_files'] + dataset['num_directories']
+
+    bundle_name = get_archive_bundle_name(dataset)
+    archive_dir = wf_utils.get_archive_dir(dataset["type"])
+    archive_path = f'{archive_dir}/{bundle_name}'
+    if config['archive']['mode'] == 'chunks':
+        if get_bundle_format(dataset) != 'tar':
+            raise ValueError("archive mode 'chunks' stores uncompressed tar bundles only")
+        archive_path = chunkstore.recipe_archive_path(archive_path)
+    index = open_index(dataset)
+
+    with FileMetadataPoster(dataset_id=dataset_id,
+                            batch_size=config['inspect']['file_metadata_batch_size'],
+                            max_pending_batches=config['inspect']['max_pending_batches'],
+                            stored_files=get_stored_files(dataset_id)) as poster:
+        with _bundle_sink(dataset, bundle_name, archive_path) as (sink, bundle):
+            if get_bundle_format(dataset) == 'tar':
+                inspection, bundle_size, bundle_checksum = write_bundle(
+                    celery_task, sink, source, on_file=poster.add, total=estimated_total, index=index)
+                frames = None
+            else:
+                with seekable_zstd.SeekableZstdWriter(sink, **config['archive']['zstd']) as compressor:
+                    inspection, _, _ = write_bundle(
+                        celery_task, compressor, source, on_file=poster.add, total=estimated_total, index=index)
+                bundle_size, bundle_checksum = compressor.size, compressor.hexdigests()['md5']
+                frames = compressor.frames
+    if index is not None:
+        index.close(frames=frames)
+
+    if bundle is not None:
+        digest_ledger.record_digests(bundle, {'md5': bundle_checksum})
+        wf_utils.archive(local_file_path=bundle, archive_path=archive_path, celery_task=celery_task)
+    archive_index(index, archive_dir)
+
+    api.update_dataset(dataset_id=dataset_id, update_data={
+        **inspection,
+        'archive_path': archive_path,
+        'bundle': {
+            'name': bundle_name,
+            'size': bundle_size,
+            'md5': bundle_checksum,
+        }
+    })
+    api.add_state_to_dataset(dataset_id=dataset_id, state='ARCHIVED')
+
+    return dataset_id,
@@ -2,28 +2,63 @@ import os
 import shutil
 import tarfile
 import tempfile
+from collections.abc import Callable
+from contextlib import contextmanager
 from pathlib import Path
 
 from celery import Celery
 from celery.utils.log import get_task_logger
 from sca_rhythm import WorkflowTask
+from sca_rhythm.progress import Progress
 
 import workers.api as api
 import workers.config.celeryconfig as celeryconfig
 import workers.utils as utils
 import workers.workflow_utils as wf_utils
-from workers import exceptions as exc
+from workers import (bundle_index, chunkstore, digest_ledger, exceptions as exc, hashing, seekable_zstd, staging_cache,
+                     tarextract)
 from workers.config import config
-from workers.dataset import compute_staging_path, get_bundle_staged_path
+from workers.dataset import (compute_staging_path, get_archive_bundle_name, get_bundle_format,
+                             get_bundle_index_archive_path, get_bundle_index_name, get_bundle_name,
+                             get_bundle_staged_path)
+from workers.tasks.validate import compare_digests
 
 app = Celery("tasks")
 app.config_from_object(celeryconfig)
 logger = get_task_logger(__name__)
 
 
-def extract_tarfile(tar_path: Path, target_dir: Path, override_arcname=False):
+def _extract(archive: tarfile.TarFile, path: str) -> tuple[str, dict[str, str]]:
     """
-    tar_path: path to the tar file to extract
+    Extract archive into path with the parallel extractor (see workers/tarextract.py).
+
+    returns: the name of the top-level directory in the archive, and {path relative to it: MD5} of the regular
+    files, computed while they were written
+    """
+    digests = tarextract.extract(archive, path,
+                                 num_workers=config['stage']['extract']['workers'],
+                                 max_buffered_size=config['stage']['extract']['max_buffered_size'],
+                                 readable_by_others=config['stage']['extract']['readable_by_others'])
+    # find the top-level directory in the extracted archive
+    # (compressed bundles are read as a stream - the names are known once it is extracted)
+    archive_name = os.path.commonprefix(archive.getnames())
+    return archive_name, {os.path.relpath(name, archive_name): digest for name, digest in digests.items()}
+
+
+def _open_bundle(tar_path: Path) -> tarfile.TarFile:
+    """
+    Open a bundle for extraction. Seekable zstd bundles (archive format 'tar.zst') are decompressed frame by
+    frame on config['archive']['zstd']['threads'] threads and read as a stream.
+    """
+    if seekable_zstd.is_seekable(tar_path):
+        chunks = seekable_zstd.iter_decompressed(tar_path, threads=config['archive']['zstd']['threads'])
+        return tarfile.open(fileobj=seekable_zstd.ChunkStream(chunks), mode='r|')
+    return tarfile.open(tar_path, mode='r')
+
+
+def extract_tarfile(tar_path: Path, target_dir: Path, override_arcname=False) -> dict[str, str]:
+    """
+    tar_path: path to the tar file (or seekable zstd compressed tar file) to extract
     target_dir: path to the top level directory after extraction
 
     extracts the tar file to  target_dir.parent directory.
@@ -37,55 +72,203 @@ def extract_tarfile(tar_path: Path, target_dir: Path, override_arcname=False):
     @param tar_path:
     @param target_dir:
     @param override_arcname:
+    @return: {path relative to the extracted directory: MD5} of the regular files, computed while they were written
     """
-    with tarfile.open(tar_path, mode='r') as archive:
-        # find the top-level directory in the extracted archive
-        archive_name = os.path.commonprefix(archive.getnames())
+    # if target_dir is going to be replaced, delete it before extracting to keep the space free
+    if override_arcname and target_dir.exists():
+        shutil.rmtree(target_dir)
+
+    # create parent directories if missing
+    target_dir.parent.mkdir(parents=True, exist_ok=True)
+
+    # extracts the tar contents to a temp directory
+    # move the contents to the extraction_dir
+    with tempfile.TemporaryDirectory(dir=target_dir.parent) as tmp_dir:
+        with _open_bundle(tar_path) as archive:
+            archive_name, digests = _extract(archive, tmp_dir)
         extraction_dir = target_dir if override_arcname else (target_dir.parent / archive_name)
 
         # if extraction_dir exists then delete it
         if extraction_dir.exists():
             shutil.rmtree(extraction_dir)
 
-        # create parent directories if missing
-        extraction_dir.parent.mkdir(parents=True, exist_ok=True)
+        shutil.move(Path(tmp_dir) / archive_name, extraction_dir)
+    return digests
+
 
-        # extracts the tar contents to a temp directory
-        # move the contents to the extraction_dir
-        with tempfile.TemporaryDirectory(dir=extraction_dir.parent) as tmp_dir:
-            archive.extractall(path=tmp_dir)
-            shutil.move(Path(tmp_dir) / archive_name, extraction_dir)
+@contextmanager
+def _open_bundle_stream(stream, bundle_format: str):
+    """
+    Open a bundle that can only be read forward (see wf_utils.open_archive_reader) for extraction.
+    """
+    if bundle_format == 'tar':
+        with tarfile.open(fileobj=stream, mode='r|') as archive:
+            yield archive
+    else:
+        with seekable_zstd.decompressing_reader(stream) as decompressed:
+            with tarfile.open(fileobj=decompressed, mode='r|') as archive:
+                yield archive
 
 
-def stage(celery_task: WorkflowTask, dataset: dict) -> (str, str):
+def stream_stage(celery_task: WorkflowTask, dataset: dict, staging_dir: Path) -> dict[str, str]:
+    """
+    Stage the bundle in a single pass as it is read from the archive location (`hsi get`, or the archived file
+    in docker): every byte is hashed on its way into the extractor, which writes it to a temporary directory next to
+    staging_dir. No bundle is written to disk.
+
+    The extraction replaces staging_dir only if the MD5 of the bytes read matches the bundle's checksum;
+    otherwise the temporary directory is removed and ValidationFailed is raised.
+
+    returns: {path relative to staging_dir: MD5} of the regular files, computed while they were written
+    """
+    staging_dir.parent.mkdir(parents=True, exist_ok=True)
+    progress = Progress(celery_task=celery_task, name='stage', total=dataset['bundle']['size'], units='bytes')
+    with tempfile.TemporaryDirectory(dir=staging_dir.parent) as tmp_dir:
+        with wf_utils.open_archive_reader(dataset['archive_path']) as src:
+            reader = hashing.HashingReader(src, ['md5'], on_progress=progress.update)
+            with _open_bundle_stream(reader, get_bundle_format(dataset)) as archive:
+                archive_name, digests = _extract(archive, tmp_dir)
+            # the padding after the end-of-archive marker is part of the checksum
+            reader.drain()
+
+        evaluated_checksum = reader.hexdigests()['md5']
+        if evaluated_checksum != dataset['bundle']['md5']:
+            raise exc.ValidationFailed(f'Expected checksum of the archived bundle to be {dataset["bundle"]["md5"]},'
+                                       f' but evaluated checksum was {evaluated_checksum}')
+
+        if staging_dir.exists():
+            shutil.rmtree(staging_dir)
+        shutil.move(Path(tmp_dir) / archive_name, staging_dir)
+    return digests
+
+
+def check_extracted_files(dataset: dict, staging_dir: Path, digests: dict[str, str],
+                          files_metadata: list[dict] = None) -> None:
+    """
+    Validate the staged files with the MD5s computed while they were extracted, without reading them again.
+
+    The digests are recorded in the digest ledger, where validate_dataset finds them for as long as the staged
+    files are unchanged. If the dataset's file metadata is given, the files are checked against it now and
+    ValidationFailed is raised with the validation errors validate_dataset would report.
+    """
+    digest_ledger.record_all_digests({staging_dir / relpath: {'md5': md5} for relpath, md5 in digests.items()})
+    if files_metadata:
+        validation_errors = compare_digests(dataset_dir=staging_dir, files_metadata=files_metadata,
+                                            digests=digests)
+        if validation_errors:
+            logger.warning(f'{len(validation_errors)} validation errors for dataset id: {dataset["id"]} '
+                           f'path: {staging_dir}')
+            raise exc.ValidationFailed(validation_errors)
+
+
+def find_local_bundle(dataset: dict) -> Path | None:
+    """
+    A copy of the dataset's bundle on local disk with the bundle's size and MD5: the bundle staged earlier, or
+    the bundle archive_dataset generated (kept in the bundle generation directory by archive modes tar and
+    stream). The MD5 of a generated bundle is in the digest ledger, so checking it does not read the bundle.
+    """
+    if not config['stage']['local_bundles']:
+        return None
+    candidates = [
+        Path(get_bundle_staged_path(dataset=dataset)),
+        Path(config['paths'][dataset['type']]['bundle']['generate']) / get_archive_bundle_name(dataset),
+    ]
+    for path in candidates:
+        try:
+            if path.stat().st_size != dataset['bundle']['size']:
+                continue
+            if digest_ledger.file_digest(path) == dataset['bundle']['md5']:
+                return path
+        except FileNotFoundError:
+            continue
+    return None
+
+
+def _stage_local_bundle(dataset: dict, local_bundle: Path) -> Path:
+    """
+    Place a verified local copy of the bundle (see find_local_bundle) in the bundle staging directory.
+    """
+    bundle_download_path = Path(get_bundle_staged_path(dataset=dataset))
+    if local_bundle != bundle_download_path:
+        bundle_download_path.parent.mkdir(parents=True, exist_ok=True)
+        method = utils.clone_file(local_bundle, bundle_download_path)
+        logger.info(f'staged {local_bundle} to {bundle_download_path} ({method}) instead of downloading '
+                    f'{dataset["archive_path"]}')
+        digest_ledger.record_digests(bundle_download_path, {'md5': dataset['bundle']['md5']})
+    return bundle_download_path
+
+
+def _stage_bundle(celery_task: WorkflowTask, dataset: dict, local_bundle: Path | None) -> Path:
+    """
+    Download the bundle into the bundle staging directory and verify its checksum. The verified local copy of
+    the bundle local_bundle (see find_local_bundle) is used instead of the archived one if it is not None.
+    """
+    if local_bundle is not None:
+        return _stage_local_bundle(dataset, local_bundle)
+
+    bundle_download_path = Path(get_bundle_staged_path(dataset=dataset))
+    if chunkstore.is_recipe(dataset['archive_path']):
+        # archived in the chunk store: rebuild the bundle from its chunks
+        chunkstore.restore(recipe_path=dataset['archive_path'],
+                           local_file=bundle_download_path,
+                           celery_task=celery_task)
+    else:
+        wf_utils.stage(archive_path=dataset['archive_path'],
+                       local_file_path=bundle_download_path,
+                       celery_task=celery_task)
+
+    evaluated_checksum = utils.checksum(bundle_download_path)
+    if evaluated_checksum != dataset['bundle']['md5']:
+        raise exc.ValidationFailed(f'Expected checksum of downloaded file to be {dataset["bundle"]["md5"]},'
+                                   f' but evaluated checksum was {evaluated_checksum}')
+    return bundle_download_path
+
+
+def stage(celery_task: WorkflowTask, dataset: dict, load_files: Callable[[], list[dict]] = None) -> (str, str):
     """
     gets the tar from the archived location, and extracts it
 
+    Datasets still in the staging cache (see workers/staging_cache.py) are not staged again.
+
+    With config['stage']['mode'] 'stream', the tar is extracted as it is read from the archived location
+    (see stream_stage) and no local copy of it is kept. Bundles in the chunk store are always rebuilt first.
+    Bundles that are still on local disk (see find_local_bundle) are extracted from there - in 'stream' mode
+    where they are, without a copy in the bundle staging directory.
+
     input: dataset['name'], dataset['archive_path'] should exist
+    load_files: returns the dataset's file metadata to check the extracted files against (see
+                check_extracted_files). It is only called if the dataset is extracted, not for a dataset in the
+                staging cache. Default: dataset['files'], if they are loaded
     returns: stage_path
     """
     staging_dir, alias = compute_staging_path(dataset)
 
-    archived_bundle_path = dataset['archive_path']
     alias_dir = staging_dir.parent
     alias_dir.mkdir(parents=True, exist_ok=True)
 
-    bundle = dataset["bundle"]
-    bundle_md5 = bundle["md5"]
-    bundle_download_path = Path(get_bundle_staged_path(dataset=dataset))
+    if staging_cache.lookup(dataset, staging_dir):
+        logger.info(f'{dataset["archive_path"]} is staged in {staging_dir}')
+        return str(staging_dir), alias
+    staging_cache.forget(staging_dir)
 
-    wf_utils.stage(archive_path=archived_bundle_path,
-                   local_file_path=bundle_download_path,
-                   celery_task=celery_task)
+    local_bundle = find_local_bundle(dataset)
+    if config['stage']['mode'] == 'stream' and local_bundle is not None:
+        logger.info(f'extracting local bundle {local_bundle} to {staging_dir} instead of streaming '
+                    f'{dataset["archive_path"]}')
+        digests = extract_tarfile(tar_path=local_bundle, target_dir=staging_dir, override_arcname=True)
+    elif config['stage']['mode'] == 'stream' and not chunkstore.is_recipe(dataset['archive_path']):
+        logger.info(f'streaming {dataset["archive_path"]} to {staging_dir}')
+        digests = stream_stage(celery_task, dataset, staging_dir)
+    else:
+        bundle_download_path = _stage_bundle(celery_task, dataset, local_bundle)
 
-    evaluated_checksum = utils.checksum(bundle_download_path)
-    if evaluated_checksum != bundle_md5:
-        raise exc.ValidationFailed(f'Expected checksum of downloaded file to be {bundle_md5},'
-                                   f' but evaluated checksum was {evaluated_checksum}')
+        # extract the tar file to stage directory
+        logger.info(f'extracting tar {bundle_download_path} to {staging_dir}')
+        digests = extract_tarfile(tar_path=bundle_download_path, target_dir=staging_dir, override_arcname=True)
 
-    # extract the tar file to stage directory
-    logger.info(f'extracting tar {bundle_download_path} to {staging_dir}')
-    extract_tarfile(tar_path=bundle_download_path, target_dir=staging_dir, override_arcname=True)
+    files_metadata = load_files() if load_files is not None else dataset.get('files')
+    check_extracted_files(dataset, staging_dir, digests, files_metadata)
+    staging_cache.record(dataset, staging_dir, readable_by_others=config['stage']['extract']['readable_by_others'])
 
     # delete the local tar copy after extraction
     # bundle_path.unlink()
@@ -93,9 +276,76 @@ def stage(celery_task: WorkflowTask, dataset: dict) -> (str, str):
     return str(staging_dir), alias
 
 
+def partial_staging_path(dataset: dict) -> Path:
+    """
+    Directory stage_files() writes to - next to, not in, the staging directory of the full dataset.
+    """
+    staging_dir, _ = compute_staging_path(dataset)
+    return staging_dir.parent / 'partial' / dataset['name']
+
+
+def stage_files(celery_task: WorkflowTask, dataset: dict, files: list[str]) -> Path:
+    """
+    Stage only some of the files of an archived dataset, using the bundle's member index to read just the
+    byte ranges (or, for seekable zstd bundles, the frames; for bundles in the chunk store, the chunks) that
+    hold them. The rest of the bundle is skipped without being staged.
+
+    Bundles archived without an index are staged whole once; their index is built then and archived for the
+    next request.
+
+    input: dataset['name'], dataset['archive_path'] and dataset['bundle'] should exist
+    files: paths relative to the dataset root, as in the dataset's file metadata
+    returns: the directory the files were staged to (see partial_staging_path)
+    """
+    index_path = Path(config['paths'][dataset['type']]['bundle']['stage']) / get_bundle_index_name(dataset)
+    index_path.parent.mkdir(parents=True, exist_ok=True)
+    index_archive_path = get_bundle_index_archive_path(dataset)
+
+    local_bundle = None
+    if wf_utils.exists_in_archive(index_archive_path):
+        wf_utils.stage(archive_path=index_archive_path, local_file_path=index_path)
+    else:
+        logger.warning(f'{index_archive_path} does not exist - staging the whole bundle to index it')
+        local_bundle = _stage_bundle(celery_task, dataset, find_local_bundle(dataset))
+        bundle_index.index_bundle(local_bundle, index_path)
+        wf_utils.archive(local_file_path=index_path, archive_path=index_archive_path)
+
+    try:
+        entries, frames = bundle_index.read_index(index_path, files)
+    except bundle_index.BundleIndexError as e:
+        raise exc.ValidationFailed(str(e))
+
+    target_dir = partial_staging_path(dataset)
+    target_dir.parent.mkdir(parents=True, exist_ok=True)
+    logger.info(f'staging {len(files)} files of {dataset["archive_path"]} to {target_dir}')
+    with tempfile.TemporaryDirectory(dir=target_dir.parent) as tmp_dir:
+        if local_bundle is not None:
+            reader = open(local_bundle, 'rb')
+        elif chunkstore.is_recipe(dataset['archive_path']):
+            # only the chunks that hold the members are restored, the rest of the bundle is a hole
+            local_bundle = Path(tmp_dir) / get_bundle_name(dataset)
+            chunkstore.restore(recipe_path=dataset['archive_path'],
+                               local_file=local_bundle,
+                               ranges=[(e.offset, e.offset + e.stored_size) for e in entries if e.type == 'file'])
+            reader = open(local_bundle, 'rb')
+        else:
+            reader = wf_utils.open_archive_reader(dataset['archive_path'])
+        with reader as stream:
+            num_bytes = bundle_index.read_members(stream, entries, Path(tmp_dir) / dataset['name'],
+                                                  frames=frames,
+                                                  threads=config['archive']['zstd']['threads'])
+        if target_dir.exists():
+            shutil.rmtree(target_dir)
+        shutil.move(Path(tmp_dir) / dataset['name'], target_dir)
+    logger.info(f'staged {len(entries)} files ({num_bytes} bytes) to {target_dir}')
+    return target_dir
+
+
 def stage_dataset(celery_task, dataset_id, **kwargs):
     dataset = api.get_dataset(dataset_id=dataset_id, bundle=True)
-    staged_path, alias = stage(celery_task, dataset)
+    # the file metadata is loaded only if the dataset is not in the staging cache
+    staged_path, alias = stage(celery_task, dataset,
+                               load_files=lambda: api.get_dataset(dataset_id=dataset_id, files=True)['files'])
 
     update_data = {
         'staged_path': staged_path,
@@ -106,3 +356,14 @@ def stage_dataset(celery_task, dataset_id, **kwargs):
     api.update_dataset(dataset_id=dataset_id, update_data=update_data)
     api.add_state_to_dataset(dataset_id=dataset_id, state='FETCHED')
     return dataset_id,
+
+
+def stage_dataset_files(celery_task, dataset_id, files: list[str] = None, **kwargs):
+    """
+    Stage a subset of a dataset's files (see stage_files). The dataset's staged_path and states are not changed.
+    """
+    if not files:
+        raise exc.ValidationFailed('no files to stage')
+    dataset = api.get_dataset(dataset_id=dataset_id, bundle=True)
+    stage_files(celery_task, dataset, files)
+    return dataset_id,
@@ -1,3 +1,5 @@
+import math
+import random
 from pathlib import Path
 
 from celery import Celery
@@ -7,47 +9,147 @@ from sca_rhythm.progress import Progress
 
 import workers.api as api
 import workers.config.celeryconfig as celeryconfig
-import workers.utils as utils
+from workers import digest_ledger, hashing
 from workers import exceptions as exc
+from workers.config import config
 
 app = Celery("tasks")
 app.config_from_object(celeryconfig)
 logger = get_task_logger(__name__)
 
+# size: every file exists and has its recorded size
+# sample: and the MD5s of a random sample of the files match (see sample_size)
+# full: and the MD5s of all the files match, read from disk - for audits of data that may have rotted since it
+#   was staged, the digest ledger is not used
+TIERS = ['size', 'sample', 'full']
+
+
+def _check_file(path: Path, expected_md5: str, digest: str = None, reread: bool = False):
+    """
+    Validation error for the file at path, or None. digest is the MD5 of the file if it is already known.
+    Otherwise it is looked up in (or hashed into) the digest ledger, or with reread, hashed from the file's
+    contents even if the ledger has it.
+    """
+    if not path.exists():
+        return str(path), 'file does not exist'
+    # for symlinks skip checksum validation
+    if path.is_symlink():
+        return None
+    if digest is None and reread:
+        digest = hashing.hash_file(path, ['md5'])['md5']
+    elif digest is None:
+        digest = digest_ledger.file_digest(path)
+    if digest != expected_md5:
+        return str(path), 'checksum mismatch'
+    return None
+
+
+def _check_size(path: Path, expected_size: int):
+    """
+    Validation error for the file at path, or None, without reading it.
+    """
+    if not path.exists():
+        return str(path), 'file does not exist'
+    if path.is_symlink():
+        return None
+    if expected_size is None:
+        return str(path), 'size is not recorded'
+    if path.stat().st_size != expected_size:
+        return str(path), 'size mismatch'
+    return None
+
+
+def sample_size(num_files: int, confidence: float, defect_rate: float) -> int:
+    """
+    Number of files to hash so that, if at least defect_rate of num_files files are corrupt, at least one of
+    them is in a random sample with probability confidence: 1 - (1 - defect_rate) ** n >= confidence.
+    """
+    if defect_rate >= 1:
+        return min(1, num_files)
+    if defect_rate <= 0:
+        return num_files
+    return min(num_files, math.ceil(math.log(1 - confidence) / math.log(1 - defect_rate)))
+
+
+def check_files(celery_task: WorkflowTask,
+                dataset_dir: Path,
+                files_metadata: list[dict],
+                tier: str = 'full',
+                rng: random.Random = None):
+    """
+    Validate the files of a staged dataset at one of the TIERS.
+
+    returns: validation errors [(path, reason)], and a report of the check: {'tier', 'files', 'hashed_files'}
+    """
+    if tier not in TIERS:
+        raise ValueError(f'unknown validation tier {tier}, expected one of {TIERS}')
+
+    if tier == 'full':
+        hashed = files_metadata
+    elif tier == 'sample':
+        sample_config = config['validate']['sample']
+        k = sample_size(len(files_metadata), sample_config['confidence'], sample_config['defect_rate'])
+        hashed = (rng or random).sample(files_metadata, k)
+    else:
+        hashed = []
+
+    validation_errors = []
+    if tier != 'full':
+        for file_metadata in files_metadata:
+            error = _check_size(dataset_dir / file_metadata['path'], file_metadata.get('size'))
+            if error is not None:
+                validation_errors.append(error)
+        # files that fail the size check are not hashed
+        failed = {path for path, _ in validation_errors}
+        hashed = [f for f in hashed if str(dataset_dir / f['path']) not in failed]
 
-def check_files(celery_task: WorkflowTask, dataset_dir: Path, files_metadata: list[dict]):
     progress = Progress(celery_task=celery_task, units='files')
+    for file_metadata in progress(hashed):
+        error = _check_file(dataset_dir / file_metadata['path'], file_metadata['md5'], reread=tier == 'full')
+        if error is not None:
+            validation_errors.append(error)
+    return validation_errors, {'tier': tier, 'files': len(files_metadata), 'hashed_files': len(hashed)}
+
+
+def compare_digests(dataset_dir: Path, files_metadata: list[dict], digests: dict[str, str]):
+    """
+    check_files() with MD5s that are already known - {path relative to dataset_dir: MD5}, e.g. computed while
+    the files were extracted. Files without a known MD5 are looked up in (or hashed into) the digest ledger.
+    """
     validation_errors = []
-    for file_metadata in progress(files_metadata):
+    for file_metadata in files_metadata:
         rel_path = file_metadata['path']
-        path = dataset_dir / rel_path
-        if path.exists():
-            # for symlinks skip checksum validation
-            if path.is_symlink():
-                continue
-            digest = utils.checksum(path)
-            if digest != file_metadata['md5']:
-                validation_errors.append((str(path), 'checksum mismatch'))
-        else:
-            validation_errors.append((str(path), 'file does not exist'))
+        error = _check_file(dataset_dir / rel_path, file_metadata['md5'], digests.get(rel_path))
+        if error is not None:
+            validation_errors.append(error)
     return validation_errors
 
 
-def validate_dataset(celery_task, dataset_id, **kwargs):
+def validate_dataset(celery_task, dataset_id, tier: str = None, **kwargs):
+    """
+    @param tier: one of TIERS - set per workflow in the kwargs of its validate step (config['workflow_registry']),
+                 config['validate']['tier'] by default
+    """
+    tier = tier or config['validate']['tier']
     dataset = api.get_dataset(dataset_id=dataset_id, files=True)
     staged_path = Path(dataset['staged_path'])
 
-    validation_errors = check_files(celery_task=celery_task,
-                                    dataset_dir=staged_path,
-                                    files_metadata=dataset['files'])
+    # below tier full, the digests stage computed while extracting are in the digest ledger - unchanged files
+    # are not read again
+    validation_errors, report = check_files(celery_task=celery_task,
+                                            dataset_dir=staged_path,
+                                            files_metadata=dataset['files'],
+                                            tier=tier)
+    logger.info(f'validated dataset id: {dataset_id} path: {staged_path} {report}')
 
     if len(validation_errors) > 0:
-        logger.warning(f'{len(validation_errors)} validation errors for dataset id: {dataset_id} path: {staged_path}')
+        logger.warning(f'{len(validation_errors)} validation errors ({tier} validation) for dataset id: {dataset_id}'
+                       f' path: {staged_path}')
         raise exc.ValidationFailed(validation_errors)
 
     update_data = {
         'is_staged': True
     }
     api.update_dataset(dataset_id=dataset_id, update_data=update_data)
-    api.add_state_to_dataset(dataset_id=dataset_id, state='STAGED')
-    return dataset_id, validation_errors
+    api.add_state_to_dataset(dataset_id=dataset_id, state='STAGED', metadata={'validation': report})
+    return dataset_id, validation_errors, report
@@ -13,6 +13,12 @@ existence check.
 
 from pathlib import Path
 
+from workers import digest_ledger
+
+# digests computed in the single verification read of every uploaded file:
+# blake3 for the manifest-hash and md5 for the dataset file metadata collected later by inspect_dataset
+UPLOAD_DIGEST_ALGORITHMS = ['blake3', 'md5']
+
 
 def verify_upload_integrity(dataset, upload_log=None):
     """
@@ -255,7 +261,8 @@ def _compute_manifest_hash(origin_path):
 
       1. Collect all files under origin_path, sorted by relative path.
       2. Hash each file in streaming 16 MB chunks (optimal for Lustre HPFS;
-         >4 MB minimum, 10–32 MB ideal range).
+         >4 MB minimum, 10–32 MB ideal range), unless the digest ledger
+         already has the BLAKE3 digest of the unchanged file.
       3. Build a manifest string:
              blake3-manifest-v1
              <rel_path>\\t<size_bytes>\\t<file_hash>
@@ -274,9 +281,6 @@ def _compute_manifest_hash(origin_path):
     """
     import blake3  # already confirmed importable in verify_upload_integrity
 
-    # 16 MB chunks — optimal for Lustre HPFS (>4 MB minimum, 10–32 MB ideal)
-    CHUNK_SIZE = 16 * 1024 * 1024
-
     files = sorted([f for f in origin_path.rglob('*') if f.is_file()])
 
     if not files:
@@ -288,12 +292,11 @@ def _compute_manifest_hash(origin_path):
     for idx, file_path in enumerate(files, 1):
         print(f"    Hashing file {idx}/{len(files)}: {file_path.name} ({file_path.stat().st_size} bytes)")
         
-        # Stream hash file content in chunks to avoid loading entire file into memory
-        hasher = blake3.blake3()
-        with open(file_path, 'rb') as f:
-            while chunk := f.read(CHUNK_SIZE):
-                hasher.update(chunk)
-        file_hash = hasher.hexdigest()
+        # Stream hash file content in chunks to avoid loading entire file into memory.
+        # Files that were already hashed by a previous (retried) verification are looked up in the
+        # digest ledger and not read again.
+        # The MD5 that inspect_dataset needs is computed in the same read and recorded in the ledger.
+        file_hash = digest_ledger.file_digests(file_path, algorithms=UPLOAD_DIGEST_ALGORITHMS)['blake3']
         print(f"      File hash: {file_hash}")
 
         # Relative path from origin_path
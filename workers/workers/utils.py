@@ -1,15 +1,18 @@
 from __future__ import annotations  # type unions by | are only available in versions > 3.10
 
-import hashlib
 import json
 import os
-from collections.abc import Iterable
+from collections import deque
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from datetime import datetime, timezone, date, time
 from enum import Enum, unique
 from itertools import islice
 from pathlib import Path
 
+from workers import hashing
+
 
 def str_func_call(func, args, kwargs):
     args_list = [repr(arg) for arg in args] + [f"{key}={repr(val)}" for key, val in kwargs.items()]
@@ -18,11 +21,7 @@ def str_func_call(func, args, kwargs):
 
 
 def checksum(fname: Path | str):
-    m = hashlib.md5()
-    with open(str(fname), "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            m.update(chunk)
-    return m.hexdigest()
+    return hashing.hash_file(fname, ['md5'])['md5']
 
 
 #
@@ -111,6 +110,70 @@ def batched(iterable: Iterable, n: int) -> list:
         yield batch
 
 
+def parallel_map(fn: Callable, iterable: Iterable, num_workers: int, max_pending: int = None) -> Iterator:
+    """
+    Lazily apply fn to every item of iterable on a pool of num_workers threads and yield the results
+    in input order (like the builtin map).
+
+    At most max_pending calls (default: 2 * num_workers) are in flight at any time, so the iterable is only
+    consumed as fast as the results are, and memory stays bounded for very large inputs.
+    Exceptions raised by fn are re-raised in the caller when the corresponding result is reached.
+
+    Threads are used because the work this is meant for (file I/O and hashlib digests) releases the GIL.
+    With num_workers <= 1, fn is called serially in the calling thread.
+    """
+    if num_workers <= 1:
+        yield from map(fn, iterable)
+        return
+
+    max_pending = max_pending or 2 * num_workers
+    pool = ThreadPoolExecutor(max_workers=num_workers)
+    pending = deque()
+    try:
+        for item in iterable:
+            pending.append(pool.submit(fn, item))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        # do not leave queued work running if the consumer stopped early or raised
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def clone_file(src: Path, dst: Path) -> str:
+    """
+    Make dst a copy of src as cheaply as the file system allows: a hard link, else a copy_file_range copy
+    (a reflink on file systems that share extents, a server-side copy on others), else a plain copy.
+    An existing dst is replaced.
+
+    @return: 'link', 'copy_file_range' or 'copy'
+    """
+    dst.unlink(missing_ok=True)
+    try:
+        os.link(src, dst)
+        return 'link'
+    except OSError:
+        pass
+
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        remaining = os.fstat(fsrc.fileno()).st_size
+        try:
+            while remaining > 0:
+                copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                if copied == 0:
+                    break
+                remaining -= copied
+            if remaining == 0:
+                return 'copy_file_range'
+        except OSError:
+            # not supported between these file systems - copy what is left with read / write
+            pass
+        while data := fsrc.read(hashing.default_block_size()):
+            fdst.write(data)
+    return 'copy'
+
+
 @contextmanager
 def empty_context_manager():
     try:
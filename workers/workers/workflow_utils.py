@@ -12,7 +12,7 @@ import billiard as multiprocessing
 from sca_rhythm import WorkflowTask
 from sca_rhythm.progress import Progress
 
-from workers import sda, utils
+from workers import digest_ledger, multipart, sda, utils
 from workers.config import app_env, config
 
 logger = logging.getLogger(__name__)
@@ -98,6 +98,14 @@ def upload_file_to_sda(local_file_path: Path,
     @param verify_checksum:
     @param preflight_check:
     """
+    part_size = config['sda']['part_size']
+    if part_size and local_file_path.stat().st_size > part_size:
+        _upload_parts(local_file_path, sda_file_path, part_size=part_size, celery_task=celery_task,
+                      verify_checksum=verify_checksum, preflight_check=preflight_check)
+        # a bundle that was stored as a single file is replaced by its parts
+        sda.delete(sda_file_path)
+        return
+
     local_digest = None
     sda_digest = None
 
@@ -105,7 +113,7 @@ def upload_file_to_sda(local_file_path: Path,
         sda_digest = sda.get_hash(sda_file_path, missing_ok=True)
         if sda_digest is not None:
             logger.info(f'computing checksum of local file {local_file_path} to compare with sda_digest')
-            local_digest = utils.checksum(local_file_path)
+            local_digest = digest_ledger.file_digest(local_file_path)
 
     if sda_digest is not None and local_digest is not None and sda_digest == local_digest:
         logger.warning(f'The checksums of local file {local_file_path} and SDA file {sda_file_path} match - not '
@@ -123,6 +131,57 @@ def upload_file_to_sda(local_file_path: Path,
         with cm:
             logging.info(f'putting {local_file_path} on SDA at {sda_file_path}')
             sda.put(local_file=str(local_file_path), sda_file=sda_file_path, verify_checksum=verify_checksum)
+    # a bundle that was stored in parts is replaced by a single file - its manifest would be read first
+    multipart.delete(sda_file_path)
+
+
+def _upload_parts(local_file_path: Path, sda_file_path: str, *, part_size: int, celery_task: WorkflowTask = None,
+                  verify_checksum: bool = True, preflight_check: bool = True) -> None:
+    # with the MD5 of the bundle in its manifest, a bundle that is already on SDA in parts is not uploaded again
+    local_digest = digest_ledger.file_digest(local_file_path) if preflight_check else None
+    if local_digest is not None:
+        manifest = multipart.read_manifest(sda_file_path)
+        if manifest is not None and manifest.get('md5') == local_digest:
+            logger.warning(f'The checksums of local file {local_file_path} and the parts of SDA file {sda_file_path} '
+                           f'match - not uploading')
+            return
+
+    progress = Progress(celery_task=celery_task, name='sda put', total=local_file_path.stat().st_size,
+                        units='bytes')
+    transferred = 0
+
+    def on_part(part: multipart.Part):
+        nonlocal transferred
+        transferred += part.size
+        progress.update(transferred)
+
+    logger.info(f'putting {local_file_path} on SDA at {multipart.parts_dir(sda_file_path)} in parts of '
+                f'{part_size} bytes')
+    multipart.put(local_file=local_file_path, sda_file=sda_file_path, part_size=part_size,
+                  parallel_transfers=config['sda']['parallel_transfers'], on_part=on_part,
+                  verify_checksum=verify_checksum, md5=local_digest)
+
+
+def _download_parts(sda_file_path: str, local_file_path: Path, manifest: dict, *, celery_task: WorkflowTask = None,
+                    verify_checksum: bool = True, preflight_check: bool = False) -> None:
+    if preflight_check and manifest.get('md5') is not None and local_file_path.is_file():
+        logger.info(f'computing checksum of local file {local_file_path}')
+        if digest_ledger.file_digest(local_file_path) == manifest['md5']:
+            logger.warning(f'local file exists and the checksums match - not getting from the SDA')
+            return
+
+    progress = Progress(celery_task=celery_task, name='sda get', total=manifest['size'], units='bytes')
+    transferred = 0
+
+    def on_part(part: multipart.Part):
+        nonlocal transferred
+        transferred += part.size
+        progress.update(transferred)
+
+    logger.info(f'getting {len(manifest["parts"])} parts of {sda_file_path} from SDA to {local_file_path}')
+    multipart.get(sda_file=sda_file_path, local_file=local_file_path, manifest=manifest,
+                  parallel_transfers=config['sda']['parallel_transfers'], on_part=on_part,
+                  verify_checksum=verify_checksum)
 
 
 def download_file_from_sda(sda_file_path: str,
@@ -140,6 +199,12 @@ def download_file_from_sda(sda_file_path: str,
     @param verify_checksum:
     @param preflight_check:
     """
+    manifest = multipart.read_manifest(sda_file_path)
+    if manifest is not None:
+        _download_parts(sda_file_path, local_file_path, manifest, celery_task=celery_task,
+                        verify_checksum=verify_checksum, preflight_check=preflight_check)
+        return
+
     file_exists = False
 
     if preflight_check:
@@ -193,6 +258,76 @@ def archive(local_file_path: Path, archive_path: str, *, celery_task: WorkflowTa
         )
 
 
+@contextmanager
+def open_archive_stream(archive_path: str, *, verify_checksum: bool = True):
+    """
+    Writable binary stream to a Dataset's archive location, for archiving without a local bundle file.
+
+    In docker the stream is written to a temporary file next to archive_path which is renamed into place
+    when the body completes. Otherwise it is piped into `hsi put` (see sda.put_stream).
+
+    @param archive_path: Path to the Dataset's archived location
+    @param verify_checksum: have SDA compute and store a checksum of the stream
+    """
+    if app_env == 'docker':
+        archive_file_path = Path(archive_path)
+        archive_file_path.parent.mkdir(parents=True, exist_ok=True)
+        partial_path = archive_file_path.with_name(f'{archive_file_path.name}.partial')
+        try:
+            with open(partial_path, 'wb') as f:
+                yield f
+            partial_path.replace(archive_file_path)
+        finally:
+            partial_path.unlink(missing_ok=True)
+    else:
+        with sda.put_stream(sda_file=archive_path, verify_checksum=verify_checksum) as f:
+            yield f
+        # a bundle that was stored in parts is replaced by a single file - its manifest would be read first
+        multipart.delete(archive_path)
+
+
+@contextmanager
+def open_archive_reader(archive_path: str):
+    """
+    Readable binary stream of a file in the archive location, for reading parts of it without staging it.
+
+    In docker the archived file is opened directly (the stream is seekable). Otherwise it is read from the
+    stdout of `hsi get` (see sda.get_stream) - one part after another for bundles stored in parts - and can only
+    be read forward.
+
+    @param archive_path: Path of the file in the archive location
+    """
+    if app_env == 'docker':
+        with open(archive_path, 'rb') as f:
+            yield f
+    else:
+        manifest = multipart.read_manifest(archive_path)
+        if manifest is not None:
+            with multipart.open_reader(sda_file=archive_path, manifest=manifest) as f:
+                yield f
+        else:
+            with sda.get_stream(sda_file=archive_path) as f:
+                yield f
+
+
+def exists_in_archive(archive_path: str) -> bool:
+    if app_env == 'docker':
+        return Path(archive_path).exists()
+    return sda.exists(archive_path) or sda.exists(multipart.manifest_path(archive_path))
+
+
+def delete_from_archive(archive_path: str) -> None:
+    """
+    Delete a file from the archive location, if it exists.
+    """
+    if app_env == 'docker':
+        # remote archive storage is not available in docker - the archive is a local directory
+        Path(archive_path).unlink(missing_ok=True)
+    else:
+        sda.delete(archive_path)
+        multipart.delete(archive_path)
+
+
 def stage(archive_path: str, local_file_path: Path, *, celery_task: WorkflowTask = None) -> None:
     """
     Stage an archived Dataset from its archive location.